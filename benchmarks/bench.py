@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Ytelsesmåling av nbno mot den lokale IIIF-stand-in-serveren.
+
+Hvert scenario (medietype x hentemodus x format) kjøres i en egen
+prosess, så topp-RSS gjelder bare det scenarioet. Book.download og make_pdf
+måles, og resultatet skrives som JSON som kan sammenlignes mellom commits:
+
+    python benchmarks/bench.py --latency 0.05 --output før.json
+    python benchmarks/bench.py --latency 0.05 --compare før.json
+
+Med --codecs sammenlignes formatene for lagrede sider (kodetid per side og
+byte på disk), f.eks. --codecs jpeg,jpeg:90,webp:80,png,tiff,tiles.
+
+Kart (digikart) måles ikke: sidene deres har ikke rene tall som navn, så
+nbno laster dem ikke ned, og stand-in-serveren lager dem ikke.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import iiif_standin  # noqa: E402
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MEDIA_IDS = {
+    "digibok": "digibok_2020010100001",
+    "digavis": "digavis_standin_null_null_20200101_1_1_1",
+    "plikt": "pliktmonografi_000000001",
+}
+# numbers compared by --compare, and whether bigger is better
+COMPARED = {
+    "pages_per_sec": True,
+    "tiles_per_sec": True,
+    "download_seconds": False,
+    "pdf_seconds": False,
+    "peak_rss_mb": False,
+    "tile_p50_ms": False,
+    "tile_p95_ms": False,
+    "encode_ms_per_page": False,
+    "disk_mb": False,
+    "pdf_mb": False,
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def parse_codec(spec):
+    """"format[:kvalitet]" fra --codecs; gir (format, kvalitet eller None)."""
+    fmt, _, quality = spec.partition(":")
+    return fmt, int(quality) if quality else None
+
+
+def directory_bytes(path):
+    total = 0
+    for root, _, names in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in names)
+    return total
+
+
+def run_scenario(api_url, scenario, workdir, results):
+    """Kjøres i en egen prosess: laster ned og lager PDF av én bok i workdir."""
+    import resource
+
+    os.environ["NBNO_API_URL"] = api_url
+    os.environ["DOWNLOAD_DIR"] = workdir
+    sys.path.insert(0, REPO_DIR)
+    import nbno
+
+    latencies = []
+    encode_times = []
+    stitch_times = []
+    counts = {"tiles": 0, "bytes": 0, "retries": 0, "failed_pages": 0, "errors": 0}
+
+    def sink(event):
+        kind = event["type"]
+        if kind == "tile_fetched":
+            counts["tiles"] += 1
+            counts["bytes"] += event["bytes"]
+            latencies.append(event["seconds"])
+        elif kind == "page_finished":
+            encode_times.append(event["encode_seconds"])
+            stitch_times.append(event["stitch_seconds"])
+        elif kind == "retry":
+            counts["retries"] += 1
+        elif kind == "page_failed":
+            counts["failed_pages"] += 1
+        elif kind == "error":
+            counts["errors"] += 1
+
+    book = nbno.Book(MEDIA_IDS[scenario["media"]], cli_mode=True)
+    book.set_quiet()
+    book.add_event_sink(sink)
+    book.set_fetch_mode(scenario["mode"])
+    if scenario["workers"]:
+        book.set_max_workers(scenario["workers"])
+    if scenario["cpu_workers"]:
+        book.set_cpu_workers(scenario["cpu_workers"])
+    fmt, quality = parse_codec(scenario["codec"])
+    book.set_output(fmt, quality, scenario["progressive"], scenario["optimize"])
+    if scenario["adaptive"]:
+        book.set_adaptive()
+    if scenario["resize"]:
+        book.set_resize(scenario["resize"])
+    if scenario["covers"]:
+        book.download_covers()
+    started = time.perf_counter()
+    ok = book.download()
+    download_seconds = time.perf_counter() - started
+    saved = nbno.page_files(book.sources_dir)
+    pages = len(saved)
+    # page files, plus the tiles themselves when those are the output
+    disk_bytes = sum(os.path.getsize(path) for path in saved.values())
+    if fmt == "tiles":
+        disk_bytes += directory_bytes(book.tiles_dir)
+    started = time.perf_counter()
+    pdf_ok = book.make_pdf() if pages else False
+    pdf_seconds = time.perf_counter() - started
+    pdf_path = os.path.join(book.pdf_dir, f"{book.folder_name}.pdf")
+    pdf_bytes = os.path.getsize(pdf_path) if pdf_ok and os.path.exists(pdf_path) else 0
+    # ru_maxrss is KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results.put(dict(
+        scenario,
+        success=bool(ok),
+        pdf_success=bool(pdf_ok),
+        pages=pages,
+        tiles=counts["tiles"],
+        bytes=counts["bytes"],
+        retries=counts["retries"],
+        failed_pages=counts["failed_pages"],
+        errors=counts["errors"],
+        tile_size=book.tile_width,
+        download_seconds=round(download_seconds, 3),
+        pdf_seconds=round(pdf_seconds, 3),
+        pages_per_sec=round(pages / download_seconds, 2) if download_seconds else None,
+        tiles_per_sec=round(counts["tiles"] / download_seconds, 2) if download_seconds else None,
+        peak_rss_mb=round(peak_rss, 1),
+        tile_p50_ms=round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+        tile_p95_ms=round(percentile(latencies, 95) * 1000, 1) if latencies else None,
+        encode_ms_per_page=round(sum(encode_times) / len(encode_times) * 1000, 1) if encode_times else None,
+        encode_p95_ms=round(percentile(encode_times, 95) * 1000, 1) if encode_times else None,
+        stitch_ms_per_page=round(sum(stitch_times) / len(stitch_times) * 1000, 1) if stitch_times else None,
+        disk_mb=round(disk_bytes / 1024 / 1024, 2),
+        page_kb=round(disk_bytes / pages / 1024, 1) if pages else None,
+        pdf_mb=round(pdf_bytes / 1024 / 1024, 2),
+    ))
+
+
+def run(api_url, scenario, timeout):
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    # removed here, so a scenario that crashes or times out is cleaned up too
+    with tempfile.TemporaryDirectory(prefix="nbno-bench-") as workdir:
+        process = ctx.Process(target=run_scenario, args=(api_url, scenario, workdir, results))
+        process.start()
+        try:
+            result = results.get(timeout=timeout)
+        except Exception:
+            result = dict(scenario, success=False, error="tidsavbrudd eller krasj")
+        process.join(timeout=10)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """Skriver endringen i hvert mål mot en tidligere rapport."""
+    def key(result):
+        return (result["media"], result["mode"], result.get("codec", "jpeg"))
+
+    old = {key(result): result for result in baseline.get("results", [])}
+    for result in report["results"]:
+        before = old.get(key(result))
+        if before is None:
+            continue
+        changes = []
+        for name, higher_is_better in COMPARED.items():
+            a, b = before.get(name), result.get(name)
+            if not a or b is None:
+                continue
+            change = (b - a) / a * 100
+            better = change > 0 if higher_is_better else change < 0
+            changes.append(f"{name} {a} -> {b} ({change:+.1f}%{'' if better or not change else ' !'})")
+        print(
+            f"{result['media']}/{result['mode']}/{result.get('codec', 'jpeg')}: " + ", ".join(changes),
+            file=sys.stderr,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--media", default="digibok,digavis,plikt",
+        help=f"Medietyper, kommaseparert ({', '.join(MEDIA_IDS)})",
+    )
+    parser.add_argument("--modes", default="serial,page,book", help="Hentemoduser, kommaseparert")
+    parser.add_argument("--workers", type=int, default=0, help="Book.set_max_workers (0: standard)")
+    parser.add_argument("--cpu-workers", type=int, default=0, help="Book.set_cpu_workers (0: i trådene)")
+    parser.add_argument("--adaptive", action="store_true", help="Book.set_adaptive")
+    parser.add_argument("--resize", type=int, default=0, help="Prosent av originalstørrelse")
+    parser.add_argument(
+        "--codecs", default="jpeg",
+        help="Formater for sidene, kommaseparert som format[:kvalitet] "
+        "(jpeg, webp, png, tiff, tiles)",
+    )
+    parser.add_argument("--progressive", action="store_true", help="Book.set_output(progressive=True)")
+    parser.add_argument("--optimize", action="store_true", help="Book.set_output(optimize=True)")
+    parser.add_argument("--timeout", type=float, default=600, help="Maks sekunder per scenario")
+    parser.add_argument("--output", help="Skriv JSON-rapporten hit (standard: stdout)")
+    parser.add_argument("--compare", help="Tidligere JSON-rapport å sammenligne med")
+    iiif_standin.add_arguments(parser)
+    args = parser.parse_args()
+
+    config = iiif_standin.config_from_args(args)
+    server, api_url = iiif_standin.start(config)
+    results = []
+    try:
+        for media in args.media.split(","):
+            if media not in MEDIA_IDS:
+                parser.error(f"ukjent medietype: {media}")
+            for mode in args.modes.split(","):
+                for codec in args.codecs.split(","):
+                    scenario = {
+                        "media": media,
+                        "mode": mode,
+                        "codec": codec,
+                        "progressive": args.progressive,
+                        "optimize": args.optimize,
+                        "workers": args.workers,
+                        "cpu_workers": args.cpu_workers,
+                        "adaptive": args.adaptive,
+                        "resize": args.resize,
+                        "covers": config["covers"],
+                    }
+                    result = run(api_url, scenario, args.timeout)
+                    print(
+                        f"{media}/{mode}/{codec}: {result.get('pages_per_sec')} sider/s, "
+                        f"{result.get('tiles_per_sec')} bildedeler/s, "
+                        f"{result.get('encode_ms_per_page')} ms koding/side, "
+                        f"{result.get('disk_mb')} MB på disk",
+                        file=sys.stderr,
+                    )
+                    results.append(result)
+    finally:
+        server.terminate()
+    report = {
+        "revision": git_revision(),
+        "time": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "server": config,
+        "results": results,
+    }
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
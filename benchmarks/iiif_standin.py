@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Lokal stand-in for api.nb.no sine IIIF-tjenester, til ytelsesmåling.
+
+Svarer på manifest (Presentation 2), info.json og regioner
+(Image API 2) for alle ID-er, med like sider for hver medietype. Kart
+(digikart) finnes ikke; ID-er uten kjent type får sider som plikt.
+Forsinkelse, båndbredde, største bildedel og tilfeldige feil (403, 429,
+brutte forbindelser og avkuttede JPEG-er) kan stilles inn, så nbno kan
+måles uten å bli strupet av nb.no.
+
+    python benchmarks/iiif_standin.py --port 8088 --latency 0.05
+    NBNO_API_URL=http://127.0.0.1:8088/catalog/v1/iiif/URN:NBN:no-nb nbno --id digibok_1
+"""
+import io
+import re
+import json
+import time
+import random
+import argparse
+import threading
+import multiprocessing
+from PIL import Image
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# page size in pixels per media type (width, height)
+PAGE_SIZES = {
+    "digibok": (2000, 3000),
+    "digitidsskrift": (2000, 3000),
+    "digavis": (5000, 7000),
+    "plikt": (2000, 3000),
+}
+DEFAULTS = {
+    "pages": 20,
+    "covers": True,
+    "latency": 0.0,
+    "jitter": 0.0,
+    "bandwidth": 0,
+    "max_tile": 0,
+    "forbidden": 0.0,
+    "throttled": 0.0,
+    "dropped": 0.0,
+    "truncated": 0.0,
+    "quality": 85,
+    "seed": 1,
+}
+MANIFEST = re.compile(r"^/catalog/v1/iiif/URN:NBN:no-nb_(?P<id>[^/]+)/manifest$")
+# digavis pages are named "<n>_null"
+IMAGE = re.compile(
+    r"^/image/URN:NBN:no-nb_(?P<id>[^/]+)_(?P<page>[^/_]+(?:_[^/_]+)?)"
+    r"/(?:(?P<info>info\.json)|(?P<region>[^/]+)/(?P<size>[^/]+)/0/native\.jpg)$"
+)
+
+
+def media_type(media_id):
+    for prefix in ("digibok", "digitidsskrift", "digavis"):
+        if media_id.startswith(prefix):
+            return prefix
+    return "plikt"
+
+
+def page_names(kind, pages, covers):
+    """Sidenavnene i manifestet, i samme form som nb.no bruker per medietype."""
+    if kind == "digavis":
+        names = [f"{i:03d}_null" for i in range(1, pages + 1)]
+    else:
+        names = [f"{i:04d}" for i in range(1, pages + 1)]
+    if covers and kind != "digavis":
+        names = ["C1", "I1"] + names + ["I3", "C2", "C3"]
+    return names
+
+
+class StandIn:
+    """Sidebilder og ferdigkodede bildedeler, delt av alle forespørslene."""
+
+    def __init__(self, config):
+        self.config = dict(DEFAULTS, **config)
+        self.random = random.Random(self.config["seed"])
+        self.lock = threading.Lock()
+        self.images = {}
+        self.tiles = {}
+        self.stats = {"requests": 0, "tiles": 0, "bytes": 0, "faults": 0}
+
+    def page_image(self, kind):
+        """Et deterministisk sidebilde med støy, som komprimeres omtrent som en skanning."""
+        with self.lock:
+            image = self.images.get(kind)
+            if image is None:
+                size = PAGE_SIZES[kind]
+                noise = Image.effect_noise(size, 24)
+                gradient = Image.linear_gradient("L").resize(size)
+                image = Image.merge("RGB", (noise, gradient, noise.transpose(Image.FLIP_LEFT_RIGHT)))
+                self.images[kind] = image
+            return image
+
+    def tile(self, kind, region, size):
+        """JPEG-bytes for en region; de samme bildedelene brukes for alle sider."""
+        key = (kind, region, size)
+        with self.lock:
+            data = self.tiles.get(key)
+        if data is not None:
+            return data
+        x, y, w, h = region
+        tile = self.page_image(kind).crop((x, y, x + w, y + h))
+        if size != (w, h):
+            tile = tile.resize(size)
+        buf = io.BytesIO()
+        tile.save(buf, "JPEG", quality=self.config["quality"])
+        data = buf.getvalue()
+        with self.lock:
+            self.tiles[key] = data
+        return data
+
+    def fault(self):
+        """Velger en tilfeldig feil for en bildedel, eller None."""
+        with self.lock:
+            roll = self.random.random()
+        for name in ("forbidden", "throttled", "dropped", "truncated"):
+            roll -= self.config[name]
+            if roll < 0:
+                with self.lock:
+                    self.stats["faults"] += 1
+                return name
+        return None
+
+    def manifest(self, host, media_id):
+        kind = media_type(media_id)
+        width, height = PAGE_SIZES[kind]
+        canvases = [
+            {
+                "@id": f"{host}/canvas/URN:NBN:no-nb_{media_id}_{name}",
+                "width": width,
+                "height": height,
+                "images": [{"resource": {"service": {
+                    "@id": f"{host}/image/URN:NBN:no-nb_{media_id}_{name}",
+                }}}],
+            }
+            for name in page_names(kind, self.config["pages"], self.config["covers"])
+        ]
+        return {
+            "label": f"Stand-in {media_id}",
+            "metadata": [{"label": "Tilgang", "value": "Fritt tilgjengelig"}],
+            "sequences": [{"canvases": canvases}],
+        }
+
+    def info(self, host, media_id, page):
+        width, height = PAGE_SIZES[media_type(media_id)]
+        info = {
+            "@id": f"{host}/image/URN:NBN:no-nb_{media_id}_{page}",
+            "width": width,
+            "height": height,
+            "tiles": [{"width": 1024, "scaleFactors": [1, 2, 4, 8]}],
+        }
+        if self.config["max_tile"]:
+            info["maxWidth"] = self.config["max_tile"]
+        return info
+
+
+def parse_region(region, size, page_size):
+    """Region og størrelse fra en Image API-URL; gir ((x, y, b, h), (b, h))."""
+    if region == "full":
+        x, y, w, h = 0, 0, *page_size
+    else:
+        x, y, w, h = (int(v) for v in region.split(","))
+        w = min(w, page_size[0] - x)
+        h = min(h, page_size[1] - y)
+    if size in ("full", "max"):
+        out = (w, h)
+    elif size.startswith("pct:"):
+        pct = float(size[4:]) / 100
+        out = (max(1, round(w * pct)), max(1, round(h * pct)))
+    else:
+        sw, _, sh = size.lstrip("!").partition(",")
+        sw = int(sw) if sw else None
+        sh = int(sh) if sh else None
+        if sw and not sh:
+            sh = max(1, round(h * sw / w))
+        elif sh and not sw:
+            sw = max(1, round(w * sh / h))
+        out = (sw, sh)
+    return (x, y, w, h), out
+
+
+def make_handler(standin):
+    config = standin.config
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, status, body, content_type, headers=()):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command == "HEAD":
+                return
+            bandwidth = config["bandwidth"]
+            if not bandwidth:
+                self.wfile.write(body)
+                return
+            # pace the body in 16 KiB chunks to the configured bytes/second
+            for start in range(0, len(body), 16384):
+                chunk = body[start:start + 16384]
+                self.wfile.write(chunk)
+                time.sleep(len(chunk) / bandwidth)
+
+        def send_status(self, status, headers=()):
+            self.send_body(status, b"", "text/plain", headers)
+
+        def handle(self):
+            try:
+                super().handle()
+            except (BrokenPipeError, ConnectionResetError):
+                # the client hung up, e.g. a tile size probe reading only the status
+                pass
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def do_GET(self):
+            with standin.lock:
+                standin.stats["requests"] += 1
+            if config["latency"] or config["jitter"]:
+                time.sleep(config["latency"] + random.uniform(0, config["jitter"]))
+            host = f"http://{self.headers['Host']}"
+            path = self.path.split("?", 1)[0]
+            m = MANIFEST.match(path)
+            if m:
+                body = json.dumps(standin.manifest(host, m["id"])).encode()
+                self.send_body(200, body, "application/json")
+                return
+            m = IMAGE.match(path)
+            if not m:
+                self.send_status(404)
+                return
+            if m["info"]:
+                body = json.dumps(standin.info(host, m["id"], m["page"])).encode()
+                self.send_body(200, body, "application/json")
+                return
+            kind = media_type(m["id"])
+            try:
+                region, size = parse_region(m["region"], m["size"], PAGE_SIZES[kind])
+            except ValueError:
+                self.send_status(400)
+                return
+            if config["max_tile"] and max(region[2:]) > config["max_tile"]:
+                self.send_status(403)
+                return
+            fault = standin.fault()
+            if fault == "forbidden":
+                self.send_status(403)
+                return
+            if fault == "throttled":
+                self.send_status(429, [("Retry-After", "1")])
+                return
+            if fault == "dropped":
+                # hang up without an answer, like a timed-out connection
+                self.close_connection = True
+                return
+            data = standin.tile(kind, region, size)
+            if fault == "truncated":
+                data = data[:len(data) // 2]
+            with standin.lock:
+                standin.stats["tiles"] += 1
+                standin.stats["bytes"] += len(data)
+            self.send_body(200, data, "image/jpeg")
+
+    return Handler
+
+
+def serve(config, port=0, ready=None):
+    """Kjører stand-in-serveren til prosessen stoppes; ready får porten."""
+    standin = StandIn(config)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(standin))
+    server.daemon_threads = True
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start(config):
+    """Starter serveren i en egen prosess, så den ikke deler GIL med nbno.
+
+    Gir (prosess, api_url) der api_url passer for NBNO_API_URL.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Queue()
+    process = ctx.Process(target=serve, args=(config, 0, ready), daemon=True)
+    process.start()
+    port = ready.get(timeout=30)
+    return process, f"http://127.0.0.1:{port}/catalog/v1/iiif/URN:NBN:no-nb"
+
+
+def add_arguments(parser):
+    """Flagg for serveroppsettet, delt med bench.py."""
+    parser.add_argument("--pages", type=int, default=DEFAULTS["pages"], help="Sider per bok")
+    parser.add_argument("--no-covers", action="store_true", help="Ingen omslagssider")
+    parser.add_argument("--latency", type=float, default=0.0, help="Sekunder før hvert svar")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Tilfeldig ekstra forsinkelse (s)")
+    parser.add_argument("--bandwidth", type=int, default=0, help="Byte/s per forbindelse (0: ubegrenset)")
+    parser.add_argument("--max-tile", type=int, default=0, help="403 for større bildedeler (0: ingen grense)")
+    parser.add_argument("--forbidden", type=float, default=0.0, help="Andel bildedeler som gir 403")
+    parser.add_argument("--throttled", type=float, default=0.0, help="Andel bildedeler som gir 429")
+    parser.add_argument("--dropped", type=float, default=0.0, help="Andel forbindelser som brytes")
+    parser.add_argument("--truncated", type=float, default=0.0, help="Andel avkuttede JPEG-er")
+    parser.add_argument("--seed", type=int, default=DEFAULTS["seed"])
+
+
+def config_from_args(args):
+    return {
+        "pages": args.pages,
+        "covers": not args.no_covers,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "bandwidth": args.bandwidth,
+        "max_tile": args.max_tile,
+        "forbidden": args.forbidden,
+        "throttled": args.throttled,
+        "dropped": args.dropped,
+        "truncated": args.truncated,
+        "seed": args.seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8088)
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(f"NBNO_API_URL=http://127.0.0.1:{args.port}/catalog/v1/iiif/URN:NBN:no-nb")
+    serve(config_from_args(args), args.port)
+
+
+if __name__ == "__main__":
+    main()
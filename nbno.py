@@ -3,51 +3,151 @@
 import io
 import os
 import re
-import warnings
+import sys
+import json
+import queue
+import time
+import random
+import hashlib
+import tempfile
 import argparse
+import atexit
 import threading
-from PIL import Image, UnidentifiedImageError
-from glob import glob
+import contextlib
+import collections
+from PIL import Image
 from math import ceil
 import multiprocessing
+from multiprocessing import shared_memory
 from requests import session
 import concurrent.futures as cf
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
 
 BASE_DIR = os.environ.get('DOWNLOAD_DIR', '.')
 # directory for aggregated PDFs
 # PDFs and sources organized per book directory
 
+# IIIF endpoint; NBNO_API_URL points nbno at another server, e.g. the
+# stand-in in benchmarks/
+API_URL = os.environ.get('NBNO_API_URL', "https://api.nb.no/catalog/v1/iiif/URN:NBN:no-nb")
+# tile fetch strategies selectable per Book (see Book.set_fetch_mode)
+FETCH_MODES = ("serial", "page", "book")
+# cover/insert pages are skipped rather than retried when they fail
+COVER_PAGES = ("I3", "I1", "C3", "C2", "C1")
+# responses that make the adaptive controller back off (408 = timeout)
+THROTTLE_STATUSES = (408, 429, 503)
+DEFAULT_TILE_CACHE_BYTES = 1024 * 1024 * 1024
+JOURNAL_FILE = ".nbno_journal"
+# download_page result for a page that ran out of retries (see failed_pages)
+PAGE_FAILED = 206
+# pixels per inch for PDF pages; PDFs have always been laid out at 100 dpi
+PDF_RESOLUTION = 100.0
+# pages read ahead of the PDF writer while building from files
+PDF_PREFETCH = 4
+FRONT_COVERS = ("C1", "I1")
+BACK_COVERS = ("I3", "C2", "C3")
+# parsed manifests are shared between Book instances for MANIFEST_TTL seconds,
+# then revalidated with ETag/Last-Modified; a copy is kept in metadata/.
+# At most MANIFEST_CACHE_SIZE are held in memory, least recently used out
+MANIFEST_TTL = 300
+MANIFEST_CACHE_SIZE = 64
+MANIFEST_FILE = ".nbno_manifest.json"
+# url -> (time stored, record)
+_manifest_cache = collections.OrderedDict()
+_manifest_lock = threading.Lock()
+# largest tile the image server accepts, per media type and access class,
+# found by probing once and remembered for later books (see probe_tile_size)
+TILE_SIZE_FILE = os.path.join(BASE_DIR, ".nbno_tile_sizes.json")
+TILE_SIZE_CANDIDATES = (4096, 2048, 1024, 512, 300, 200)
+# media types the sizes are remembered for separately (plikt* share one)
+MEDIA_TYPES = (
+    "digibok", "digavis", "digifoto", "digitidsskrift", "digikart",
+    "digimanus", "digiprogramrapport",
+)
+_tile_size_lock = threading.Lock()
+# how saved pages are written: file extension and Pillow format. "tiles"
+# keeps the server's JPEG tiles in tiles/<side>/ and only writes a marker
+OUTPUT_FORMATS = {
+    "jpeg": (".jpg", "JPEG"),
+    "webp": (".webp", "WEBP"),
+    "png": (".png", "PNG"),
+    "tiff": (".tif", "TIFF"),
+    "tiles": (".tiles", None),
+}
+IMAGE_EXTENSIONS = tuple(ext for ext, fmt in OUTPUT_FORMATS.values() if fmt)
+# largest width or height libwebp can encode; bigger pages are saved as JPEG
+WEBP_MAX_SIZE = 16383
+
+
 class Book:
     """Holder styr på all info om bildefiler til bok/avis/mm."""
 
-    def __init__(self, digimedie, cli_mode=False):
+    def __init__(self, digimedie, cli_mode=False, offline=False, session=None):
         # original passed ID; media_type and media_id will be set next
         self.digimedie = digimedie
         # run in CLI mode (flat dirs) vs. webapp mode (sources/, metadata/, pdf/)
         self.cli_mode = bool(cli_mode)
-        if digimedie.find("plikt") > -1:
-            self.media_type = "plikt" + \
-                digimedie.split("plikt")[1].split("_")[0]
-        else:
-            self.media_type = "dig" + digimedie.split("dig")[1].split("_")[0]
-        self.media_id = digimedie.split(self.media_type + "_")[1]
+        self.media_type, self.media_id = parse_media_id(digimedie)
+        # offline: read the manifest from the stored copy only, never the network
+        self.offline = bool(offline)
+        self._manifest_record = None
         # default folder_name = type + '_' + id
         self.folder_name = f"{self.media_type}_{self.media_id}"
         # store the original download folder name for canonical references
         self.default_folder_name = self.folder_name
         self.current_page = "0001"
         self.max_workers = multiprocessing.cpu_count() * 4
+        # how tiles are fetched: "serial", "page" (parallel per page) or
+        # "book" (one prioritized tile queue for the whole book)
+        self.fetch_mode = "serial"
+        self.tile_workers = 8
+        # optional AIMD limit on tile requests in flight (see set_adaptive)
+        self.controller = None
+        # optional on-disk cache of tile bytes keyed by region URL
+        self.tile_cache = None
+        # keep raw tiles in tiles/<side>/ and/or build the PDF from them live
+        self.keep_tiles = False
+        self.live_tile_pdf = False
+        self.tile_pdf = None
+        # (sink, types) pairs receiving progress events (see add_event_sink)
+        self.event_sinks = []
+        # quiet: no printing, messages only go out as "log" events
+        self.quiet = False
+        # bounded, backed-off retries of missing tiles; pages that run out
+        # of retries end up in failed_pages
+        self.retry_policy = RetryPolicy()
+        self.failed_pages = {}
+        # tile-level resume journal in the metadata dir (see set_resume)
+        self.resume = False
+        self.journal = None
+        # optional Profiler timing each stage (see set_profile)
+        self.profiler = None
+        # processes that decode, stitch and encode pages; 0 does it in the
+        # download threads (see set_cpu_workers)
+        self.cpu_workers = 0
+        # format and Pillow save() options for pages (see set_output)
+        self.output_format = "jpeg"
+        self.save_options = {}
         self.covers = False
         self.verbose = False
         self.print_url = False
         self.print_error = False
         self.tile_width = 1024
         self.tile_height = 1024
-        self.api_url = "https://api.nb.no/catalog/v1/iiif/URN:NBN:no-nb"
+        # where the tile size came from: None (not chosen yet), "set",
+        # "default", "probe" or "cache"
+        self.tile_size_source = None
+        self.probe_tiles = True
+        self.tile_size_lock = threading.Lock()
+        self.api_url = API_URL
         self.tilgang = ""
         self.image_url = ""
         self.title = "nbno"
@@ -61,12 +161,8 @@ class Book:
         # manifest-level thumbnail (from IIIF manifest), if any
         self.manifest_thumbnail = None
         self.resize = 0
-        self.session = session()
-        self.session.headers["User-Agent"] = "Mozilla/5.0"
-        self.adapter = HTTPAdapter(max_retries=(
-            Retry(total=5, backoff_factor=0.5)))
-        self.session.mount("https://", self.adapter)
-        self.session.mount("http://", self.adapter)
+        # books in a batch share one session, and so one connection pool
+        self.session = session if session is not None else new_session()
         # whether to include a cover page (C1.jpg) first in PDF output
         self.include_cover = False
         # base output directory may be configured via DOWNLOAD_DIR env var
@@ -76,18 +172,169 @@ class Book:
             self.sources_dir = self.folder_path
             self.pdf_dir = self.folder_path
             self.meta_dir = self.folder_path
+            self.tiles_dir = os.path.join(self.folder_path, 'tiles') + os.path.sep
         else:
             self.sources_dir = os.path.join(self.folder_path, 'sources') + os.path.sep
             self.pdf_dir = os.path.join(self.folder_path, 'pdf') + os.path.sep
             self.meta_dir = os.path.join(self.folder_path, 'metadata') + os.path.sep
+            self.tiles_dir = os.path.join(self.folder_path, 'tiles') + os.path.sep
         self.get_manifest()
         self.image_lock = threading.Lock()
         self.download_skipped = False
         self._pdf_redownload_attempts = set()
 
+    def set_fetch_mode(self, mode):
+        """Velg hvordan bildedeler hentes: "serial" (én og én), "page" (parallelt
+        per side) eller "book" (én felles kø for alle bildedeler i boken)."""
+        if mode not in FETCH_MODES:
+            raise ValueError(f"Ukjent modus: {mode} (gyldige: {', '.join(FETCH_MODES)})")
+        self.fetch_mode = mode
+
+    def set_max_workers(self, workers):
+        """Antall sider (eller bildedeler i "book"-modus) som lastes samtidig."""
+        self.max_workers = max(1, int(workers))
+
+    def set_adaptive(self, enabled=True, initial=4):
+        """Juster antall samtidige forespørsler etter responstid og 429/503.
+
+        Grensen vokser fra initial opp mot max_workers, så "book"-modus gir
+        mest spillerom; sett max_workers før denne kalles.
+        """
+        if not enabled:
+            self.controller = None
+            return
+        self.controller = ConcurrencyController(
+            initial=initial,
+            maximum=self.max_workers,
+            report=self._report_concurrency,
+        )
+
+    def set_cpu_workers(self, workers):
+        """Antall prosesser som dekoder, setter sammen og lagrer sidene.
+
+        Med 0 (standard) gjøres dette i nedlastingstrådene, der det deler
+        GIL med hentingen. Ellers samler trådene bare bytes for bildedelene,
+        og en ferdig side sendes til en CpuStage med så mange prosesser.
+        """
+        self.cpu_workers = max(0, int(workers))
+
+    def set_controller(self, controller):
+        """Bruk en ConcurrencyController delt med andre bøker (eller None).
+
+        Da gjelder grensen for forespørsler i luften for alle bøkene samlet.
+        """
+        self.controller = controller
+
+    def concurrency(self):
+        """Høyeste antall forespørsler nedlastingen kan ha i luften."""
+        if self.controller is not None:
+            return self.controller.maximum
+        if self.fetch_mode == "page":
+            return self.max_workers * self.tile_workers
+        return self.max_workers
+
+    def _report_concurrency(self, limit, reason):
+        if self.verbose:
+            self.log(f"{' '*5}Samtidige forespørsler: {limit} ({reason})")
+
+    def set_tile_cache(self, cache):
+        """Bruk en TileCache (eller None) for bildedeler."""
+        self.tile_cache = cache
+
+    def set_retry_policy(self, policy):
+        """Bytt ut RetryPolicy, f.eks. for andre grenser for nye forsøk."""
+        self.retry_policy = policy
+
+    def set_tile_workers(self, workers):
+        """Maks antall samtidige forespørsler per side i "page"-modus."""
+        self.tile_workers = max(1, int(workers))
+
     def set_tile_sizes(self, width, height):
         self.tile_width = width
         self.tile_height = height
+        self.tile_size_source = "set"
+
+    def set_tile_probe(self, flag=True):
+        """Finn største bildedel serveren godtar (standard), eller bruk faste størrelser."""
+        self.probe_tiles = bool(flag)
+
+    def tile_class(self):
+        """Nøkkel for lagrede bildedelstørrelser: medietype og tilgang."""
+        return tile_class(self.media_type, self.tilgang)
+
+    def _ensure_tile_size(self, side):
+        """Velger bildedelstørrelse før første side: lagret, prøvd ut eller standard."""
+        if self.tile_size_source is not None:
+            return
+        with self.tile_size_lock:
+            if self.tile_size_source is not None:
+                return
+            size, source = None, "default"
+            if self.probe_tiles:
+                size = load_tile_sizes().get(self.tile_class())
+                source = "cache"
+                if size is None:
+                    size, conclusive = self.probe_tile_size(side)
+                    source = "probe"
+                    if size is not None and conclusive:
+                        save_tile_size(self.tile_class(), size)
+            if size is None:
+                size, source = default_tile_size(self.media_type, self.tilgang), "default"
+            self.tile_width = self.tile_height = int(size)
+            self.tile_size_source = source
+            if self.verbose:
+                self.log(f"{' '*5}Bildedeler: {size}x{size} ({source})")
+
+    def probe_tile_size(self, side):
+        """Finner største bildedel serveren godtar, med siden som prøve.
+
+        info.json gir maxWidth og serverens egen flisstørrelse der de finnes;
+        deretter prøves størrelsene fra den største og nedover til serveren
+        svarer 200. Bare statuslinjen leses, ikke bildet. Gir (størrelse
+        eller None om serveren ikke svarte, om svaret gjelder hele klassen);
+        en side mindre enn bildedelen sier bare noe om seg selv.
+        """
+        base = self.page_url[side]
+        width, height = self.page_data[side]
+        floor = default_tile_size(self.media_type, self.tilgang)
+        limit = None
+        candidates = set(TILE_SIZE_CANDIDATES)
+        try:
+            response = self.session.get(f"{base}/info.json", timeout=10)
+            response.raise_for_status()
+            info = response.json()
+            limit = info.get("maxWidth")
+            for tiles in info.get("tiles") or []:
+                if tiles.get("width"):
+                    candidates.add(int(tiles["width"]))
+        except (RequestException, ValueError, AttributeError, TypeError):
+            pass
+        candidates = sorted(
+            (size for size in candidates if size >= floor and (limit is None or size <= limit)),
+            reverse=True,
+        )
+        tried = set()
+        for size in candidates:
+            region = (min(size, width), min(size, height))
+            if region in tried:
+                continue
+            tried.add(region)
+            url = f"{base}/0,0,{region[0]},{region[1]}/full/0/native.jpg"
+            try:
+                response = self.session.get(url, stream=True, timeout=10)
+                status = response.status_code
+                response.close()
+            except RequestException:
+                return None, False
+            if status == 200:
+                if max(region) < size:
+                    # a page smaller than the tile only proves its own size
+                    return max(max(region), floor), False
+                return size, True
+            if status != 403:
+                return None, False
+        # every larger size was refused; the default is known to work
+        return floor, True
 
     def _extract_label_text(self, label):
         if isinstance(label, str):
@@ -128,23 +375,17 @@ class Book:
         self.find_existing_files()
 
     def load_cookie(self, file_path):
-        with open(file_path) as f:
-            for line in f:
-                if "=" in line:
-                    key, value = map(str.strip, line.split("=", 1))
-                    if key in ["authorization", "cookie"]:
-                        self.session.headers[key] = value
+        load_cookie(self.session, file_path)
         if self.verbose:
-            print(self.session.headers)
+            self.log(self.session.headers)
 
     def find_existing_files(self):
-        filelist = []
-        filelist.extend(glob(os.path.join(f"{self.folder_path}*.jpg")))
-        if filelist:
-            for file in filelist:
-                self.existing_images.extend(
-                    [file.split(".jpg")[0].split(os.path.sep)[2]]
-                )
+        # finished pages live in sources/ in webapp mode
+        if self.cli_mode:
+            sources = self.folder_path
+        else:
+            sources = os.path.join(self.folder_path, 'sources')
+        self.existing_images = list(page_files(sources))
 
     def set_resize(self, size):
         self.resize = int(size) / 100
@@ -163,15 +404,108 @@ class Book:
                 pages.append(page)
         self.page_names = pages
 
-    def get_manifest(self):
-        manifest_url = f"{self.api_url}_{self.media_type}_{self.media_id}/manifest"
+    def _read_manifest_copy(self):
+        try:
+            with open(os.path.join(self.meta_dir, MANIFEST_FILE), encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # a copy from disk has to be revalidated before it counts as fresh
+        record["checked"] = None
+        return record
+
+    def _save_manifest_copy(self):
+        record = self._manifest_record
+        if record is None or not os.path.isdir(self.meta_dir):
+            return
+        stored = {key: record.get(key) for key in ("url", "etag", "last_modified", "manifest")}
+        path = os.path.join(self.meta_dir, MANIFEST_FILE)
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(stored, f)
+            os.replace(path + ".tmp", path)
+        except OSError as error:
+            if self.print_error:
+                self.log(error)
+
+    def _load_manifest(self, manifest_url):
+        """Henter manifestet fra minnet, fra metadata/ eller fra nettet.
+
+        Gir en post med manifest og ETag/Last-Modified, eller None.
+        """
+        now = time.monotonic()
+        record = cached_manifest(manifest_url)
+        if record is not None and (
+            self.offline
+            or (record["checked"] is not None and now - record["checked"] < MANIFEST_TTL)
+        ):
+            return record
+        if record is None:
+            record = self._read_manifest_copy()
+        if self.offline:
+            if record is None:
+                self.log(f"Fant ikke lagret manifest for {self.digimedie}.")
+                return None
+            cache_manifest(manifest_url, record)
+            return record
+        headers = {}
+        if record is not None:
+            if record.get("etag"):
+                headers["If-None-Match"] = record["etag"]
+            if record.get("last_modified"):
+                headers["If-Modified-Since"] = record["last_modified"]
         try:
-            response = self.session.get(manifest_url)
+            response = self.session.get(manifest_url, headers=headers)
             response.raise_for_status()
-            json_data = response.json()
+            if response.status_code == 304 and record is not None:
+                record = dict(record, checked=now)
+            else:
+                record = {
+                    "url": manifest_url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "manifest": response.json(),
+                    "checked": now,
+                }
+                self._manifest_record = record
+                self._save_manifest_copy()
         except RequestException as error:
-            print(error)
+            self.log(error)
+            # a stale copy is still better than no page list at all
+            return record
+        cache_manifest(manifest_url, record)
+        return record
+
+    def _manifest_fields(self):
+        return {
+            "raw_metadata": self.raw_metadata,
+            "manifest_thumbnail": self.manifest_thumbnail,
+            "tilgang": self.tilgang,
+            "title": self.title,
+            "page_names": list(self.page_names),
+            "page_data": dict(self.page_data),
+            "page_url": dict(self.page_url),
+        }
+
+    def get_manifest(self):
+        manifest_url = f"{self.api_url}_{self.media_type}_{self.media_id}/manifest"
+        record = self._load_manifest(manifest_url)
+        if record is None:
             return
+        self._manifest_record = record
+        parsed = record.get("parsed")
+        if parsed is None:
+            self._parse_manifest(record["manifest"])
+            record["parsed"] = self._manifest_fields()
+        else:
+            # same manifest already parsed by another Book; copy, don't share
+            for key, value in parsed.items():
+                if isinstance(value, (list, dict)):
+                    value = value.copy()
+                setattr(self, key, value)
+        self.num_pages = len(self.page_names)
+
+    def _parse_manifest(self, json_data):
         # retain raw metadata for preview
         self.raw_metadata = json_data.get('metadata', [])
         # grab manifest-level thumbnail if provided
@@ -225,35 +559,63 @@ class Book:
         self.page_names = sorted(self.page_names)
         self.num_pages = len(self.page_names)
 
-    def fetch_new_image_url(self, side, column, row):
-        # compute region to request, clamped to page bounds to avoid oversize requests
+    def output_size(self, side):
+        """Størrelsen siden lagres i: manifestets mål, skalert med resize."""
+        width, height = self.page_data[side]
+        if self.resize == 0:
+            return width, height
+        return int(self.resize * width), int(self.resize * height)
+
+    def tile_box(self, side, column, row):
+        """Gir regionen (x, y, b, h) i originalen og plassen (x, y, b, h) på
+        den lagrede siden for en bildedel.
+
+        Kantene skaleres hver for seg og avrundes, så bildedelene dekker den
+        skalerte siden nøyaktig, uten glipper eller overlapp.
+        """
         orig_w, orig_h = self.page_data[side]
+        out_w, out_h = self.output_size(side)
         x = int(column) * self.tile_width
         y = int(row) * self.tile_height
         # clamp width/height for last tiles so as not to exceed page dimensions
         region_w = min(self.tile_width, orig_w - x)
         region_h = min(self.tile_height, orig_h - y)
+        left = (x * out_w + orig_w // 2) // orig_w
+        right = ((x + region_w) * out_w + orig_w // 2) // orig_w
+        top = (y * out_h + orig_h // 2) // orig_h
+        bottom = ((y + region_h) * out_h + orig_h // 2) // orig_h
+        return (x, y, region_w, region_h), (left, top, right - left, bottom - top)
+
+    def server_scales(self):
+        """Sant når serveren skalerer bildedelene ned; forstørring gjøres lokalt."""
+        return 0 < self.resize < 1
+
+    def fetched_tile_size(self, side, column, row):
+        """(b, h) en hentet bildedel har: plassen på siden eller hele regionen."""
+        region, box = self.tile_box(side, column, row)
+        return tuple(box[2:]) if self.server_scales() else tuple(region[2:])
+
+    def fetch_new_image_url(self, side, column, row):
+        # compute region to request, clamped to page bounds to avoid oversize requests
+        (x, y, region_w, region_h), (_, _, out_w, out_h) = self.tile_box(side, column, row)
+        # when shrinking, the server scales each region to its exact size on
+        # the saved page, so only the pixels we keep are sent; upscaling is
+        # optional in IIIF (sizeAboveFull), so those tiles come in full size
+        # and are scaled when pasted
+        size = f"{out_w},{out_h}" if self.server_scales() else "full"
         image_url = (
             f"{self.page_url[side]}/"
             f"{x},{y},{region_w},{region_h}"
-            f"/full/0/native.jpg"
+            f"/{size}/0/native.jpg"
         )
         if self.print_url:
-            print(f"Side: {side}, Col: {column}, Row: {row}")
-            print(image_url)
+            self.log(f"Side: {side}, Col: {column}, Row: {row}")
+            self.log(image_url)
         return image_url
 
     def update_column_row(self, side):
         column_number, row_number = 0, 0
-        # use smaller tile sizes for resources to avoid access restrictions
-        if self.tilgang and "tilgjengelig etter bestemte vilkår" in self.tilgang.lower():
-            self.set_tile_sizes(200,200)
-        elif self.media_type.startswith("plikt"):
-            self.set_tile_sizes(300, 300)
-        elif self.media_type in ("digibok", "digitidsskrift"):
-            self.set_tile_sizes(1024, 1024)
-        else:
-            self.set_tile_sizes(4096, 4096)
+        self._ensure_tile_size(side)
         column_number = ceil(self.page_data[side][0] / self.tile_width) - 1
         row_number = ceil(self.page_data[side][1] / self.tile_height) - 1
         return (int(column_number), int(row_number))
@@ -263,6 +625,124 @@ class Book:
         self.covers = True
         self.include_cover = True
 
+    def set_output(self, fmt="jpeg", quality=None, progressive=False, optimize=False):
+        """Velg hvordan sidene lagres: "jpeg", "webp", "png", "tiff" eller "tiles".
+
+        quality (1-100) gjelder JPEG og WebP; uten den brukes Pillow sin
+        standard. progressive gjelder JPEG, og optimize gir mindre JPEG/PNG
+        og tregere WebP-koding. PNG og TIFF er tapsfrie. "tiles" lagrer
+        bildedelene slik de kom fra serveren, uten ny koding, og PDF lages
+        da av dem (se make_tile_pdf).
+        """
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError(f"Ukjent format: {fmt} (gyldige: {', '.join(OUTPUT_FORMATS)})")
+        if quality is not None and not 1 <= int(quality) <= 100:
+            raise ValueError(f"Kvalitet må være mellom 1 og 100: {quality}")
+        self.output_format = fmt
+        self.save_options = save_options(fmt, quality, progressive, optimize)
+        if fmt == "tiles":
+            self.keep_tiles = True
+
+    def page_path(self, page_number):
+        """Stien en side lagres til i valgt format."""
+        return os.path.join(self.sources_dir, page_number + OUTPUT_FORMATS[self.output_format][0])
+
+    def page_file(self, page_number):
+        """Filnavnet til en side, for meldinger."""
+        return os.path.basename(self.page_path(page_number))
+
+    def set_keep_tiles(self, flag=True):
+        """Ta vare på bildedelene som de kom fra serveren, i tiles/<side>/."""
+        self.keep_tiles = bool(flag)
+
+    def set_tile_pdf(self, flag=True):
+        """Bygg PDF av bildedelene mens de lastes ned, uten å dekode dem."""
+        self.live_tile_pdf = bool(flag)
+        if flag:
+            self.keep_tiles = True
+
+    def set_resume(self, flag=True):
+        """Før journal over hentede bildedeler, så en avbrutt nedlasting
+        fortsetter midt i en side i stedet for å starte siden på nytt."""
+        self.resume = bool(flag)
+
+    def add_page_hook(self, hook):
+        """Kall hook(side, sti) hver gang en side er lagret, f.eks. for OCR."""
+        self.add_event_sink(
+            lambda event: hook(event["page"], event["path"]), types=("page_finished",)
+        )
+
+    def add_event_sink(self, sink, types=None):
+        """Send hendelser til sink(hendelse), f.eks. en QueueSink eller JsonLinesSink.
+
+        En hendelse er en dict med "type", "book" og "time", og ellers:
+
+          log               msg
+          download_started  pages, skipped
+          page_started      page
+          tile_fetched      page, column, row, bytes, cached, seconds
+          tile_failed       page, column, row, status, seconds
+          page_finished     page, path, bytes, stitch_seconds, encode_seconds
+          progress          done, total
+          retry             page, attempt, missing, delay
+          page_failed       page, missing, tiles, retries
+          error             status, msg
+          download_finished success, failed
+          pdf_progress      done, total, path
+          pdf_finished      path, pages, seconds
+
+        types begrenser hvilke typer sink får. sink kalles fra
+        nedlastingstrådene og må tåle det.
+        """
+        self.event_sinks.append((sink, None if types is None else frozenset(types)))
+
+    def set_quiet(self, flag=True):
+        """Ikke skriv noe til terminalen; meldinger går bare ut som "log"-hendelser."""
+        self.quiet = bool(flag)
+
+    def emit(self, kind, **data):
+        """Sender en hendelse til alle sinks som abonnerer på typen."""
+        if not self.event_sinks:
+            return
+        event = {"type": kind, "book": self.digimedie, "time": time.time(), **data}
+        for sink, types in self.event_sinks:
+            if types is not None and kind not in types:
+                continue
+            try:
+                sink(event)
+            except Exception as error:
+                # a broken listener must not take the download down with it
+                if not self.quiet:
+                    print(f"Feil i hendelsesmottaker: {error}")
+
+    def log(self, msg):
+        """Skriver en melding og sender den som "log"-hendelse."""
+        msg = str(msg)
+        if not self.quiet:
+            print(msg)
+        self.emit("log", msg=msg)
+
+    def set_profile(self, flag=True):
+        """Mål vegg- og CPU-tid per steg og side (se Profiler og write_profile)."""
+        self.profiler = Profiler() if flag else None
+
+    def span(self, stage, page=None):
+        """Måler en blokk som steget stage når profilering er på."""
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.span(stage, page)
+
+    def write_profile(self, path=None):
+        """Skriver Chrome-trace til path (standard: nbno_profile.json i
+        metadata-mappen) og gir sammendraget som tekst."""
+        if self.profiler is None:
+            return ""
+        if path is None:
+            path = os.path.join(self.meta_dir, "nbno_profile.json")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.profiler.write_trace(path)
+        return self.profiler.summary() + f"\nTrace: {path}"
+
     def set_include_cover(self, flag=True):
         """If True, put C1.jpg as first page in generated PDF."""
         self.include_cover = bool(flag)
@@ -272,6 +752,8 @@ class Book:
         os.makedirs(self.sources_dir, exist_ok=True)
         os.makedirs(self.meta_dir, exist_ok=True)
         os.makedirs(self.pdf_dir, exist_ok=True)
+        # keep the manifest next to the book so later runs can work offline
+        self._save_manifest_copy()
         # record original ID and title metadata for UI gallery
         # write metadata for gallery
         # write metadata for gallery UI only in webapp mode
@@ -298,6 +780,7 @@ class Book:
             except Exception:
                 pass
         self.download_skipped = False
+        self.failed_pages = {}
         imagelist = self.page_names
         if self.covers:
             # order covers same as GUI/web PDF: C1, I1, numbered pages, I3, C2, C3
@@ -318,276 +801,2340 @@ class Book:
                 if image in imagelist:
                     counter += 1
                     imagelist.remove(image)
-            print(f"{' '*5}Hopper over {counter} eksisterende sider.")
+            self.log(f"{' '*5}Hopper over {counter} eksisterende sider.")
+        self.emit(
+            "download_started", pages=len(imagelist), skipped=len(self.existing_images)
+        )
         if len(imagelist) == 0:
             if self.existing_images:
-                print(f"{' '*5}Alle bildene finnes allerede lokalt; hopper over nedlasting.")
+                self.log(f"{' '*5}Alle bildene finnes allerede lokalt; hopper over nedlasting.")
                 self.download_skipped = True
+                self.emit("download_finished", success=True, failed=[])
                 return True
+            self.emit("download_finished", success=False, failed=[])
             return False
         else:
-            with cf.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                future_download = {
-                    executor.submit(self.download_page, page): page
-                    for page in imagelist
-                }
-                progress = 0
-                print("")
-                for future in cf.as_completed(future_download):
-                    download = future.result()
+            if self.live_tile_pdf:
+                self.tile_pdf = TilePdfBuilder(self._pdf_path())
+            if self.resume:
+                self.journal = TileJournal(os.path.join(self.meta_dir, JOURNAL_FILE))
+            # one pooled connection per request in flight, or they reconnect
+            http_pool.grow(self.concurrency())
+            if self.fetch_mode == "book":
+                results = TileScheduler(self, imagelist, self.max_workers).run()
+            else:
+                results = self._page_results(imagelist)
+            progress = 0
+            success = True
+            self.log("")
+            try:
+                for page, download in results:
+                    if download == (False, PAGE_FAILED):
+                        # already reported; the other pages carry on
+                        continue
                     if not download[0]:
                         if download[1] == 403:
-                            print(f"HTTP 403 Forbidden: Får ikke tilgang til boken.")
-                            print(f"Fra nb.nb   -   {self.tilgang}.")
-                        elif download[1] == 408:
-                            print(f"Connection Timeout ved forsøk på å laste sider.")
-                        executor.shutdown(wait=False, cancel_futures=True)
+                            self.log(f"HTTP 403 Forbidden: Får ikke tilgang til boken.")
+                            self.log(f"Fra nb.nb   -   {self.tilgang}.")
+                            if self.tile_size_source in ("probe", "cache"):
+                                # maybe the tiles are too large; probe again next time
+                                save_tile_size(self.tile_class(), None)
+                            self.emit("error", status=403, msg="Forbidden")
+                        else:
+                            self.emit("error", status=download[1], msg=f"Side {page} er tom")
+                        success = False
                         break
                     else:
                         progress += 1
-                        if not self.verbose:
+                        self.emit("progress", done=progress, total=len(imagelist))
+                        if not self.verbose and not self.quiet:
                             print(
                                 f"{' ' * 5}Lagrer side {progress} av {len(imagelist)}.",
                                 end="\r",
                             )
+            finally:
+                results.close()
             if self.verbose:
-                print(f"\n{' '*5}Lagrer side {progress} av {len(imagelist)}.")
-            return download[0]
+                self.log(f"\n{' '*5}Lagrer side {progress} av {len(imagelist)}.")
+                self.log(f"{' '*5}{http_pool.describe()}")
+                stats = self.retry_policy.stats()
+                if stats["retries"]:
+                    self.log(
+                        f"{' '*5}Nye forsøk: {stats['retries']} bildedeler i "
+                        f"{stats['rounds']} runder, {stats['wait']:.1f}s ventetid."
+                    )
+            if self.failed_pages:
+                self.log(
+                    f"\n{' '*5}Kunne ikke laste ned {len(self.failed_pages)} sider: "
+                    f"{', '.join(sorted(self.failed_pages))}"
+                )
+            if self.tile_pdf is not None:
+                self._finish_tile_pdf(success)
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            self.emit("download_finished", success=success, failed=sorted(self.failed_pages))
+            return success
 
-    def download_page(self, page_number):
-        """Laster ned og setter sammen bildedeler for side av boken"""
-        max_column, max_row = self.update_column_row(page_number)
-        image_parts = []
-        max_width, max_height = 0, 0
-        row_counter, column_counter = 0, 0
-        row_number = 0
+    def _pdf_path(self):
+        return os.path.join(self.pdf_dir, f"{self.folder_name}.pdf")
+
+    def _stored_tile_pages(self):
+        """Sider med lagrede bildedeler som også er lagret ferdig i sources/."""
+        try:
+            names = os.listdir(self.tiles_dir)
+        except OSError:
+            return []
+        saved = page_files(self.sources_dir)
+        return [
+            name for name in names
+            if os.path.isdir(os.path.join(self.tiles_dir, name)) and name in saved
+        ]
+
+    def _finish_tile_pdf(self, success):
+        started = time.monotonic()
+        builder, self.tile_pdf = self.tile_pdf, None
+        if not success:
+            builder.abort()
+            return
+        with self.span("pdf"):
+            # pages saved by an earlier run come from the tile store instead
+            for page in self._stored_tile_pages():
+                if not builder.has_page(page) and not builder.add_stored_page(
+                    page, os.path.join(self.tiles_dir, page), self.output_size(page)
+                ):
+                    self.log(f"Bildedeler mangler for side {page}; den er ikke med i PDF-en.")
+            pages = builder.close(order_pages(builder.page_names(), self.include_cover))
+        self.log(f"PDF created: {self._pdf_path()} ({pages} sider)")
+        self.emit(
+            "pdf_finished", path=self._pdf_path(), pages=pages,
+            seconds=time.monotonic() - started,
+        )
+
+    def make_tile_pdf(self):
+        """Lager PDF av bildedelene i tiles/ uten å dekode eller omkode dem."""
+        pages = order_pages(self._stored_tile_pages(), self.include_cover)
+        if not pages:
+            self.log("No tiles found to build PDF.")
+            return False
+        os.makedirs(self.pdf_dir, exist_ok=True)
+        started = time.monotonic()
+        builder = TilePdfBuilder(self._pdf_path())
+        try:
+            for done, page in enumerate(pages, 1):
+                with self.span("pdf_read", page):
+                    if not builder.add_stored_page(
+                        page, os.path.join(self.tiles_dir, page), self.output_size(page)
+                    ):
+                        self.log(f"Bildedeler mangler for side {page}; den er ikke med i PDF-en.")
+                self.emit("pdf_progress", done=done, total=len(pages), path=page)
+        except Exception as e:
+            builder.abort()
+            self.log(f"Error creating PDF: {e}")
+            return False
+        if not builder.page_names():
+            builder.abort()
+            self.log("No tiles found to build PDF.")
+            return False
+        written = builder.close(pages)
+        self.log(f"PDF created: {self._pdf_path()}")
+        self.emit(
+            "pdf_finished", path=self._pdf_path(), pages=written,
+            seconds=time.monotonic() - started,
+        )
+        return True
+
+    def _store_tile(self, page_number, column, row, content):
+        page_dir = os.path.join(self.tiles_dir, page_number)
+        os.makedirs(page_dir, exist_ok=True)
+        path = os.path.join(page_dir, f"{column}_{row}.jpg")
+        with open(path + ".tmp", "wb") as f:
+            f.write(content)
+        os.replace(path + ".tmp", path)
+        return path
+
+    def _fetch_tile(self, page_number, column, row):
+        """Henter én bildedel; returnerer (status, bytes eller None)."""
+        url = self.fetch_new_image_url(page_number, column, row)
+        if self.tile_cache is not None:
+            with self.span("cache", page_number):
+                cached = self.tile_cache.get(url)
+            if cached is not None:
+                self.emit(
+                    "tile_fetched", page=page_number, column=column, row=row,
+                    bytes=len(cached), cached=True, seconds=0.0,
+                )
+                return 200, cached
+        if self.controller is not None:
+            with self.span("throttle", page_number):
+                self.controller.acquire()
+        started = time.monotonic()
+        status = 200
+        try:
+            with self.span("fetch", page_number):
+                response = self.session.get(url, timeout=10)
+            response.raise_for_status()
+        except RequestException as error:
+            if self.print_error:
+                self.log(error)
+            if error.response is None:
+                status = 408
+            else:
+                status = error.response.status_code
+            self.emit(
+                "tile_failed", page=page_number, column=column, row=row,
+                status=status, seconds=time.monotonic() - started,
+            )
+            return status, None
+        finally:
+            if self.controller is not None:
+                self.controller.release(time.monotonic() - started, status)
+        # a truncated JPEG lacks its end-of-image marker; never cache those
+        if self.tile_cache is not None and response.content.endswith(b"\xff\xd9"):
+            self.tile_cache.put(url, response.content)
+        self.emit(
+            "tile_fetched", page=page_number, column=column, row=row,
+            bytes=len(response.content), cached=False,
+            seconds=time.monotonic() - started,
+        )
+        return 200, response.content
+
+    def _fetch_tiles(self, page_number, canvas):
+        """Henter manglende bildedeler for en side rett inn i canvas.
+
+        Returnerer (antall bildedeler hentet, 403 om tilgang ble nektet, ellers 0).
+        """
+        positions = canvas.pending()
+        fetched = 0
+        if self.fetch_mode == "serial" or len(positions) < 2:
+            for column, row in positions:
+                status, content = self._fetch_tile(page_number, column, row)
+                if status == 403:
+                    return fetched, status
+                if content is not None:
+                    fetched += 1
+                    self._paste_tile(page_number, canvas, column, row, content)
+            return fetched, 0
+        # fetch every region of the page at once, bounded by tile_workers
         HTTPerror = 0
-        while row_number <= max_row:
-            column_number = 0
-            while column_number <= max_column:
-                url = self.fetch_new_image_url(
-                    page_number, column_number, row_number)
+        workers = min(self.tile_workers, len(positions))
+        executor = cf.ThreadPoolExecutor(max_workers=workers)
+        try:
+            future_tile = {
+                executor.submit(self._fetch_tile, page_number, column, row): (column, row)
+                for column, row in positions
+            }
+            for future in cf.as_completed(future_tile):
+                status, content = future.result()
+                if status == 403:
+                    HTTPerror = status
+                    break
+                if content is not None:
+                    fetched += 1
+                    self._paste_tile(page_number, canvas, *future_tile[future], content)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        return fetched, HTTPerror
+
+    def _paste_tile(self, page_number, canvas, column, row, content, restored=False):
+        try:
+            canvas.paste(column, row, content)
+        except IOError as error:
+            # left pending in the canvas, so it is fetched again
+            if self.print_error:
+                self.log(error)
+            return
+        if not restored and (self.keep_tiles or self.journal is not None):
+            path = self._store_tile(page_number, column, row, content)
+            if self.journal is not None:
+                self.journal.record(page_number, column, row, path)
+        if self.tile_pdf is not None:
+            self.tile_pdf.add_tile(page_number, *canvas.boxes[(column, row)], content)
+
+    def page_positions(self, page_number):
+        """Alle (kolonne, rad) for bildedelene til en side, i rad-rekkefølge."""
+        return list(self.page_boxes(page_number))
+
+    def page_boxes(self, page_number):
+        """{(kolonne, rad): plass på den lagrede siden} i rad-rekkefølge.
+
+        Med kraftig nedskalering kan en smal kantbit bli null punkter bred;
+        den hentes ikke.
+        """
+        max_column, max_row = self.update_column_row(page_number)
+        boxes = {}
+        for row in range(max_row + 1):
+            for column in range(max_column + 1):
+                box = self.tile_box(page_number, column, row)[1]
+                if box[2] > 0 and box[3] > 0:
+                    boxes[(column, row)] = box
+        return boxes
+
+    def new_canvas(self, page_number):
+        """Lerret i sidens lagrede størrelse, med bildedeler fra journalen limt inn."""
+        canvas = PageCanvas(
+            self.output_size(page_number), self.page_boxes(page_number),
+            profiler=self.profiler, page=page_number,
+            # tiles kept as-is are never decoded at all
+            defer=self.cpu_workers > 0 or self.output_format == "tiles",
+        )
+        if self.journal is not None:
+            for (column, row), path in self.journal.tiles_for(page_number).items():
+                if (column, row) not in canvas.missing:
+                    continue
                 try:
-                    response = self.session.get(url, timeout=10)
-                    response.raise_for_status()
-                except RequestException as error:
-                    try:
-                        response
-                    except:
-                        HTTPerror = 408
-                        break
-                    else:
-                        if response.status_code == 403:
-                            HTTPerror = 403
-                            break
-                    if self.print_error:
-                        print(error)
-                else:
-                    try:
-                        img = Image.open(io.BytesIO(response.content))
-                        with self.image_lock:
-                            image_parts.append(img)
-                        if row_number == 0:
-                            max_width += img.size[0]
-                            column_counter += 1
-                        if column_number == 0:
-                            max_height += img.size[1]
-                            row_counter += 1
-                    except IOError as error:
-                        if self.print_error:
-                            print(error)
-                column_number += 1
-            row_number += 1
-            if HTTPerror != 0:
-                break
-        if HTTPerror == 403:
-            return False, 403
-        elif HTTPerror == 408:
-            return False, 408
-        elif not len(image_parts):
-            return False, 200
-        else:
-            if len(image_parts) == (column_number * row_number):
-                part_width, part_height = image_parts[0].size
-                full_page = Image.new("RGB", (max_width, max_height))
-                row_number = 0
-                part_counter = 0
-                row_counter = row_counter - 1
-                column_counter = column_counter - 1
-                while row_number <= row_counter:
-                    column_number = 0
-                    while column_number <= column_counter:
-                        full_page.paste(
-                            image_parts[part_counter],
-                            ((column_number * part_width),
-                             (row_number * part_height)),
-                        )
-                        part_counter += 1
-                        column_number += 1
-                    row_number += 1
-                if self.resize != 0:
-                    full_page = full_page.resize(
-                        [int(self.resize * s) for s in full_page.size]
+                    with open(path, "rb") as f:
+                        content = f.read()
+                    size = jpeg_info(content)[:2]
+                except (OSError, ValueError):
+                    continue
+                if size != self.fetched_tile_size(page_number, column, row):
+                    # stored with another tile size or --resize; fetch it again
+                    continue
+                self._paste_tile(page_number, canvas, column, row, content, restored=True)
+        return canvas
+
+    def _page_format(self, page_number, size):
+        """(sti, Pillow-format, save()-valg) en side i størrelse size lagres med."""
+        if self.output_format == "webp" and max(size) > WEBP_MAX_SIZE:
+            self.log(
+                f"Side {page_number} er {size[0]}x{size[1]} punkter, større enn WebP "
+                f"tillater ({WEBP_MAX_SIZE}); lagres som JPEG."
+            )
+            options = save_options("jpeg", self.save_options.get("quality"))
+            return os.path.join(self.sources_dir, page_number + ".jpg"), "JPEG", options
+        return self.page_path(page_number), OUTPUT_FORMATS[self.output_format][1], self.save_options
+
+    def _save_page(self, page_number, canvas):
+        """Lagrer en ferdig sammensatt side."""
+        # tiles already arrive scaled to the output size (see tile_box)
+        page_path, fmt, options = self._page_format(page_number, canvas.size)
+        if fmt is None:
+            # the tiles themselves are the page (stored by _paste_tile)
+            with open(page_path, "w", encoding="utf-8") as f:
+                json.dump({"size": list(canvas.size)}, f)
+            stitch_seconds = encode_seconds = 0.0
+        elif canvas.tiles is not None:
+            try:
+                with self.span("cpu_stage", page_number):
+                    stitch_seconds, encode_seconds = cpu_stage(self.cpu_workers).save_page(
+                        page_path, canvas.size, canvas.boxes, canvas.tiles,
+                        fmt, options,
                     )
-                full_page.save(os.path.join(self.sources_dir, f"{page_number}.jpg"))
-                if self.verbose:
-                    print(f"{' '*5}Lagret side {page_number}.jpg")
-                return True, 200
+            except Exception as error:
+                # a tile that looked whole but would not decode, or a dead worker
+                self.log(f"Feilet å sette sammen side {os.path.basename(page_path)}: {error}")
+                return self._save_failed(page_number, canvas, page_path)
+        else:
+            stitch_seconds = canvas.paste_seconds
+            started = time.monotonic()
+            try:
+                with self.span("encode", page_number):
+                    canvas.image.save(page_path, fmt, **options)
+            except Exception as error:
+                # e.g. a full disk, or a size, mode or option the encoder refuses
+                self.log(f"Feilet å lagre side {os.path.basename(page_path)}: {error}")
+                return self._save_failed(page_number, canvas, page_path)
+            encode_seconds = time.monotonic() - started
+        if self.tile_pdf is not None:
+            self.tile_pdf.finish_page(page_number, canvas.size)
+        if self.journal is not None:
+            self.journal.finish(page_number, remove_tiles=not self.keep_tiles)
+        canvas.close()
+        self.emit(
+            "page_finished", page=page_number, path=page_path,
+            bytes=os.path.getsize(page_path),
+            stitch_seconds=stitch_seconds, encode_seconds=encode_seconds,
+        )
+        if self.verbose:
+            if self.controller is not None:
+                self.log(
+                    f"{' '*5}Lagret side {os.path.basename(page_path)} "
+                    f"(samtidige forespørsler: {self.controller.current()})"
+                )
             else:
-                if page_number in ["I3", "I1", "C3", "C2", "C1"]:
-                    print(f"Feilet å laste ned side {page_number}.jpg - hopper over.")
-                    return True, 200
-                else:
-                    print(f"Feilet å laste ned side {page_number}.jpg - prøver igjen.")
-                    return self.download_page(page_number)
+                self.log(f"{' '*5}Lagret side {os.path.basename(page_path)}")
+        return True, 200
+
+    def _page_results(self, imagelist):
+        """Laster ned én side per tråd; gir (side, resultat) etter hvert som de blir ferdige."""
+        executor = cf.ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            future_download = {
+                executor.submit(self.download_page, page): page
+                for page in imagelist
+            }
+            for future in cf.as_completed(future_download):
+                yield future_download[future], future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def download_page(self, page_number, canvas=None):
+        """Laster ned og setter sammen bildedeler for side av boken"""
+        if canvas is None:
+            self.emit("page_started", page=page_number)
+            with self.span("page", page_number):
+                return self.download_page(page_number, self.new_canvas(page_number))
+        fetched, HTTPerror = self._fetch_tiles(page_number, canvas)
+        if HTTPerror == 403:
+            canvas.close()
+            return False, 403
+        # tiles that timed out, were throttled or came back broken are left
+        # pending, and the page is retried like any other incomplete page
+        if canvas.complete():
+            return self._save_page(page_number, canvas)
+        if page_number in COVER_PAGES:
+            self.log(f"Feilet å laste ned side {self.page_file(page_number)} - hopper over.")
+            self._drop_page(page_number, canvas)
+            return True, 200
+        missing = canvas.pending()
+        if not self.retry_policy.allow(page_number, len(missing)):
+            return self._page_failed(page_number, canvas)
+        self.log(f"Feilet å laste ned side {self.page_file(page_number)} - prøver igjen.")
+        delay = self.retry_policy.backoff(page_number)
+        self.emit(
+            "retry", page=page_number, attempt=self.retry_policy.page_retries(page_number),
+            missing=len(missing), delay=delay,
+        )
+        with self.span("retry_wait", page_number):
+            time.sleep(delay)
+        # tiles already on the canvas are kept; only the missing ones are fetched
+        return self.download_page(page_number, canvas)
+
+    def _save_failed(self, page_number, canvas, page_path):
+        """Fjerner en halvskrevet side, så den ikke regnes som ferdig, og gir opp siden."""
+        try:
+            os.remove(page_path)
+        except OSError:
+            pass
+        return self._page_failed(page_number, canvas)
+
+    def _drop_page(self, page_number, canvas):
+        """Glemmer en side som ikke blir lagret, også i PDF-en som bygges."""
+        canvas.close()
+        if self.tile_pdf is not None:
+            self.tile_pdf.discard_page(page_number)
+
+    def _page_failed(self, page_number, canvas):
+        """Gir opp en side når forsøkene er brukt opp; gir (False, PAGE_FAILED)."""
+        missing = canvas.pending()
+        self._drop_page(page_number, canvas)
+        with self.image_lock:
+            self.failed_pages[page_number] = {
+                "missing": missing,
+                "tiles": len(canvas.positions),
+                "retries": self.retry_policy.page_retries(page_number),
+            }
+        self.log(
+            f"Feilet å laste ned side {self.page_file(page_number)} - gir opp etter "
+            f"{self.retry_policy.page_retries(page_number)} nye forsøk "
+            f"({len(missing)} av {len(canvas.positions)} bildedeler mangler)."
+        )
+        self.emit(
+            "page_failed", page=page_number, missing=len(missing),
+            tiles=len(canvas.positions), retries=self.retry_policy.page_retries(page_number),
+        )
+        return False, PAGE_FAILED
 
     def _attempt_redownload_page_for_pdf(self, path):
         page_name = os.path.splitext(os.path.basename(path))[0]
-        if page_name in self._pdf_redownload_attempts:
+        if page_name in self._pdf_redownload_attempts or page_name not in self.page_data:
             return False
         self._pdf_redownload_attempts.add(page_name)
         try:
             os.remove(path)
         except OSError:
             pass
-        print(
+        self.log(
             f"{' '*5}Korrupt bildefil oppdaget for {page_name} under PDF-generering; "
             "sletter og laster inn siden på nytt."
         )
         success, status = self.download_page(page_name)
         if not success:
-            print(
+            self.log(
                 f"Kunne ikke laste ned {page_name} på nytt (HTTP {status}); "
                 "PDF-generering avbrytes."
             )
         return success
 
-    def _open_pdf_image(self, path):
-        try:
-            return Image.open(path)
-        except (UnidentifiedImageError, IOError) as error:
-            if self.print_error:
-                print(error)
-            if self._attempt_redownload_page_for_pdf(path):
-                try:
-                    return Image.open(path)
-                except (UnidentifiedImageError, IOError) as second_error:
-                    if self.print_error:
-                        print(second_error)
-            return None
+    def _read_pdf_page(self, path):
+        """Leser en side for PDF; en ødelagt fil lastes ned på nytt én gang."""
+        for attempt in range(2):
+            try:
+                with self.span("pdf_read", os.path.splitext(os.path.basename(path))[0]):
+                    # other formats are re-encoded as JPEG for the PDF
+                    return read_jpeg_page(path, strict=path.endswith(".jpg"))
+            except (OSError, ValueError) as error:
+                if self.print_error:
+                    self.log(error)
+            if attempt or not self._attempt_redownload_page_for_pdf(path):
+                return None
+
+    def pdf_page_files(self):
+        """Sidebildene i sources/ i den rekkefølgen make_pdf legger dem."""
+        pages = page_files(self.sources_dir, images_only=True)
+        return [pages[name] for name in order_pages(list(pages), self.include_cover)]
 
     def make_pdf(self):
-        """Build a PDF from all downloaded JPGs in the folder."""
-        # filter out any warnings for large images
-        warnings.simplefilter("error", Image.DecompressionBombWarning)
-
-        # list all .jpg files in sources subdir (and optionally include cover first)
-        pattern = os.path.join(self.sources_dir, "*.jpg")
-        files = sorted(glob(pattern))
-        if self.include_cover:
-            # desired order: C1, I1, numbered pages, I3, C2, C3
-            basenames = [os.path.basename(f) for f in files]
-            lower = [b.lower() for b in basenames]
-            ordered = []
-            # front covers
-            for name in ('c1.jpg', 'i1.jpg'):
-                if name in lower:
-                    idx = lower.index(name)
-                    ordered.append(files[idx])
-            # numeric pages
-            for fpath, bname in zip(files, basenames):
-                if bname[:-4].isdigit():
-                    ordered.append(fpath)
-            # back covers
-            for name in ('i3.jpg', 'c2.jpg', 'c3.jpg'):
-                if name in lower:
-                    idx = lower.index(name)
-                    ordered.append(files[idx])
-            # append any remaining pages
-            for fpath in files:
-                if fpath not in ordered:
-                    ordered.append(fpath)
-            files = ordered
+        """Build a PDF from all downloaded page images in the folder."""
+        # list all page images in sources subdir (and optionally include cover first)
+        files = self.pdf_page_files()
         if not files:
-            print("No images found to build PDF.")
+            if self._stored_tile_pages():
+                # pages saved with --format tiles
+                return self.make_tile_pdf()
+            self.log("No images found to build PDF.")
             return False
+        if len(files) < len(page_files(self.sources_dir)):
+            self.log(
+                "Noen sider er lagret som bildedeler (--format tiles) og "
+                "kommer ikke med i PDF-en."
+            )
 
         # name PDF after the folder_name, not the original ID
-        # ensure PDF_DIR exists
         # ensure per-book pdf directory exists
         os.makedirs(self.pdf_dir, exist_ok=True)
         output_pdf = os.path.join(self.pdf_dir, f"{self.folder_name}.pdf")
-        # try efficient PDF assembly via img2pdf to reduce peak memory use
+        self._pdf_redownload_attempts.clear()
+        started = time.monotonic()
         try:
-            import img2pdf
-
-            with open(output_pdf, "wb") as f:
-                f.write(img2pdf.convert(files))
-            print(f"PDF created: {output_pdf}")
-            return True
-        except ImportError:
-            pass
+            with self.span("pdf"):
+                pages = build_jpeg_pdf(
+                    output_pdf, files, load=self._read_pdf_page,
+                    progress=lambda done, path: self.emit(
+                        "pdf_progress", done=done, total=len(files), path=path
+                    ),
+                )
         except Exception as e:
-            print(f"Error creating PDF via img2pdf: {e}")
-            print("Falling back to PIL for PDF creation.")
+            self.log(f"Error creating PDF: {e}")
+            return False
+        if not pages:
+            self.log("PDF-generering avbrutt.")
+            return False
+        self.log(f"PDF created: {output_pdf}")
+        self.emit(
+            "pdf_finished", path=output_pdf, pages=pages, seconds=time.monotonic() - started
+        )
+        return True
 
-        # fallback to PIL-based assembly (may use more memory)
-        self._pdf_redownload_attempts.clear()
+
+class QueueSink:
+    """Hendelsesmottaker som legger hendelsene i en queue.Queue."""
+
+    def __init__(self, events=None):
+        self.queue = events if events is not None else queue.Queue()
+
+    def __call__(self, event):
+        self.queue.put(event)
+
+
+class JsonLinesSink:
+    """Hendelsesmottaker som skriver én JSON-linje per hendelse.
+
+    Filen holdes åpen mellom hendelsene og tømmes etter hver linje, så den
+    kan følges med tail -f mens nedlastingen pågår.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Metrics:
+    """Tellere, målere og histogrammer i Prometheus sitt tekstformat.
+
+    Hver måling er et oppslag og en addisjon under en lås, så den er billig
+    nok til å gjøres for hver bildedel. Navn registreres med counter,
+    gauge eller histogram før de brukes; render gir teksten til /metrics.
+    """
+
+    DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.help = {}
+        self.buckets = {}
+        self.values = {}
+
+    def _register(self, kind, name, help_text, buckets=None):
+        with self.lock:
+            self.kinds.setdefault(name, kind)
+            self.help.setdefault(name, help_text)
+            self.values.setdefault(name, {})
+            if buckets is not None:
+                self.buckets.setdefault(name, tuple(buckets))
+
+    def counter(self, name, help_text):
+        self._register("counter", name, help_text)
+
+    def gauge(self, name, help_text):
+        self._register("gauge", name, help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._register("histogram", name, help_text, buckets)
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            values = self.values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[name][key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(labels)
+        buckets = self.buckets[name]
+        with self.lock:
+            entry = self.values[name].get(key)
+            if entry is None:
+                entry = self.values[name][key] = [[0] * len(buckets), 0, 0.0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        text = ",".join(
+            '{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        )
+        return "{" + text + "}"
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.kinds):
+                kind = self.kinds[name]
+                lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(self.values[name].items()):
+                    if kind != "histogram":
+                        lines.append(f"{name}{self._labels(key)} {value}")
+                        continue
+                    counts, count, total = value
+                    cumulative = 0
+                    for bound, n in zip(self.buckets[name], counts):
+                        cumulative += n
+                        lines.append(f"{name}_bucket{self._labels(key, [('le', repr(float(bound)))])} {cumulative}")
+                    lines.append(f"{name}_bucket{self._labels(key, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{self._labels(key)} {total}")
+                    lines.append(f"{name}_count{self._labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsSink:
+    """Hendelsesmottaker som oppdaterer et Metrics-register.
+
+    Etikettene (f.eks. media_type) legges på alle målingene fra boka.
+    """
+
+    def __init__(self, metrics, **labels):
+        self.metrics = metrics
+        self.labels = labels
+        metrics.counter("nbno_tile_requests_total", "Forespørsler etter bildedeler, etter utfall.")
+        metrics.counter("nbno_tile_bytes_total", "Byte med bildedeler hentet eller lest fra mellomlageret.")
+        metrics.histogram("nbno_tile_seconds", "Tid per bildedel.")
+        metrics.counter("nbno_retries_total", "Nye forsøk på sider med manglende bildedeler.")
+        metrics.counter("nbno_pages_total", "Sider, etter utfall.")
+        metrics.histogram("nbno_stitch_seconds", "Tid brukt på å sette sammen bildedelene til en side.")
+        metrics.histogram("nbno_encode_seconds", "Tid brukt på å lagre en side som JPEG.")
+        metrics.counter("nbno_errors_total", "Feil fra nb.no, etter HTTP-status.")
+        metrics.counter("nbno_downloads_total", "Nedlastinger, etter utfall.")
+        metrics.counter("nbno_pdfs_total", "PDF-er laget.")
+        metrics.histogram(
+            "nbno_pdf_seconds", "Tid brukt på å lage en PDF.",
+            buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0),
+        )
+
+    def __call__(self, event):
+        m, labels, kind = self.metrics, self.labels, event["type"]
+        if kind == "tile_fetched":
+            outcome = "cached" if event["cached"] else "ok"
+            m.inc("nbno_tile_requests_total", outcome=outcome, **labels)
+            m.inc("nbno_tile_bytes_total", event["bytes"], outcome=outcome, **labels)
+            if not event["cached"]:
+                m.observe("nbno_tile_seconds", event["seconds"], **labels)
+        elif kind == "tile_failed":
+            m.inc("nbno_tile_requests_total", outcome=str(event["status"]), **labels)
+        elif kind == "retry":
+            m.inc("nbno_retries_total", **labels)
+        elif kind == "page_finished":
+            m.inc("nbno_pages_total", outcome="ok", **labels)
+            m.observe("nbno_stitch_seconds", event["stitch_seconds"], **labels)
+            m.observe("nbno_encode_seconds", event["encode_seconds"], **labels)
+        elif kind == "page_failed":
+            m.inc("nbno_pages_total", outcome="failed", **labels)
+        elif kind == "error":
+            m.inc("nbno_errors_total", status=str(event["status"]), **labels)
+        elif kind == "download_finished":
+            outcome = "ok" if event["success"] else "failed"
+            m.inc("nbno_downloads_total", outcome=outcome, **labels)
+        elif kind == "pdf_finished":
+            m.inc("nbno_pdfs_total", **labels)
+            m.observe("nbno_pdf_seconds", event["seconds"], **labels)
+
+
+def peak_rss():
+    """Høyeste minnebruk (RSS) for prosessen i byte, eller None om ukjent."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Profiler:
+    """Vegg- og CPU-tid per steg og side, for --profile.
+
+    span(steg, side) måler en blokk i tråden som kjører den. CPU-tiden er
+    trådens egen, så der veggtiden er mye større enn CPU-tiden venter
+    tråden på nett, disk eller låser. summary gir en tabell, og write_trace
+    skriver Chrome trace-event JSON som kan åpnes i Perfetto eller
+    chrome://tracing.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        # (stage, page, thread id, start, wall, cpu), times in seconds
+        self.spans = []
+        self.threads = {}
+        self.memory = []
+
+    @contextlib.contextmanager
+    def span(self, stage, page=None):
+        start = time.perf_counter()
+        cpu = time.thread_time()
         try:
-            images = []
-            for path in files:
-                image = self._open_pdf_image(path)
-                if image is None:
-                    return False
-                images.append(image)
-            images[0].save(
-                output_pdf,
-                "PDF",
-                resolution=100.0,
-                save_all=True,
-                append_images=images[1:]
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.thread_time() - cpu
+            thread = threading.current_thread()
+            with self.lock:
+                self.threads[thread.ident] = thread.name
+                self.spans.append((stage, page, thread.ident, start - self.origin, wall, cpu))
+                # one memory sample per saved page
+                if stage == "encode":
+                    self.memory.append((start + wall - self.origin, peak_rss()))
+
+    def stages(self):
+        """{steg: (antall, vegg, cpu, maks vegg)} i sekunder."""
+        totals = {}
+        with self.lock:
+            for stage, _, _, _, wall, cpu in self.spans:
+                count, total_wall, total_cpu, longest = totals.get(stage, (0, 0.0, 0.0, 0.0))
+                totals[stage] = (count + 1, total_wall + wall, total_cpu + cpu, max(longest, wall))
+        return totals
+
+    def pages(self):
+        """{side: {steg: vegg}} i sekunder."""
+        pages = {}
+        with self.lock:
+            for stage, page, _, _, wall, _ in self.spans:
+                if page is not None:
+                    stages = pages.setdefault(page, {})
+                    stages[stage] = stages.get(stage, 0.0) + wall
+        return pages
+
+    def summary(self, slowest=10):
+        """Tabell over stegene, de tregeste sidene og høyeste minnebruk."""
+        elapsed = time.perf_counter() - self.origin
+        lines = [
+            f"{'Steg':<12}{'antall':>8}{'vegg (s)':>11}{'CPU (s)':>10}"
+            f"{'snitt (ms)':>12}{'maks (ms)':>11}"
+        ]
+        for stage, (count, wall, cpu, longest) in sorted(
+            self.stages().items(), key=lambda item: -item[1][1]
+        ):
+            lines.append(
+                f"{stage:<12}{count:>8}{wall:>11.2f}{cpu:>10.2f}"
+                f"{wall / count * 1000:>12.1f}{longest * 1000:>11.1f}"
             )
-            print(f"PDF created: {output_pdf}")
+        # pages fetched by the book-wide queue have no "page" span of their own
+        page_time = {
+            page: stages.get("page", sum(stages.values()))
+            for page, stages in self.pages().items()
+        }
+        pages = sorted(self.pages().items(), key=lambda item: -page_time[item[0]])[:slowest]
+        if pages:
+            lines.append("")
+            lines.append("Tregeste sider:")
+            for page, stages in pages:
+                parts = ", ".join(
+                    f"{stage} {wall:.2f}" for stage, wall in sorted(stages.items()) if stage != "page"
+                )
+                lines.append(f"  {page:<10}{page_time[page]:>8.2f} s  ({parts})")
+        lines.append("")
+        lines.append(f"Total tid: {elapsed:.2f} s")
+        peak = peak_rss()
+        if peak is not None:
+            lines.append(f"Høyeste minnebruk: {peak / 1024 / 1024:.1f} MB")
+        lines.append("Vegg summeres over tråder og nøstede steg (page inneholder de andre).")
+        return "\n".join(lines)
+
+    def write_trace(self, path):
+        """Skriver målingene som Chrome trace-event JSON."""
+        pid = os.getpid()
+        with self.lock:
+            spans = list(self.spans)
+            threads = dict(self.threads)
+            memory = list(self.memory)
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in threads.items()
+        ]
+        for stage, page, tid, start, wall, cpu in spans:
+            event = {
+                "name": stage, "cat": "nbno", "ph": "X", "pid": pid, "tid": tid,
+                "ts": round(start * 1e6), "dur": round(wall * 1e6),
+                "args": {"cpu_ms": round(cpu * 1000, 3)},
+            }
+            if page is not None:
+                event["args"]["page"] = page
+            events.append(event)
+        for ts, peak in memory:
+            if peak is not None:
+                events.append({
+                    "name": "peak_rss_mb", "ph": "C", "pid": pid, "ts": round(ts * 1e6),
+                    "args": {"MB": round(peak / 1024 / 1024, 1)},
+                })
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+class RetryPolicy:
+    """Grenser og ventetid for nye forsøk på bildedeler som mangler.
+
+    En side får page_budget runder med nye forsøk, og hver runde henter bare
+    bildedelene som fortsatt mangler. Alle sider deler book_budget nye
+    forsøk på enkeltbildedeler. Før hver runde ventes en tilfeldig tid
+    mellom 0 og base_delay * 2^runde (maks max_delay).
+    """
+
+    def __init__(self, page_budget=5, book_budget=1000, base_delay=0.5, max_delay=30.0):
+        self.page_budget = page_budget
+        self.book_budget = book_budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.rounds = {}
+        self.retries = 0
+        self.wait = 0.0
+
+    def allow(self, page, tiles):
+        """Sant, og forsøkene trekkes fra budsjettet, om siden kan prøves igjen."""
+        with self.lock:
+            if self.rounds.get(page, 0) >= self.page_budget:
+                return False
+            if self.retries + tiles > self.book_budget:
+                return False
+            self.rounds[page] = self.rounds.get(page, 0) + 1
+            self.retries += tiles
             return True
-        except Exception as e:
-            print(f"Error creating PDF: {e}")
-            return False
 
+    def backoff(self, page):
+        """Ventetid i sekunder før neste runde for siden (og tell den med)."""
+        with self.lock:
+            attempt = self.rounds.get(page, 1) - 1
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            self.wait += delay
+        return delay
 
-def f2pdf(image_location, pdf_name):
-    try:
-        Image.open(image_location).save(
-            pdf_name + ".pdf", "PDF", resolution=100.0, append=True
-        )
-    except OSError:
-        Image.open(image_location).save(
-            pdf_name + ".pdf", "PDF", resolution=100.0)
+    def page_retries(self, page):
+        with self.lock:
+            return self.rounds.get(page, 0)
 
+    def stats(self):
+        with self.lock:
+            return {
+                "retries": self.retries,
+                "rounds": sum(self.rounds.values()),
+                "wait": self.wait,
+            }
 
-def main():
-    parser = argparse.ArgumentParser()
-    optional = parser._action_groups.pop()
-    required = parser.add_argument_group("required arguments")
-    required.add_argument(
-        "--id",
-        metavar="<bokID>",
-        help="IDen på mediet som skal lastes ned",
-        default=False,
-    )
-    optional.add_argument(
-        "--cover", action="store_true", help="Settes for å laste covers", default=False
-    )
-    optional.add_argument(
-        "--title",
-        action="store_true",
-        help="Settes for å hente tittel på bok automatisk",
-        default=False,
-    )
-    optional.add_argument(
-        "--pdf",
-        action="store_true",
-        help="Settes for å lage pdf av bildene som lastes",
-        default=False,
+
+class TileCache:
+    """Diskbuffer for bildedeler, nøklet på region-URL, med LRU-utkastelse.
+
+    Filene ligger under directory/<ab>/<sha256>.jpg. mtime brukes som sist
+    brukt-tid, så rekkefølgen overlever omstart og deles mellom prosesser;
+    skriving går via en midlertidig fil og os.replace, så en leser ser aldri
+    en halvskrevet bildedel.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_TILE_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.lock = threading.Lock()
+        # path -> size, least recently used first
+        self.entries = collections.OrderedDict()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        found = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".jpg"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, path, st.st_size))
+        found.sort()
+        with self.lock:
+            for _, path, size in found:
+                self.entries[path] = size
+                self.total += size
+            self._evict()
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.jpg")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+                size = self.entries.pop(path, None)
+                if size is not None:
+                    self.total -= size
+            return None
+        with self.lock:
+            self.hits += 1
+            if path in self.entries:
+                self.entries.move_to_end(path)
+            else:
+                # written by another process since we scanned
+                self.entries[path] = len(data)
+                self.total += len(data)
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            self.total -= self.entries.pop(path, 0)
+            self.entries[path] = len(data)
+            self.total += len(data)
+            self._evict()
+
+    def _evict(self):
+        # caller holds self.lock
+        while self.total > self.max_bytes and self.entries:
+            path, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ConcurrencyController:
+    """AIMD-styrt grense for antall forespørsler i luften.
+
+    Grensen økes med én for hver full runde med sunne svar, og halveres ved
+    429/503, tidsavbrudd eller når p95-responstiden stiger over
+    latency_factor ganger det beste nivået som er målt. Med adaptive=False
+    står grensen fast på initial.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, window=50,
+                 latency_factor=2.0, report=None, adaptive=True):
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.latency_factor = latency_factor
+        self.report = report
+        self.adaptive = adaptive
+        self.latencies = collections.deque(maxlen=window)
+        self.baseline = None
+        self.in_flight = 0
+        self.successes = 0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def current(self):
+        return int(self.limit)
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, status):
+        if not self.adaptive:
+            with self.cond:
+                self.in_flight -= 1
+                self.cond.notify_all()
+            return
+        reason = None
+        with self.cond:
+            self.in_flight -= 1
+            if status in THROTTLE_STATUSES:
+                reason = self._decrease(f"HTTP {status}")
+            elif status < 400:
+                self.latencies.append(latency)
+                self.successes += 1
+                if self.successes >= int(self.limit):
+                    self.successes = 0
+                    reason = self._evaluate()
+            self.cond.notify_all()
+            limit = int(self.limit)
+        if reason and self.report:
+            self.report(limit, reason)
+
+    def _p95(self):
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def _evaluate(self):
+        """Kalles etter en runde sunne svar; øker eller senker grensen."""
+        if len(self.latencies) >= min(10, self.latencies.maxlen):
+            p95 = self._p95()
+            if self.baseline is None or p95 < self.baseline:
+                self.baseline = p95
+            elif p95 > self.baseline * self.latency_factor:
+                return self._decrease(f"p95 {p95:.2f}s")
+        if self.limit < self.maximum:
+            self.limit = min(self.maximum, self.limit + 1)
+            return "øker"
+        return None
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        # requests already in flight when we backed off report the same
+        # congestion; only cut once per round trip
+        window = self._p95() if self.latencies else 1.0
+        if now - self.last_decrease < window:
+            return None
+        self.last_decrease = now
+        self.successes = 0
+        self.latencies.clear()
+        self.limit = max(self.minimum, self.limit / 2)
+        return f"senker, {reason}"
+
+
+def read_jpeg_page(path, strict=False):
+    """Leser en bildefil som (JPEG-bytes, (bredde, høyde, komponenter)).
+
+    JPEG-filer brukes som de er. Med strict må filen være en hel JPEG
+    (ValueError ellers); uten blir andre formater omkodet til JPEG.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        info = jpeg_info(data)
+        # a truncated file is missing its end-of-image marker
+        if data.rstrip(b"\0").endswith(b"\xff\xd9"):
+            return data, info
+        raise ValueError(f"avkuttet JPEG: {path}")
+    except ValueError:
+        if strict:
+            raise
+    with Image.open(io.BytesIO(data)) as image:
+        buf = io.BytesIO()
+        image.convert("RGB").save(buf, "JPEG", quality=95)
+    data = buf.getvalue()
+    return data, jpeg_info(data)
+
+
+def prefetch(items, load, depth):
+    """Kjører load(item) i en bakgrunnstråd, høyst depth elementer foran.
+
+    Gir (item, resultat) i samme rekkefølge som items.
+    """
+    ready = queue.Queue(maxsize=max(1, depth))
+    stopped = threading.Event()
+
+    def reader():
+        for item in items:
+            if stopped.is_set():
+                break
+            try:
+                ready.put((item, load(item), None))
+            except Exception as error:
+                ready.put((item, None, error))
+                break
+        ready.put(None)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            entry = ready.get()
+            if entry is None:
+                return
+            item, result, error = entry
+            if error is not None:
+                raise error
+            yield item, result
+    finally:
+        stopped.set()
+        # unblock the reader if it is waiting on a full queue
+        while thread.is_alive():
+            try:
+                ready.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def build_jpeg_pdf(output_pdf, paths, load=read_jpeg_page, depth=PDF_PREFETCH, progress=None):
+    """Skriver én side per bildefil til output_pdf, strømmet rett til disk.
+
+    JPEG-ene legges inn uten omkoding, og bare depth sider leses inn på
+    forhånd, så minnebruken er den samme for 10 og 10 000 sider. load(path)
+    gir (bytes, info) eller None for å avbryte; progress(antall, path)
+    kalles etter hver side. Gir antall sider, eller 0 om PDF-en ble avbrutt.
+    """
+    writer = PdfWriter(output_pdf)
+    scale = 72.0 / PDF_RESOLUTION
+    page_ids = []
+    try:
+        for path, page in prefetch(paths, load, depth):
+            if page is None:
+                writer.abort()
+                return 0
+            data, info = page
+            image_id = writer.add_jpeg(data, info)
+            width, height = info[0] * scale, info[1] * scale
+            page_ids.append(writer.add_page(width, height, [(image_id, 0, 0, width, height)]))
+            del data, page
+            if progress is not None:
+                progress(len(page_ids), path)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close(page_ids)
+    return len(page_ids)
+
+
+def order_pages(names, include_cover=True):
+    """Sorterer sidenavn slik de skal stå i PDF: C1, I1, sider, I3, C2, C3.
+
+    Uten include_cover sorteres navnene bare alfabetisk, som filene i mappen.
+    """
+    names = sorted(names)
+    if not include_cover:
+        return names
+    front = [name for name in FRONT_COVERS if name in names]
+    back = [name for name in BACK_COVERS if name in names]
+    numeric = [name for name in names if name.isdecimal()]
+    rest = [name for name in names if name not in front + numeric + back]
+    return front + numeric + back + rest
+
+
+def jpeg_info(data):
+    """(bredde, høyde, fargekomponenter) fra JPEG-hodet, uten å dekode bildet."""
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("ikke en JPEG-fil")
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            raise ValueError("ugyldig JPEG-markør")
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # fill byte before the actual marker
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        length = int.from_bytes(data[i + 2:i + 4], "big")
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if i + 10 > len(data):
+                break
+            height = int.from_bytes(data[i + 5:i + 7], "big")
+            width = int.from_bytes(data[i + 7:i + 9], "big")
+            return width, height, data[i + 9]
+        i += 2 + length
+    raise ValueError("fant ikke bildestørrelse i JPEG-hodet")
+
+
+class PdfWriter:
+    """Skriver en PDF rett til disk, ett objekt om gangen.
+
+    Bare objektenes posisjon holdes i minnet; Pages-treet, katalogen og
+    xref-tabellen skrives i close(). Filen skrives til path + ".part" og
+    flyttes på plass først når den er komplett.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".part"
+        self.file = open(self.tmp_path, "wb")
+        # offsets[n] is the byte position of object n; 1 and 2 are the
+        # catalog and the page tree, written last
+        self.offsets = [0, None, None]
+        self.position = 0
+        self.lock = threading.Lock()
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write(self, data):
+        self.file.write(data)
+        self.position += len(data)
+
+    def _add_object(self, body, stream=None, obj_id=None):
+        with self.lock:
+            if obj_id is None:
+                obj_id = len(self.offsets)
+                self.offsets.append(None)
+            self.offsets[obj_id] = self.position
+            self._write(b"%d 0 obj\n" % obj_id)
+            self._write(body)
+            if stream is not None:
+                self._write(b"\nstream\n")
+                self._write(stream)
+                self._write(b"\nendstream")
+            self._write(b"\nendobj\n")
+        return obj_id
+
+    def add_jpeg(self, data, info=None):
+        """Legger inn en JPEG som bildeobjekt (DCTDecode); gir objektnummeret."""
+        width, height, components = info or jpeg_info(data)
+        colorspace = {1: b"/DeviceGray", 4: b"/DeviceCMYK"}.get(components, b"/DeviceRGB")
+        body = (
+            b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+            b"/ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode "
+            % (width, height, colorspace)
+        )
+        if components == 4:
+            # Adobe CMYK JPEGs are stored inverted
+            body += b"/Decode [1 0 1 0 1 0 1 0] "
+        body += b"/Length %d >>" % len(data)
+        return self._add_object(body, data)
+
+    def add_page(self, width, height, placements):
+        """Legger til en side (mål i punkter) med bilder plassert som
+        (objektnummer, x, y, bredde, høyde), der y regnes fra bunnen."""
+        content = b"".join(
+            b"q %.4f 0 0 %.4f %.4f %.4f cm /Im%d Do Q\n" % (w, h, x, y, image_id)
+            for image_id, x, y, w, h in placements
+        )
+        content_id = self._add_object(b"<< /Length %d >>" % len(content), content)
+        xobjects = b" ".join(
+            b"/Im%d %d 0 R" % (image_id, image_id) for image_id, *_ in placements
+        )
+        return self._add_object(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] "
+            b"/Resources << /XObject << %s >> >> /Contents %d 0 R >>"
+            % (width, height, xobjects, content_id)
+        )
+
+    def close(self, page_ids):
+        """Skriver sidetreet i gitt rekkefølge og avslutter filen."""
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+        self._add_object(
+            b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids)), obj_id=2
+        )
+        self._add_object(b"<< /Type /Catalog /Pages 2 0 R >>", obj_id=1)
+        with self.lock:
+            xref = self.position
+            self._write(b"xref\n0 %d\n0000000000 65535 f \n" % len(self.offsets))
+            for offset in self.offsets[1:]:
+                self._write(b"%010d 00000 n \n" % offset)
+            self._write(
+                b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                % (len(self.offsets), xref)
+            )
+            self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class TilePdfBuilder:
+    """Lager PDF der hver bildedel legges inn som den JPEG-en serveren sendte.
+
+    Bildedelene plasseres ved sine forskyvninger på siden, så det trengs
+    verken dekoding eller omkoding. Sider kan fullføres i vilkårlig
+    rekkefølge; rekkefølgen i PDF-en bestemmes i close(). En sides
+    bildedeler holdes i minnet til siden er ferdig, så sider som feiler
+    ikke etterlater bilder i filen.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.writer = PdfWriter(path)
+        self.scale = 72.0 / PDF_RESOLUTION
+        self.lock = threading.Lock()
+        # side -> [(JPEG-bytes, jpeg_info, x, y, bredde, høyde)] in pixels
+        self.placed = {}
+        self.pages = {}
+
+    def has_page(self, page):
+        with self.lock:
+            return page in self.pages
+
+    def page_names(self):
+        with self.lock:
+            return list(self.pages)
+
+    def add_tile(self, page, x, y, width, height, data):
+        """Legger en bildedel på siden i rektangelet (x, y, width, height)."""
+        try:
+            info = jpeg_info(data)
+        except ValueError:
+            # not a JPEG after all; this one tile has to be re-encoded
+            with Image.open(io.BytesIO(data)) as tile:
+                buf = io.BytesIO()
+                tile.convert("RGB").save(buf, "JPEG", quality=95)
+            data = buf.getvalue()
+            info = jpeg_info(data)
+        with self.lock:
+            self.placed.setdefault(page, []).append((data, info, x, y, width, height))
+
+    def discard_page(self, page):
+        """Glemmer bildedelene til en side som ikke blir ferdig."""
+        with self.lock:
+            self.placed.pop(page, None)
+
+    def finish_page(self, page, size, scale=1):
+        """Skriver bildedelene og sideobjektet for en side."""
+        width, height = size
+        factor = self.scale * scale
+        with self.lock:
+            placed = self.placed.pop(page, [])
+        placements = [
+            (self.writer.add_jpeg(data, info), x * factor, (height - y - h) * factor, w * factor, h * factor)
+            for data, info, x, y, w, h in placed
+        ]
+        page_id = self.writer.add_page(width * factor, height * factor, placements)
+        with self.lock:
+            self.pages[page] = page_id
+
+    def add_stored_page(self, page, directory, size=None):
+        """Legger til en side fra bildedeler lagret som <kolonne>_<rad>.jpg.
+
+        size er sidens lagrede størrelse; bildedeler hentet i en annen
+        oppløsning skaleres dit i PDF-en. Gir False, uten å skrive noe, om
+        bildedeler mangler eller ikke kan leses.
+        """
+        tiles = {}
+        for name in os.listdir(directory):
+            stem, ext = os.path.splitext(name)
+            column, _, row = stem.partition("_")
+            if ext.lower() == ".jpg" and column.isdecimal() and row.isdecimal():
+                tiles[(int(column), int(row))] = os.path.join(directory, name)
+        columns = sorted({column for column, row in tiles})
+        rows = sorted({row for column, row in tiles})
+        # a gap anywhere would leave a hole, or no first row/column to measure
+        if (
+            not tiles or columns != list(range(len(columns))) or rows != list(range(len(rows)))
+            or len(tiles) != len(columns) * len(rows)
+        ):
+            return False
+        # offsets follow from the tile sizes along the first row and column
+        sizes = {}
+        try:
+            for (column, row), path in tiles.items():
+                if column == 0 or row == 0:
+                    with open(path, "rb") as f:
+                        sizes[(column, row)] = jpeg_info(f.read())[:2]
+        except (OSError, ValueError):
+            return False
+        x_offsets, y_offsets = {}, {}
+        x = y = 0
+        for column in columns:
+            x_offsets[column] = x
+            x += sizes[(column, 0)][0]
+        for row in rows:
+            y_offsets[row] = y
+            y += sizes[(0, row)][1]
+        if not x or not y:
+            return False
+        try:
+            for (column, row), path in sorted(tiles.items(), key=lambda item: item[0][::-1]):
+                with open(path, "rb") as f:
+                    data = f.read()
+                width, height = jpeg_info(data)[:2]
+                self.add_tile(page, x_offsets[column], y_offsets[row], width, height, data)
+        except (OSError, ValueError):
+            self.discard_page(page)
+            return False
+        scale = 1 if size is None else size[0] / x
+        self.finish_page(page, (x, y), scale)
+        return True
+
+    def close(self, order):
+        """Avslutter PDF-en med sidene i gitt rekkefølge; gir antall sider."""
+        with self.lock:
+            page_ids = [self.pages[page] for page in order if page in self.pages]
+        self.writer.close(page_ids)
+        return len(page_ids)
+
+    def abort(self):
+        self.writer.abort()
+
+
+class TileJournal:
+    """Journal over hentede bildedeler, så nedlasting kan fortsette midt i en side.
+
+    Hver linje er et JSON-objekt som legges til med én os.write på en fil
+    åpnet med O_APPEND, så et krasj etterlater på det meste en avkuttet
+    siste linje, som hoppes over ved lesing. Ved åpning skrives journalen
+    på nytt uten ferdige sider og bildedeler som ikke finnes lenger.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # side -> {(kolonne, rad): sti}
+        self.tiles = {}
+        self._load()
+        self._compact()
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            page = entry.get("page")
+            if entry.get("done"):
+                self.tiles.pop(page, None)
+            elif os.path.exists(entry.get("path", "")):
+                self.tiles.setdefault(page, {})[(entry["column"], entry["row"])] = entry["path"]
+
+    def _compact(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            for page, tiles in self.tiles.items():
+                for (column, row), path in tiles.items():
+                    f.write(self._line(page, column, row, path))
+        os.replace(self.path + ".tmp", self.path)
+
+    @staticmethod
+    def _line(page, column, row, path):
+        return json.dumps({"page": page, "column": column, "row": row, "path": path}) + "\n"
+
+    def tiles_for(self, page):
+        with self.lock:
+            return dict(self.tiles.get(page, {}))
+
+    def record(self, page, column, row, path):
+        line = self._line(page, column, row, path).encode("utf-8")
+        with self.lock:
+            self.tiles.setdefault(page, {})[(column, row)] = path
+            os.write(self.fd, line)
+
+    def finish(self, page, remove_tiles=True):
+        """Markerer en side som ferdig; sletter bildedelene om ønskelig."""
+        with self.lock:
+            tiles = self.tiles.pop(page, {})
+            os.write(self.fd, (json.dumps({"page": page, "done": True}) + "\n").encode("utf-8"))
+        if remove_tiles:
+            for path in tiles.values():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            try:
+                os.rmdir(os.path.dirname(next(iter(tiles.values()))))
+            except (OSError, StopIteration):
+                pass
+
+    def close(self):
+        """Lukker journalen, og fjerner den når ingen sider står uferdige."""
+        with self.lock:
+            os.close(self.fd)
+            if not self.tiles:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+
+
+class PageCanvas:
+    """Lerret for én side som bildedeler limes inn i så fort de er dekodet.
+
+    Størrelsen er sidens lagrede størrelse, og boxes gir plassen
+    (x, y, bredde, høyde) til hver (kolonne, rad). Hver bildedel lukkes rett
+    etter at den er limt inn, så en side aldri holdes i minnet to ganger.
+    Med defer beholdes bare bytes i tiles, til en CpuStage setter sammen siden.
+    """
+
+    def __init__(self, size, boxes, profiler=None, page=None, defer=False):
+        self.size = tuple(size)
+        self.boxes = dict(boxes)
+        # defer: keep the tile bytes for a CpuStage instead of decoding here
+        self.tiles = {} if defer else None
+        self.profiler = profiler
+        self.page = page
+        self.positions = list(self.boxes)
+        self.missing = set(self.positions)
+        self.image = None
+        self.lock = threading.Lock()
+        # time spent decoding and pasting tiles, for metrics
+        self.paste_seconds = 0.0
+
+    def _span(self, stage):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.span(stage, self.page)
+
+    def pending(self):
+        """Bildedeler som ennå ikke er limt inn, i rad-rekkefølge."""
+        with self.lock:
+            return [pos for pos in self.positions if pos in self.missing]
+
+    def complete(self):
+        with self.lock:
+            return not self.missing
+
+    def paste(self, column, row, data):
+        """Dekoder og limer inn én bildedel; IOError om den ikke kan dekodes."""
+        if self.tiles is not None:
+            self._keep(column, row, data)
+            return
+        x, y, width, height = self.boxes[(column, row)]
+        started = time.monotonic()
+        with self._span("decode"):
+            tile = Image.open(io.BytesIO(data))
+            try:
+                tile.load()
+                if tile.size != (width, height):
+                    # a tile from a run with another --resize, or a server that
+                    # rounded differently; make it fit its place on the page
+                    resized = tile.resize((width, height))
+                    tile.close()
+                    tile = resized
+            except BaseException:
+                tile.close()
+                raise
+        try:
+            with self._span("paste"), self.lock:
+                if self.image is None:
+                    self.image = Image.new("RGB", self.size)
+                self.image.paste(tile, (x, y))
+                self.missing.discard((column, row))
+                self.paste_seconds += time.monotonic() - started
+        finally:
+            tile.close()
+
+    def _keep(self, column, row, data):
+        """Tar vare på bytes for en bildedel etter en rask sjekk av JPEG-hodet."""
+        try:
+            jpeg_info(data)
+        except ValueError as error:
+            raise IOError(error)
+        # a truncated JPEG lacks its end-of-image marker
+        if not data.rstrip(b"\0").endswith(b"\xff\xd9"):
+            raise IOError("avkuttet JPEG")
+        with self.lock:
+            self.tiles[(column, row)] = data
+            self.missing.discard((column, row))
+
+    def close(self):
+        with self.lock:
+            if self.image is not None:
+                self.image.close()
+                self.image = None
+            if self.tiles is not None:
+                self.tiles.clear()
+
+
+def stitch_page(shm_name, layout, size, path, fmt="JPEG", options=None):
+    """Setter sammen og lagrer én side; kjøres i en CpuStage-prosess.
+
+    layout er ((x, y, bredde, høyde), start, lengde) for hver bildedel i
+    det delte minnet shm_name; siden lagres med Pillow-formatet fmt og
+    save()-valgene options. Gir (sekunder for sammensetting, for lagring).
+    """
+    started = time.monotonic()
+    image = Image.new("RGB", tuple(size))
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        for (x, y, width, height), start, length in layout:
+            with Image.open(io.BytesIO(bytes(shm.buf[start:start + length]))) as tile:
+                tile.load()
+                if tile.size != (width, height):
+                    with tile.resize((width, height)) as resized:
+                        image.paste(resized, (x, y))
+                else:
+                    image.paste(tile, (x, y))
+    finally:
+        shm.close()
+    stitched = time.monotonic()
+    image.save(path, fmt, **(options or {}))
+    image.close()
+    return stitched - started, time.monotonic() - stitched
+
+
+class CpuStage:
+    """Prosesspool for CPU-arbeidet i en nedlasting: dekoding, innliming og JPEG-koding.
+
+    Bytes for bildedelene legges i ett delt minneområde per side, så de
+    ikke piples gjennom til prosessen. Prosessene startes med spawn, siden
+    nedlastingen alltid har tråder i gang.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(1, int(workers))
+        self.executor = cf.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def save_page(self, path, size, boxes, tiles, fmt="JPEG", options=None):
+        """Lagrer siden i path fra {(kolonne, rad): bytes}; venter til den er skrevet."""
+        total = sum(len(data) for data in tiles.values())
+        shm = shared_memory.SharedMemory(create=True, size=max(1, total))
+        try:
+            layout = []
+            start = 0
+            for position, data in tiles.items():
+                shm.buf[start:start + len(data)] = data
+                layout.append((boxes[position], start, len(data)))
+                start += len(data)
+            return self.executor.submit(
+                stitch_page, shm.name, layout, size, path, fmt, options
+            ).result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+_cpu_stages = {}
+_cpu_stage_lock = threading.Lock()
+
+
+def cpu_stage(workers):
+    """CpuStage med workers prosesser, delt av alle bøkene i prosessen."""
+    with _cpu_stage_lock:
+        stage = _cpu_stages.get(workers)
+        if stage is None:
+            stage = _cpu_stages[workers] = CpuStage(workers)
+        return stage
+
+
+def shutdown_cpu_stages():
+    """Stopper prosessene til alle CpuStage-ene; kalles ved avslutning."""
+    with _cpu_stage_lock:
+        stages = list(_cpu_stages.values())
+        _cpu_stages.clear()
+    for stage in stages:
+        stage.shutdown()
+
+
+# before module teardown, or the executors are collected half torn down
+atexit.register(shutdown_cpu_stages)
+
+
+class TileScheduler:
+    """Henter alle bildedeler i en bok fra én prioritert kø.
+
+    Køen sorteres på (sideindeks, rad, kolonne), så tidligere sider blir
+    ferdige først, og antall forespørsler i luften er begrenset av workers
+    uavhengig av hvor mange bildedeler hver side består av.
+    """
+
+    def __init__(self, book, pages, workers):
+        self.book = book
+        self.pages = list(pages)
+        self.workers = max(1, int(workers))
+        self.queue = queue.PriorityQueue()
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.canvases = {}
+        self.remaining = {}
+        self.started = set()
+
+    def _enqueue(self, index, page, positions):
+        with self.lock:
+            self.remaining[page] = len(positions)
+        for column, row in positions:
+            self.queue.put((index, row, column, page))
+
+    def _finish_page(self, index, page):
+        """Kalles av tråden som hentet sidens siste bildedel."""
+        canvas = self.canvases[page]
+        if canvas.complete():
+            del self.canvases[page]
+            return page, self.book._save_page(page, canvas)
+        if page in COVER_PAGES:
+            self.book.log(f"Feilet å laste ned side {self.book.page_file(page)} - hopper over.")
+            del self.canvases[page]
+            self.book._drop_page(page, canvas)
+            return page, (True, 200)
+        missing = canvas.pending()
+        if not self.book.retry_policy.allow(page, len(missing)):
+            del self.canvases[page]
+            return page, self.book._page_failed(page, canvas)
+        self.book.log(f"Feilet å laste ned side {self.book.page_file(page)} - prøver igjen.")
+        delay = self.book.retry_policy.backoff(page)
+        self.book.emit(
+            "retry", page=page, attempt=self.book.retry_policy.page_retries(page),
+            missing=len(missing), delay=delay,
+        )
+        # only the tiles that are missing go back into the queue, after a
+        # backoff that does not hold up a worker
+        timer = threading.Timer(delay, self._enqueue, (index, page, missing))
+        timer.daemon = True
+        timer.start()
+        return None
+
+    def _worker(self):
+        while True:
+            index, row, column, page = self.queue.get()
+            if page is None or self.stopped.is_set():
+                return
+            try:
+                with self.lock:
+                    first = page not in self.started
+                    self.started.add(page)
+                if first:
+                    self.book.emit("page_started", page=page)
+                status, content = self.book._fetch_tile(page, column, row)
+                if status == 403:
+                    self.stopped.set()
+                    self.results.put((page, (False, status)))
+                    return
+                if content is not None:
+                    self.book._paste_tile(page, self.canvases[page], column, row, content)
+                    del content
+                with self.lock:
+                    self.remaining[page] -= 1
+                    done = self.remaining[page] == 0
+                if done:
+                    result = self._finish_page(index, page)
+                    if result is not None:
+                        self.results.put(result)
+            except Exception as error:
+                # e.g. a full disk while storing a tile; run() raises it in
+                # the caller, like the page threads of the other modes do
+                self.stopped.set()
+                self.results.put((page, error))
+                return
+
+    def run(self):
+        """Starter nedlastingen; gir (side, resultat) etter hvert som sider blir ferdige."""
+        for index, page in enumerate(self.pages):
+            # a canvas only allocates pixels when its first tile arrives, so
+            # only the pages actually being worked on hold memory
+            canvas = self.book.new_canvas(page)
+            self.canvases[page] = canvas
+            pending = canvas.pending()
+            if pending:
+                self._enqueue(index, page, pending)
+            else:
+                # every tile came back from the resume journal
+                self.results.put(self._finish_page(index, page))
+        threads = [
+            threading.Thread(target=self._worker, daemon=True)
+            for _ in range(min(self.workers, self.queue.qsize()))
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for _ in self.pages:
+                page, result = self.results.get()
+                if isinstance(result, Exception):
+                    raise result
+                yield page, result
+                if not result[0] and result[1] != PAGE_FAILED:
+                    break
+        finally:
+            self.stopped.set()
+            # sentinels sort after every real tile, releasing idle workers
+            for _ in threads:
+                self.queue.put((len(self.pages), 0, 0, None))
+
+
+def save_options(fmt, quality=None, progressive=False, optimize=False):
+    """Pillow save()-valg for et format i OUTPUT_FORMATS."""
+    options = {}
+    if fmt in ("jpeg", "webp") and quality is not None:
+        options["quality"] = int(quality)
+    if fmt == "jpeg":
+        if progressive:
+            options["progressive"] = True
+        if optimize:
+            options["optimize"] = True
+    elif fmt == "webp" and optimize:
+        # slowest, smallest encoder setting
+        options["method"] = 6
+    elif fmt == "png" and optimize:
+        options["optimize"] = True
+    elif fmt == "tiff":
+        options["compression"] = "tiff_deflate"
+    return options
+
+
+def page_files(directory, images_only=False):
+    """{side: sti} for lagrede sider i directory, i alle formater i OUTPUT_FORMATS.
+
+    Med images_only hoppes sider lagret som bildedeler (.tiles) over.
+    """
+    extensions = IMAGE_EXTENSIONS if images_only else tuple(
+        ext for ext, _ in OUTPUT_FORMATS.values()
+    )
+    pages = {}
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return pages
+    for name in names:
+        page, ext = os.path.splitext(name)
+        if ext.lower() in extensions:
+            # a page saved in two formats counts once; JPEG first
+            if page not in pages or ext.lower() == ".jpg":
+                pages[page] = os.path.join(directory, name)
+    return pages
+
+
+class HttpPool:
+    """Tilkoblingspool delt av alle HTTP-sesjoner i prosessen.
+
+    Hver sesjon har egne hoder (f.eks. cookie fra load_cookie), men alle
+    bruker samme HTTPAdapter, så forbindelser til nb.no holdes åpne og
+    gjenbrukes på tvers av bøker og forespørsler fra webappen. grow(n)
+    gjør plass til n forbindelser per vert før en nedlasting med n
+    forespørsler i luften starter.
+    """
+
+    def __init__(self, size=10, hosts=10):
+        self.lock = threading.Lock()
+        self.size = max(1, int(size))
+        self.adapter = HTTPAdapter(
+            pool_connections=hosts, pool_maxsize=self.size,
+            max_retries=Retry(total=5, backoff_factor=0.5),
+        )
+        # counts from pools dropped by grow
+        self.retired_requests = 0
+        self.retired_connections = 0
+
+    def session(self):
+        """Ny requests-sesjon med nbno sine hoder, koblet til den delte poolen."""
+        http = session()
+        http.headers["User-Agent"] = "Mozilla/5.0"
+        http.mount("https://", self.adapter)
+        http.mount("http://", self.adapter)
+        return http
+
+    def grow(self, size):
+        """Øker antall forbindelser som holdes åpne per vert til minst size."""
+        with self.lock:
+            if size <= self.size:
+                return
+            self.size = int(size)
+            manager = self.adapter.poolmanager
+            manager.connection_pool_kw["maxsize"] = self.size
+            # pools keep the size they were made with; requests in flight
+            # finish on the old ones, and the next request opens a larger one
+            sent, connections = self._counts()
+            self.retired_requests += sent
+            self.retired_connections += connections
+            manager.clear()
+
+    def _counts(self):
+        manager = self.adapter.poolmanager
+        sent = connections = 0
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is not None:
+                sent += pool.num_requests
+                connections += pool.num_connections
+        return sent, connections
+
+    def stats(self):
+        """{"size", "requests", "connections", "reused"} siden prosessen startet."""
+        with self.lock:
+            sent, connections = self._counts()
+            sent += self.retired_requests
+            connections += self.retired_connections
+            return {
+                "size": self.size,
+                "requests": sent,
+                "connections": connections,
+                "reused": max(0, sent - connections),
+            }
+
+    def describe(self):
+        """Kort tekst om gjenbruk av forbindelser, til sammendrag."""
+        stats = self.stats()
+        share = stats["reused"] / stats["requests"] * 100 if stats["requests"] else 0
+        return (
+            f"HTTP: {stats['requests']} forespørsler over {stats['connections']} "
+            f"forbindelser ({share:.0f}% gjenbrukt, pool {stats['size']} per vert)."
+        )
+
+
+# one pool for the whole process; NBNO_HTTP_POOL sets the starting size,
+# and downloads grow it to their own concurrency
+http_pool = HttpPool(int(os.environ.get("NBNO_HTTP_POOL", "10")))
+
+
+def new_session():
+    """HTTP-sesjon med nbno sine hoder, som bruker den delte http_pool."""
+    return http_pool.session()
+
+
+def load_cookie(http, file_path):
+    """Legger authorization/cookie fra en fil med nøkkel=verdi-linjer på sesjonen."""
+    with open(file_path) as f:
+        for line in f:
+            if "=" in line:
+                key, value = map(str.strip, line.split("=", 1))
+                if key in ["authorization", "cookie"]:
+                    http.headers[key] = value
+
+
+def cached_manifest(url):
+    """Manifestposten for url fra minnet, eller None; utgåtte poster kastes."""
+    now = time.monotonic()
+    with _manifest_lock:
+        expired = [key for key, (stored, _) in _manifest_cache.items() if now - stored >= MANIFEST_TTL]
+        for key in expired:
+            del _manifest_cache[key]
+        entry = _manifest_cache.get(url)
+        if entry is None:
+            return None
+        _manifest_cache.move_to_end(url)
+        return entry[1]
+
+
+def cache_manifest(url, record):
+    """Legger en manifestpost i minnet, og kaster de eldste over grensen."""
+    with _manifest_lock:
+        _manifest_cache[url] = (time.monotonic(), record)
+        _manifest_cache.move_to_end(url)
+        while len(_manifest_cache) > MANIFEST_CACHE_SIZE:
+            _manifest_cache.popitem(last=False)
+
+
+def default_tile_size(media_type, tilgang):
+    """Bildedelstørrelse som alltid har virket for medietypen og tilgangen."""
+    # use smaller tile sizes for resources to avoid access restrictions
+    if tilgang and "tilgjengelig etter bestemte vilkår" in tilgang.lower():
+        return 200
+    if media_type.startswith("plikt"):
+        return 300
+    if media_type in ("digibok", "digitidsskrift"):
+        return 1024
+    return 4096
+
+
+def tile_class(media_type, tilgang):
+    """Klassen bildedelstørrelser lagres for: kjent medietype og tilgang.
+
+    Tilgangsteksten fra manifestet er fritekst, så den kokes ned til noen
+    få klasser, og ukjente medietyper deler én nøkkel.
+    """
+    if media_type.startswith("plikt"):
+        kind = "plikt"
+    elif media_type in MEDIA_TYPES:
+        kind = media_type
+    else:
+        kind = "annen"
+    text = (tilgang or "").lower()
+    if "vilkår" in text:
+        access = "vilkår"
+    elif "fritt" in text:
+        access = "fri"
+    elif "norsk" in text or "norge" in text:
+        access = "norge"
+    else:
+        access = "annen"
+    return f"{kind}|{access}"
+
+
+def load_tile_sizes():
+    """Lagrede bildedelstørrelser, {medietype|tilgang: størrelse}."""
+    try:
+        with open(TILE_SIZE_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_tile_size(key, size):
+    """Lagrer (eller glemmer, med None) bildedelstørrelsen for en klasse."""
+    with _tile_size_lock:
+        sizes = load_tile_sizes()
+        if size is None:
+            if sizes.pop(key, None) is None:
+                return
+        else:
+            sizes[key] = int(size)
+        # keys from before the classes were normalised
+        sizes = {
+            name: value for name, value in sizes.items()
+            if name.split("|")[0] in MEDIA_TYPES + ("plikt", "annen")
+            and name.split("|")[-1] in ("vilkår", "fri", "norge", "annen")
+        }
+        try:
+            os.makedirs(os.path.dirname(TILE_SIZE_FILE) or ".", exist_ok=True)
+            with open(TILE_SIZE_FILE + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(sizes, f, indent=1, sort_keys=True)
+            os.replace(TILE_SIZE_FILE + ".tmp", TILE_SIZE_FILE)
+        except OSError:
+            pass
+
+
+def parse_media_id(digimedie):
+    """Deler en ID som digibok_2006... eller pliktmonografi_... i (type, id)."""
+    if digimedie.find("plikt") > -1:
+        media_type = "plikt" + digimedie.split("plikt")[1].split("_")[0]
+    else:
+        media_type = "dig" + digimedie.split("dig")[1].split("_")[0]
+    media_id = digimedie.split(media_type + "_")[1]
+    return media_type, media_id
+
+
+def find_book_folder(digimedie):
+    """Finner mappen med bilder for en ID, i CLI- eller webapp-oppsett.
+
+    Prøver <type>_<id> og den eldre <id>-mappen, både i BASE_DIR og i
+    arbeidsmappen; gir (mappe, bildemappe) eller None.
+    """
+    media_type, media_id = parse_media_id(digimedie)
+    for base in dict.fromkeys((BASE_DIR, ".")):
+        for name in (f"{media_type}_{media_id}", media_id):
+            folder = os.path.join(base, name)
+            # webapp layout keeps pages in sources/, CLI layout flat
+            for images in (os.path.join(folder, "sources"), folder):
+                if page_files(images, images_only=True):
+                    return folder, images
+    return None
+
+
+def f2pdf(folder, images_dir, include_cover=False, verbose=False):
+    """Lager PDF av bildene i en eksisterende mappe i én gjennomgang.
+
+    Sidene tas i PDF-rekkefølge (med omslag om include_cover), og PDF-en
+    havner der Book.make_pdf ville lagt den. Gir antall sider, eller False
+    når mappen ikke har noen sider å ta med.
+    """
+    folder_name = os.path.basename(os.path.normpath(folder))
+    pages = page_files(images_dir, images_only=True)
+    names = list(pages)
+    if not include_cover:
+        names = [name for name in names if name.isdecimal()]
+    files = [pages[name] for name in order_pages(names, include_cover)]
+    if not files:
+        print(f"Fant ingen sider å lage pdf av i {images_dir}.")
+        return False
+    if os.path.normpath(images_dir) == os.path.normpath(folder):
+        pdf_dir = folder
+    else:
+        pdf_dir = os.path.join(folder, "pdf")
+        os.makedirs(pdf_dir, exist_ok=True)
+    output_pdf = os.path.join(pdf_dir, f"{folder_name}.pdf")
+    print(f"\nLager {output_pdf}\n")
+    started = time.monotonic()
+
+    def progress(count, path):
+        print(
+            f"{' '*5}{os.path.basename(path)} --> {folder_name}.pdf "
+            f"({count}/{len(files)})",
+            end="\n" if verbose else "\r",
+        )
+
+    pages = build_jpeg_pdf(output_pdf, files, progress=progress)
+    elapsed = max(time.monotonic() - started, 1e-9)
+    print(f"\n{' '*5}{pages} sider på {elapsed:.1f}s ({pages / elapsed:.1f} sider/s).")
+    return pages
+
+
+def read_id_file(path):
+    """IDene i en fil, én per linje; tomme linjer og # kommentarer hoppes over."""
+    ids = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                ids.append(line)
+    return ids
+
+
+def batch_profile_path(path, media_id):
+    """Trace-filen for én bok i --batch: path med IDen før filendelsen, eller
+    None (bokmappen) når --profile er gitt uten fil."""
+    if path is True:
+        return None
+    root, ext = os.path.splitext(path)
+    return f"{root}_{media_id}{ext or '.json'}"
+
+
+def configure_book(book, args, tile_cache=None, events=None):
+    """Setter valgene fra kommandolinjen som gjelder hver bok."""
+    if args.url:
+        book.set_to_print_url()
+    if args.error:
+        book.set_to_print_errors()
+    if args.v:
+        book.verbose_print()
+    if events is not None:
+        book.add_event_sink(events)
+    if args.mode:
+        book.set_fetch_mode(args.mode)
+    if args.workers:
+        book.set_max_workers(int(args.workers))
+    if args.tiles:
+        book.set_tile_workers(int(args.tiles))
+    if args.cpu_workers:
+        book.set_cpu_workers(int(args.cpu_workers))
+    if args.format or args.quality or args.progressive or args.optimize:
+        book.set_output(
+            args.format or "jpeg", int(args.quality) if args.quality else None,
+            args.progressive, args.optimize,
+        )
+    if args.resume:
+        book.set_resume()
+    if args.retries:
+        book.set_retry_policy(RetryPolicy(page_budget=int(args.retries)))
+    if tile_cache is not None:
+        book.set_tile_cache(tile_cache)
+    if args.resize:
+        book.set_resize(int(args.resize))
+    if args.start:
+        book.set_from_page(int(args.start))
+    if args.stop:
+        book.set_to_page(int(args.stop))
+    if args.cover:
+        book.download_covers()
+    if args.title:
+        book.set_title()
+    if args.tilepdf:
+        book.set_tile_pdf()
+
+
+class BatchStats:
+    """Hendelsesmottaker som teller sider, byte og feil for én bok i en batch."""
+
+    def __init__(self, media_id):
+        self.media_id = media_id
+        self.lock = threading.Lock()
+        self.pages = 0
+        self.bytes = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self.success = False
+
+    def __call__(self, event):
+        kind = event["type"]
+        with self.lock:
+            if kind == "page_finished":
+                self.pages += 1
+            elif kind == "tile_fetched" and not event["cached"]:
+                self.bytes += event["bytes"]
+            elif kind == "page_failed":
+                self.failed += 1
+
+
+def run_batch(ids, args, tile_cache=None, events=None):
+    """Laster ned flere bøker i én kjøring.
+
+    Bøkene deler én HTTP-sesjon og én grense for forespørsler i luften
+    (--workers, eller AIMD med --adaptive). Manifestene til de neste bøkene
+    hentes mens de forrige lastes ned, og --books bøker kjøres samtidig, så
+    halen av én bok overlapper starten på den neste.
+    """
+    http = new_session()
+    if args.cookie:
+        load_cookie(http, args.cookie)
+    parallel = max(1, int(args.books)) if args.books else 2
+    slots = threading.BoundedSemaphore(parallel)
+    print_lock = threading.Lock()
+    results = []
+
+    def say(media_id, msg):
+        with print_lock:
+            print(f"[{media_id}] {msg}")
+
+    def report(limit, reason):
+        # every healthy round raises the limit; only show that with --v
+        if args.v or reason != "øker":
+            say("alle", f"Samtidige forespørsler: {limit} ({reason})")
+
+    budget = int(args.workers) if args.workers else multiprocessing.cpu_count() * 4
+    # without --adaptive the budget is a fixed limit shared by all books
+    controller = ConcurrencyController(
+        initial=4 if args.adaptive else budget, maximum=budget,
+        report=report, adaptive=bool(args.adaptive),
+    )
+
+    def open_book(media_id):
+        # runs in the prefetch thread, so the manifest is ready when a slot frees up
+        try:
+            book = Book(media_id, cli_mode=True, session=http)
+        except Exception as error:
+            say(media_id, f"Feil: {error}")
+            return None
+        configure_book(book, args, tile_cache, events)
+        book.set_controller(controller)
+        book.set_quiet()
+        book.add_event_sink(lambda event: log(media_id, event), types=("log",))
+        return book
+
+    def log(media_id, event):
+        msg = event["msg"].strip()
+        if msg:
+            say(media_id, msg)
+
+    def run(media_id, book, stats):
+        started = time.perf_counter()
+        try:
+            if args.profile:
+                book.set_profile()
+            download = book.download()
+            stats.success = download is not False and not book.failed_pages
+            if download is not False and book.download_skipped and args.tilepdf:
+                book.make_tile_pdf()
+            if download is not False and args.pdf:
+                stats.success = book.make_pdf() and stats.success
+            if args.profile:
+                trace = batch_profile_path(args.profile, media_id)
+                say(media_id, "\n" + book.write_profile(trace))
+        except Exception as error:
+            say(media_id, f"Feil: {error}")
+        finally:
+            stats.seconds = time.perf_counter() - started
+            say(media_id, f"Ferdig: {stats.pages} sider, {stats.failed} mangler, "
+                f"{stats.seconds:.1f} s.")
+            slots.release()
+
+    started = time.perf_counter()
+    print(f"Laster ned {len(ids)} bøker, {parallel} samtidig.")
+    executor = cf.ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="book")
+    try:
+        for media_id, book in prefetch(ids, open_book, parallel):
+            stats = BatchStats(media_id)
+            results.append(stats)
+            if book is None:
+                continue
+            book.add_event_sink(stats)
+            slots.acquire()
+            say(media_id, f"Starter ({book.num_pages} sider).")
+            executor.submit(run, media_id, book, stats)
+    finally:
+        executor.shutdown(wait=True)
+    elapsed = time.perf_counter() - started
+    print_batch_summary(results, elapsed)
+
+
+def print_batch_summary(results, elapsed):
+    """Tabell over bøkene i en batch og samlet gjennomstrømning."""
+    width = max([len(stats.media_id) for stats in results] + [2])
+    print(f"\n{'ID':<{width}}  {'sider':>6}  {'mangler':>7}  {'MB':>8}  {'tid (s)':>8}  status")
+    for stats in results:
+        print(
+            f"{stats.media_id:<{width}}  {stats.pages:>6}  {stats.failed:>7}  "
+            f"{stats.bytes / 1024 / 1024:>8.1f}  {stats.seconds:>8.1f}  "
+            f"{'ok' if stats.success else 'feilet'}"
+        )
+    ok = sum(stats.success for stats in results)
+    pages = sum(stats.pages for stats in results)
+    megabytes = sum(stats.bytes for stats in results) / 1024 / 1024
+    print(
+        f"\nTotalt: {len(results)} bøker ({ok} ok, {len(results) - ok} feilet), "
+        f"{pages} sider, {megabytes:.1f} MB på {elapsed:.1f} s: "
+        f"{pages / elapsed if elapsed else 0:.2f} sider/s, "
+        f"{megabytes / elapsed if elapsed else 0:.2f} MB/s."
+    )
+    print(http_pool.describe())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group("required arguments")
+    required.add_argument(
+        "--id",
+        metavar="<bokID>",
+        action="append",
+        help="IDen på mediet som skal lastes ned (kan gis flere ganger)",
+        default=[],
+    )
+    required.add_argument(
+        "--id-file",
+        metavar="<fil>",
+        help="Fil med én ID per linje (# for kommentarer)",
+        default=False,
+    )
+    optional.add_argument(
+        "--cover", action="store_true", help="Settes for å laste covers", default=False
+    )
+    optional.add_argument(
+        "--title",
+        action="store_true",
+        help="Settes for å hente tittel på bok automatisk",
+        default=False,
+    )
+    optional.add_argument(
+        "--pdf",
+        action="store_true",
+        help="Settes for å lage pdf av bildene som lastes",
+        default=False,
+    )
+    optional.add_argument(
+        "--tilepdf",
+        action="store_true",
+        help="Settes for å lage pdf direkte av bildedelene, uten omkoding",
+        default=False,
     )
     optional.add_argument(
         "--f2pdf",
@@ -625,6 +3172,108 @@ def main():
     optional.add_argument(
         "--stop", metavar="<int>", help="Sidetall å stoppe på", default=False
     )
+    optional.add_argument(
+        "--mode",
+        metavar="<modus>",
+        choices=FETCH_MODES,
+        help="Hvordan bildedeler hentes: " + ", ".join(FETCH_MODES),
+        default=False,
+    )
+    optional.add_argument(
+        "--workers",
+        metavar="<int>",
+        help="Antall samtidige nedlastinger (standard: 4 per CPU-kjerne)",
+        default=False,
+    )
+    optional.add_argument(
+        "--cpu-workers",
+        metavar="<int>",
+        help="Prosesser som setter sammen og lagrer sider (standard: 0, i nedlastingstrådene)",
+        default=False,
+    )
+    optional.add_argument(
+        "--format",
+        metavar="<format>",
+        choices=tuple(OUTPUT_FORMATS),
+        help="Format for lagrede sider: " + ", ".join(OUTPUT_FORMATS) + " (standard: jpeg)",
+        default=False,
+    )
+    optional.add_argument(
+        "--quality",
+        metavar="<int>",
+        help="Kvalitet 1-100 for jpeg og webp",
+        default=False,
+    )
+    optional.add_argument(
+        "--progressive",
+        action="store_true",
+        help="Lagre progressive JPEG-er",
+        default=False,
+    )
+    optional.add_argument(
+        "--optimize",
+        action="store_true",
+        help="Mindre filer for jpeg/png/webp, mot lengre kodetid",
+        default=False,
+    )
+    optional.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Juster antall samtidige forespørsler etter serverens svar",
+        default=False,
+    )
+    optional.add_argument(
+        "--retries",
+        metavar="<int>",
+        help="Maks runder med nye forsøk per side (standard: 5)",
+        default=False,
+    )
+    optional.add_argument(
+        "--resume",
+        action="store_true",
+        help="Settes for å fortsette avbrutte sider der de slapp",
+        default=False,
+    )
+    optional.add_argument(
+        "--cache",
+        metavar="<mappe>",
+        help="Mappe for mellomlagring av bildedeler",
+        default=False,
+    )
+    optional.add_argument(
+        "--cache-size",
+        metavar="<MB>",
+        help="Maks størrelse på mellomlageret (standard: 1024)",
+        default=False,
+    )
+    optional.add_argument(
+        "--tiles",
+        metavar="<int>",
+        help="Maks samtidige bildedeler per side (page-modus)",
+        default=False,
+    )
+    optional.add_argument(
+        "--events",
+        metavar="<fil>",
+        help="Skriv fremdriftshendelser som JSON-linjer til fil",
+        default=False,
+    )
+    optional.add_argument(
+        "--profile",
+        metavar="<fil>",
+        nargs="?",
+        const=True,
+        help="Mål tid og minne per steg og side; skriver en tabell og en "
+        "Chrome-trace (standard: nbno_profile.json i bokmappen; med --batch "
+        "får filnavnet IDen til hver bok)",
+        default=False,
+    )
+    optional.add_argument(
+        "--books",
+        metavar="<int>",
+        help="Antall bøker som lastes samtidig når flere IDer gis (standard: 2)",
+        default=False,
+    )
     optional.add_argument(
         "--cookie",
         metavar="<string>",
@@ -634,80 +3283,74 @@ def main():
     parser._action_groups.append(optional)
     args = parser.parse_args()
 
-    if args.id:
-        if args.f2pdf:
-            media_type = "dig" + args.id.split("dig")[1].split("_")[0]
-            media_id = str(args.id.split(media_type + "_")[1])
-            filelist = []
-            filelist.extend(
-                glob(os.path.join(str(media_id), ("[0-9]" * 4) + ".jpg")))
-            if not filelist:
-                filelist.extend(
-                    glob(os.path.join(str(media_id), ("[0-9]" * 3) + ".jpg"))
-                )
-            filelist = sorted(filelist)
-            print(f"\nLager {media_id}.pdf\n")
-            if args.cover:
-                filelist = [f"{media_id}/C1.jpg",
-                            *filelist, f"{media_id}/C3.jpg"]
-            for file in filelist:
-                f2pdf(file, str(media_id))
-                print(
-                    f"{' '*5}{file.split(os.path.sep)[1]} --> {media_id}.pdf", end="\r"
-                )
-                if args.v:
-                    print("")
-            print("\n\nFerdig med å lage pdf.")
-            exit()
-        # CLI mode: flat directory structure for direct downloads
-        book = Book(args.id, cli_mode=True)
-        if args.url:
-            book.set_to_print_url()
-        if args.error:
-            book.set_to_print_errors()
-        if args.v:
-            book.verbose_print()
-        if args.cookie:
-            if os.path.exists(args.cookie):
-                book.load_cookie(args.cookie)
-            else:
-                print(f"Fil for autentisering ikke funnet: {args.cookie}")
-                exit()
-        if args.resize:
-            book.set_resize(int(args.resize))
-        if args.start:
-            book.set_from_page(int(args.start))
-        if args.stop:
-            book.set_to_page(int(args.stop))
-            if int(args.stop) > book.num_pages:
-                print("Du har forsøkt å laste ned flere sider enn det eksisterer.")
-                print(
-                    f"Det finnes kun {book.num_pages} sider, du får ikke flere enn dette."
-                )
-        print(f"Laster ned {book.media_type} med ID: {book.media_id}.")
-        if args.cover:
-            book.download_covers()
-        if args.title:
-            book.set_title()
-        download = book.download()
-        if download == False:
-            print(
-                f"\nNoe gikk galt, du prøvde å laste ned {book.media_type}, "
-                f"med id {book.media_id}, er dette korrekt?"
-            )
-            exit()
-        else:
-            if not book.download_skipped:
-                print(f"\n{' '*5}Ferdig med å laste ned alle sider.\n")
-        if args.pdf:
-            print(f"\nLager {book.media_id}.pdf")
-            savepdf = book.make_pdf()
-            if savepdf:
-                print(f"\n{' '*5}Ferdig med å lage pdf.\n")
-        exit()
-    else:
+    ids = list(args.id)
+    if args.id_file:
+        ids += read_id_file(args.id_file)
+    if not ids:
         parser.print_help()
         exit()
+    if args.f2pdf:
+        for media_id in ids:
+            found = find_book_folder(media_id)
+            if found is None:
+                print(f"Fant ingen mappe med bilder for {media_id}.")
+                continue
+            f2pdf(*found, include_cover=args.cover, verbose=args.v)
+        print("\n\nFerdig med å lage pdf.")
+        exit()
+    if args.cookie and not os.path.exists(args.cookie):
+        print(f"Fil for autentisering ikke funnet: {args.cookie}")
+        exit()
+    tile_cache = None
+    if args.cache:
+        cache_bytes = DEFAULT_TILE_CACHE_BYTES
+        if args.cache_size:
+            cache_bytes = int(args.cache_size) * 1024 * 1024
+        tile_cache = TileCache(args.cache, cache_bytes)
+    events = JsonLinesSink(args.events) if args.events else None
+    if len(ids) > 1:
+        run_batch(ids, args, tile_cache, events)
+        exit()
+
+    # CLI mode: flat directory structure for direct downloads
+    book = Book(ids[0], cli_mode=True)
+    configure_book(book, args, tile_cache, events)
+    if args.cookie:
+        book.load_cookie(args.cookie)
+    if args.adaptive:
+        book.set_adaptive()
+    if args.profile:
+        book.set_profile()
+        trace = None if args.profile is True else args.profile
+        # written however the run ends, since main exits from several places
+        atexit.register(lambda: print("\n" + book.write_profile(trace)))
+    if args.stop and int(args.stop) > book.num_pages:
+        print("Du har forsøkt å laste ned flere sider enn det eksisterer.")
+        print(
+            f"Det finnes kun {book.num_pages} sider, du får ikke flere enn dette."
+        )
+    print(f"Laster ned {book.media_type} med ID: {book.media_id}.")
+    download = book.download()
+    if download == False:
+        print(
+            f"\nNoe gikk galt, du prøvde å laste ned {book.media_type}, "
+            f"med id {book.media_id}, er dette korrekt?"
+        )
+        exit()
+    else:
+        if book.failed_pages:
+            print(f"\n{' '*5}Ferdig, men {len(book.failed_pages)} sider mangler.\n")
+        elif not book.download_skipped:
+            print(f"\n{' '*5}Ferdig med å laste ned alle sider.\n")
+        elif args.tilepdf:
+            # nothing was downloaded, so the live PDF never started
+            book.make_tile_pdf()
+    if args.pdf:
+        print(f"\nLager {book.media_id}.pdf")
+        savepdf = book.make_pdf()
+        if savepdf:
+            print(f"\n{' '*5}Ferdig med å lage pdf.\n")
+    exit()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,139 @@
+import io
+import json
+import re
+import threading
+import time
+
+import pytest
+import requests
+from PIL import Image
+
+import nbno
+
+
+IMAGE_URL = "http://iiif.test/image/"
+TILE = re.compile(r"/(?P<page>[^/]+)/(?P<x>\d+),(?P<y>\d+),(?P<w>\d+),(?P<h>\d+)/(?P<size>[^/]+)/0/native\.jpg$")
+
+
+def jpeg_bytes(size, color=(200, 120, 40)):
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+def response(url, status=200, content=b"", headers=None):
+    r = requests.Response()
+    r.url = url
+    r.status_code = status
+    r._content = content
+    r._content_consumed = True
+    r.headers.update(headers or {})
+    return r
+
+
+class FakeIIIF:
+    """Stand-in for a requests.Session against api.nb.no.
+
+    pages is {side: (bredde, høyde)}. fault(page, region, attempt) may return
+    an HTTP status, "truncated" or "dropped" (the connection breaks) for a
+    tile, or None for a good one. Tiles come in the IIIF size asked for, and
+    those wider or taller than max_tile are refused with 403. The manifest
+    carries etag, and If-None-Match with the same value gives 304.
+    """
+
+    def __init__(self, pages, fault=None, delay=0.0, max_tile=None):
+        self.pages = pages
+        self.fault = fault
+        self.delay = delay
+        self.max_tile = max_tile
+        self.etag = '"1"'
+        self.headers = {}
+        self.lock = threading.Lock()
+        self.manifest_requests = []
+        self.attempts = {}
+        self.tiles = []
+        # the IIIF size of each tile request: "full" or "b,h"
+        self.sizes = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def manifest(self, media_id):
+        canvases = [
+            {
+                "@id": f"http://iiif.test/canvas/{media_id}_{name}",
+                "width": width,
+                "height": height,
+                "images": [{"resource": {"service": {"@id": IMAGE_URL + name}}}],
+            }
+            for name, (width, height) in self.pages.items()
+        ]
+        return {
+            "label": "Test",
+            "metadata": [{"label": "Tilgang", "value": "Fritt tilgjengelig"}],
+            "sequences": [{"canvases": canvases}],
+        }
+
+    def get(self, url, headers=None, **kwargs):
+        if url.endswith("/manifest"):
+            headers = headers or {}
+            self.manifest_requests.append(headers)
+            if headers.get("If-None-Match") == self.etag:
+                return response(url, 304)
+            media_id = url.split("no-nb_")[-1].rsplit("/", 1)[0]
+            content = json.dumps(self.manifest(media_id)).encode()
+            return response(url, content=content, headers={"ETag": self.etag})
+        m = TILE.search(url)
+        if not m:
+            return response(url, 404)
+        page = m["page"]
+        region = tuple(int(m[k]) for k in ("x", "y", "w", "h"))
+        with self.lock:
+            attempt = self.attempts[(page, region)] = self.attempts.get((page, region), 0) + 1
+            self.tiles.append((page, region))
+            self.sizes.append(m["size"])
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            if self.max_tile and max(region[2:]) > self.max_tile:
+                return response(url, 403)
+            fault = self.fault(page, region, attempt) if self.fault else None
+            if isinstance(fault, int):
+                return response(url, fault)
+            if fault == "dropped":
+                raise requests.ConnectionError(f"connection dropped: {url}")
+            size = region[2:] if m["size"] == "full" else tuple(map(int, m["size"].split(",")))
+            data = jpeg_bytes(size)
+            if fault == "truncated":
+                data = data[:len(data) // 2]
+            return response(url, content=data, headers={"Content-Type": "image/jpeg"})
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+@pytest.fixture
+def make_book(tmp_path, monkeypatch):
+    """Book mot en FakeIIIF, med nedlastinger under tmp_path.
+
+    Bildedelene er 1024x1024, som for digibok; med tile=None prøves
+    størrelsen ut. Med session deles en FakeIIIF mellom flere Book, som en
+    ny kjøring mot samme server.
+    """
+    monkeypatch.setattr(nbno, "BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(nbno, "TILE_SIZE_FILE", str(tmp_path / ".nbno_tile_sizes.json"))
+    monkeypatch.setattr(nbno, "_manifest_cache", type(nbno._manifest_cache)())
+
+    def make(pages, fault=None, mode="serial", tile=1024, delay=0.0,
+             media_id="digibok_2020010100001", session=None, offline=False):
+        session = session or FakeIIIF(pages, fault, delay)
+        book = nbno.Book(media_id, cli_mode=True, offline=offline, session=session)
+        book.set_quiet()
+        book.set_fetch_mode(mode)
+        if tile:
+            book.set_tile_sizes(tile, tile)
+        book.set_retry_policy(nbno.RetryPolicy(page_budget=3, base_delay=0.0))
+        return book, session
+
+    return make
@@ -0,0 +1,72 @@
+import threading
+
+from nbno import ConcurrencyController
+
+
+def healthy(controller, n, latency=0.01):
+    for _ in range(n):
+        controller.acquire()
+        controller.release(latency, 200)
+
+
+def test_grows_by_one_per_healthy_round():
+    controller = ConcurrencyController(initial=4, maximum=6)
+    healthy(controller, 4)
+    assert controller.current() == 5
+    healthy(controller, 5)
+    assert controller.current() == 6
+    healthy(controller, 50)
+    assert controller.current() == 6
+
+
+def test_halves_on_throttling_once_per_round_trip():
+    reports = []
+    controller = ConcurrencyController(initial=16, maximum=16, report=lambda *a: reports.append(a))
+    controller.acquire()
+    controller.release(0.1, 429)
+    assert controller.current() == 8
+    # answers already in flight report the same congestion
+    controller.acquire()
+    controller.release(0.1, 503)
+    assert controller.current() == 8
+    assert reports == [(8, "senker, HTTP 429")]
+
+
+def test_never_below_minimum():
+    controller = ConcurrencyController(initial=2, minimum=2, maximum=8)
+    controller.acquire()
+    controller.release(0.1, 429)
+    assert controller.current() == 2
+
+
+def test_backs_off_when_p95_latency_grows():
+    controller = ConcurrencyController(initial=10, maximum=20, latency_factor=2.0)
+    healthy(controller, 10, latency=0.01)
+    assert controller.current() == 11
+    healthy(controller, 11, latency=1.0)
+    assert controller.current() == 5
+
+
+def test_fixed_limit_ignores_throttling():
+    controller = ConcurrencyController(initial=8, maximum=8, adaptive=False)
+    for status in (429, 503, 408, 200):
+        controller.acquire()
+        controller.release(5.0, status)
+    assert controller.current() == 8
+
+
+def test_acquire_waits_for_a_free_slot():
+    controller = ConcurrencyController(initial=1, maximum=1)
+    controller.acquire()
+    acquired = threading.Event()
+
+    def second():
+        controller.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not acquired.wait(0.1)
+    controller.release(0.01, 200)
+    assert acquired.wait(2)
+    thread.join()
@@ -0,0 +1,56 @@
+import re
+
+from nbno import f2pdf
+from conftest import jpeg_bytes
+
+# each page gets its own width, so the order can be read back from the PDF
+WIDTHS = {"C1": 10, "I1": 20, "0001": 30, "0002": 40, "0010": 50, "I3": 60, "C2": 70, "C3": 80}
+
+
+def page_widths(path):
+    """Sidebreddene i PDF-en, i sidenes rekkefølge, i piksler ved 100 dpi."""
+    with open(path, "rb") as f:
+        data = f.read()
+    kids = re.search(rb"/Kids \[([^\]]*)\]", data).group(1).split()[::3]
+    widths = []
+    for kid in kids:
+        page = re.search(rb"\n%s 0 obj\n<< /Type /Page .*?/MediaBox \[0 0 ([\d.]+) " % kid, data)
+        widths.append(round(float(page.group(1)) * 100 / 72))
+    return widths
+
+
+def make_folder(folder, names):
+    folder.mkdir()
+    for name in names:
+        (folder / f"{name}.jpg").write_bytes(jpeg_bytes((WIDTHS[name], 10)))
+
+
+def test_pages_in_order_without_covers(tmp_path):
+    folder = tmp_path / "digibok_1"
+    make_folder(folder, ["0010", "C1", "0002", "I3", "0001"])
+    assert f2pdf(str(folder), str(folder)) == 3
+    assert page_widths(folder / "digibok_1.pdf") == [30, 40, 50]
+
+
+def test_covers_around_the_pages(tmp_path):
+    folder = tmp_path / "digibok_1"
+    make_folder(folder, WIDTHS)
+    assert f2pdf(str(folder), str(folder), include_cover=True) == 8
+    assert page_widths(folder / "digibok_1.pdf") == [10, 20, 30, 40, 50, 60, 70, 80]
+
+
+def test_webapp_layout_writes_to_pdf_dir(tmp_path):
+    folder = tmp_path / "digibok_1"
+    folder.mkdir()
+    make_folder(folder / "sources", ["0002", "0001"])
+    assert f2pdf(str(folder), str(folder / "sources")) == 2
+    assert page_widths(folder / "pdf" / "digibok_1.pdf") == [30, 40]
+
+
+def test_folder_without_pages_gives_no_pdf(tmp_path, capsys):
+    folder = tmp_path / "digibok_1"
+    # only covers, and they are left out without include_cover
+    make_folder(folder, ["C1", "I3"])
+    assert f2pdf(str(folder), str(folder)) is False
+    assert not (folder / "digibok_1.pdf").exists()
+    assert "Fant ingen sider" in capsys.readouterr().out
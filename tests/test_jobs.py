@@ -0,0 +1,111 @@
+import os
+import runpy
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("ocrmypdf")
+
+APP = os.path.join(os.path.dirname(__file__), os.pardir, "web", "app.py")
+
+
+@pytest.fixture(scope="module")
+def web(tmp_path_factory):
+    """web/app.py (et skript, ikke en pakke), med data i en midlertidig mappe."""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("DOWNLOAD_DIR", str(tmp_path_factory.mktemp("web")))
+        mp.setenv("TILE_CACHE_MB", "0")
+        mp.setenv("THUMB_CACHE_MB", "0")
+        yield runpy.run_path(APP, run_name="__mp_main__")
+
+
+@pytest.fixture
+def store(web, tmp_path):
+    return web["JobStore"](str(tmp_path / "jobs.db"))
+
+
+def test_same_book_is_queued_once(store):
+    first, new = store.create("download", "digibok_1", {"media_id": "digibok_1"})
+    assert new
+    assert store.create("download", "digibok_1", {}) == (first, False)
+    # another kind, or another book, is a job of its own
+    assert store.create("pdf", "digibok_1", {})[1]
+    assert store.create("download", "digibok_2", {})[1]
+    store.update(first, state="running")
+    assert store.create("download", "digibok_1", {}) == (first, False)
+    store.update(first, state="done", finished=time.time())
+    again, new = store.create("download", "digibok_1", {})
+    assert new and again != first
+
+
+def test_running_jobs_are_queued_again_after_restart(web, tmp_path, store):
+    running = store.create("download", "a", {"n": 1})[0]
+    queued = store.create("download", "b", {"n": 2})[0]
+    done = store.create("download", "c", {"n": 3})[0]
+    store.update(running, state="running")
+    store.update(done, state="done", finished=time.time())
+    reopened = web["JobStore"](str(tmp_path / "jobs.db"))
+    jobs = reopened.unfinished()
+    assert [(job["id"], job["state"], job["params"]) for job in jobs] == [
+        (running, "queued", {"n": 1}), (queued, "queued", {"n": 2}),
+    ]
+
+
+def test_prune_drops_old_finished_jobs_and_their_events(store):
+    old = store.create("download", "a", {})[0]
+    recent = store.create("download", "b", {})[0]
+    active = store.create("download", "c", {})[0]
+    store.update(old, state="done", finished=time.time() - 100)
+    store.update(recent, state="failed", finished=time.time())
+    for job_id in (old, recent, active):
+        store.add_event(job_id, "log", {"msg": "x"})
+    store.prune(50)
+    assert store.get(old) is None and store.events(old) == []
+    assert store.get(recent)["state"] == "failed"
+    assert [event for _, event, _ in store.events(active)] == ["log"]
+
+
+def test_scheduler_runs_a_queued_book_once(web, store):
+    calls = []
+    release = threading.Event()
+
+    def runner(params, sink):
+        calls.append(params)
+        sink({"type": "progress", "book": "b", "done": 1, "total": 2})
+        release.wait(5)
+
+    scheduler = web["JobScheduler"](store, {"download": (runner, 2)})
+    first = scheduler.submit("download", "digibok_1", {"n": 1})
+    assert scheduler.submit("download", "digibok_1", {"n": 2}) == first
+    release.set()
+    job = scheduler.wait(first, poll=0.01)
+    assert job["state"] == "done" and job["error"] is None
+    assert (job["page"], job["total"]) == (1, 2)
+    assert calls == [{"n": 1}]
+    assert [event for _, event, _ in store.events(first)] == ["progress", "done"]
+
+
+def test_scheduler_marks_failed_jobs(web, store):
+    def refuse(params, sink):
+        return False
+
+    def crash(params, sink):
+        raise RuntimeError("boom")
+
+    scheduler = web["JobScheduler"](store, {"refuse": (refuse, 1), "crash": (crash, 1)})
+    refused = scheduler.wait(scheduler.submit("refuse", "a", {}), poll=0.01)
+    assert (refused["state"], refused["error"]) == ("failed", None)
+    crashed = scheduler.wait(scheduler.submit("crash", "a", {}), poll=0.01)
+    assert (crashed["state"], crashed["error"]) == ("failed", "boom")
+    messages = [data.get("msg", "") for _, _, data in store.events(crashed["id"])]
+    assert any("RuntimeError: boom" in msg for msg in messages)
+
+
+@pytest.mark.parametrize("langs, ok", [
+    ("nor", True), ("nor+eng", True), ("chi_sim", True),
+    ("", False), ("../x", False), ("nor+", False), ("no", False), ("NOR", False),
+])
+def test_ocr_languages_are_checked(web, langs, ok):
+    assert web["valid_ocr_langs"](langs) is ok
@@ -0,0 +1,99 @@
+import json
+import os
+
+import pytest
+
+from nbno import TileJournal
+
+
+@pytest.fixture
+def tile_files(tmp_path):
+    """Lager bildedeler under tmp_path/tiles/<side>/ og gir stiene."""
+
+    def make(page, *positions):
+        directory = tmp_path / "tiles" / page
+        directory.mkdir(parents=True, exist_ok=True)
+        paths = {}
+        for column, row in positions:
+            path = directory / f"{column}_{row}.jpg"
+            path.write_bytes(b"tile")
+            paths[(column, row)] = str(path)
+        return paths
+
+    return make
+
+
+def test_round_trip(tmp_path, tile_files):
+    path = str(tmp_path / "journal")
+    tiles = tile_files("0001", (0, 0), (1, 0))
+    journal = TileJournal(path)
+    for (column, row), tile in tiles.items():
+        journal.record("0001", column, row, tile)
+    journal.close()
+    # unfinished pages keep the journal on disk
+    assert os.path.exists(path)
+    reopened = TileJournal(path)
+    assert reopened.tiles_for("0001") == tiles
+    assert reopened.tiles_for("0002") == {}
+    reopened.close()
+
+
+def test_finish_removes_tiles_and_journal(tmp_path, tile_files):
+    path = str(tmp_path / "journal")
+    tiles = tile_files("0001", (0, 0), (0, 1))
+    kept = tile_files("0002", (0, 0))
+    journal = TileJournal(path)
+    for page, paths in (("0001", tiles), ("0002", kept)):
+        for (column, row), tile in paths.items():
+            journal.record(page, column, row, tile)
+    journal.finish("0001")
+    journal.finish("0002", remove_tiles=False)
+    assert not os.path.exists(tmp_path / "tiles" / "0001")
+    assert os.path.exists(kept[(0, 0)])
+    assert journal.tiles_for("0001") == {}
+    journal.close()
+    assert not os.path.exists(path)
+
+
+def test_skips_torn_lines_and_missing_tiles(tmp_path, tile_files):
+    path = tmp_path / "journal"
+    tiles = tile_files("0001", (0, 0), (1, 0))
+    os.remove(tiles[(1, 0)])
+    lines = [
+        json.dumps({"page": "0001", "column": c, "row": r, "path": p})
+        for (c, r), p in tiles.items()
+    ]
+    lines += [
+        json.dumps({"page": "0002", "column": 0, "row": 0, "path": tiles[(0, 0)]}),
+        json.dumps({"page": "0002", "done": True}),
+    ]
+    # a crash mid-write leaves a cut-off last line
+    path.write_text("\n".join(lines) + '\n{"page": "0003", "col')
+    journal = TileJournal(str(path))
+    assert journal.tiles_for("0001") == {(0, 0): tiles[(0, 0)]}
+    assert journal.tiles_for("0002") == {}
+    assert journal.tiles_for("0003") == {}
+    # compacted on open: only what is still unfinished and on disk
+    assert [json.loads(line) for line in path.read_text().splitlines()] == [
+        {"page": "0001", "column": 0, "row": 0, "path": tiles[(0, 0)]}
+    ]
+    journal.close()
+
+
+def test_book_resumes_inside_a_page(make_book):
+    pages = {"0001": (2000, 1400), "0002": (2000, 1400)}
+    broken = ("0002", (1024, 1024, 976, 376))
+    # a 403 on the last tile stops the whole download
+    book, session = make_book(pages, fault=lambda page, region, attempt: 403 if (page, region) == broken else None)
+    book.set_max_workers(1)
+    book.set_resume()
+    assert book.download() is False
+    assert not os.path.exists(os.path.join(book.sources_dir, "0002.jpg"))
+
+    book, session = make_book(pages)
+    book.set_resume()
+    assert book.download() is True
+    # only the missing tile of the unfinished page is fetched again
+    assert session.tiles == [broken]
+    assert os.path.exists(os.path.join(book.sources_dir, "0002.jpg"))
+    assert not os.path.exists(os.path.join(book.meta_dir, ".nbno_journal"))
@@ -0,0 +1,75 @@
+import os
+
+import nbno
+from conftest import FakeIIIF
+
+PAGES = {"0001": (400, 300), "0002": (400, 300)}
+
+
+class Offline(FakeIIIF):
+    def get(self, url, **kwargs):
+        raise AssertionError(f"ingen nett i offline-modus: {url}")
+
+
+def test_manifest_is_shared_while_fresh(make_book):
+    book, session = make_book(PAGES)
+    again, _ = make_book(PAGES, session=session)
+    assert len(session.manifest_requests) == 1
+    assert again.page_names == ["0001", "0002"]
+    # each Book gets its own lists to filter
+    again.set_to_page(1)
+    assert book.page_names == ["0001", "0002"]
+
+
+def test_stored_manifest_is_revalidated(make_book):
+    book, session = make_book(PAGES)
+    assert book.download() is True
+    assert os.path.exists(os.path.join(book.meta_dir, nbno.MANIFEST_FILE))
+    # as in a new process: nothing in memory, the copy in metadata/ is used
+    nbno._manifest_cache.clear()
+    session.pages = {}
+    again, _ = make_book(PAGES, session=session)
+    assert session.manifest_requests[-1] == {"If-None-Match": '"1"'}
+    assert again.page_names == ["0001", "0002"]
+
+
+def test_changed_manifest_replaces_the_copy(make_book):
+    book, session = make_book(PAGES)
+    book.download()
+    nbno._manifest_cache.clear()
+    session.etag = '"2"'
+    session.pages = {"0001": (400, 300)}
+    again, _ = make_book(PAGES, session=session)
+    assert again.page_names == ["0001"]
+
+
+def test_offline_uses_the_stored_copy(make_book):
+    book, session = make_book(PAGES)
+    book.download()
+    nbno._manifest_cache.clear()
+    offline, _ = make_book(PAGES, session=Offline({}), offline=True)
+    assert offline.page_names == ["0001", "0002"]
+    assert tuple(offline.page_data["0002"]) == (400, 300)
+
+
+def test_offline_without_a_copy_has_no_pages(make_book):
+    offline, _ = make_book(PAGES, session=Offline({}), offline=True)
+    assert offline.page_names == []
+
+
+def test_memory_cache_is_bounded(make_book, monkeypatch):
+    monkeypatch.setattr(nbno, "MANIFEST_CACHE_SIZE", 2)
+    session = FakeIIIF(PAGES)
+    for n in range(1, 4):
+        make_book(PAGES, media_id=f"digibok_202001010000{n}", session=session)
+    assert len(nbno._manifest_cache) == 2
+    # the oldest was dropped and is fetched again
+    make_book(PAGES, media_id="digibok_2020010100001", session=session)
+    assert len(session.manifest_requests) == 4
+
+
+def test_expired_manifest_is_fetched_again(make_book, monkeypatch):
+    book, session = make_book(PAGES)
+    monkeypatch.setattr(nbno, "MANIFEST_TTL", 0)
+    make_book(PAGES, session=session)
+    assert len(session.manifest_requests) == 2
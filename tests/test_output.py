@@ -0,0 +1,91 @@
+import io
+import json
+import os
+
+import pytest
+from PIL import Image
+
+from conftest import jpeg_bytes
+
+# 2 x 2 tiles of 1024
+PAGES = {"0001": (2000, 1400)}
+
+
+@pytest.mark.parametrize("fmt, suffix, pil_format", [
+    ("jpeg", ".jpg", "JPEG"),
+    ("webp", ".webp", "WEBP"),
+    ("png", ".png", "PNG"),
+    ("tiff", ".tif", "TIFF"),
+])
+def test_pages_are_saved_in_the_chosen_format(make_book, fmt, suffix, pil_format):
+    book, session = make_book(PAGES)
+    book.set_output(fmt, quality=80 if fmt in ("jpeg", "webp") else None)
+    assert book.download() is True
+    assert sorted(os.listdir(book.sources_dir)) == [".nbno_manifest.json", "0001" + suffix]
+    with Image.open(os.path.join(book.sources_dir, "0001" + suffix)) as image:
+        assert image.format == pil_format
+        assert image.size == (2000, 1400)
+        image.load()
+        # lossless formats keep the decoded tiles exactly
+        if fmt in ("png", "tiff"):
+            with Image.open(io.BytesIO(jpeg_bytes((976, 376)))) as tile:
+                assert image.getpixel((1999, 1399)) == tile.getpixel((975, 375))
+
+
+def test_tiles_format_keeps_the_server_tiles(make_book):
+    book, session = make_book(PAGES)
+    book.set_output("tiles")
+    assert book.download() is True
+    with open(os.path.join(book.sources_dir, "0001.tiles"), encoding="utf-8") as f:
+        assert json.load(f) == {"size": [2000, 1400]}
+    assert sorted(os.listdir(os.path.join(book.tiles_dir, "0001"))) == [
+        "0_0.jpg", "0_1.jpg", "1_0.jpg", "1_1.jpg",
+    ]
+
+
+def test_existing_pages_in_any_format_are_skipped(make_book):
+    book, session = make_book(PAGES)
+    book.set_output("png")
+    book.download()
+    again, session = make_book(PAGES)
+    assert again.download() is True
+    assert session.tiles == []
+
+
+@pytest.mark.parametrize("fmt, quality", [("gif", None), ("jpeg", 0), ("webp", 101)])
+def test_unknown_format_or_quality_is_refused(make_book, fmt, quality):
+    book, session = make_book(PAGES)
+    with pytest.raises(ValueError):
+        book.set_output(fmt, quality)
+
+
+def test_page_too_large_for_webp_is_saved_as_jpeg(make_book):
+    book, session = make_book({"0001": (16400, 8)}, tile=4096)
+    book.set_output("webp")
+    assert book.download() is True
+    with Image.open(os.path.join(book.sources_dir, "0001.jpg")) as image:
+        assert image.size == (16400, 8)
+    assert not os.path.exists(os.path.join(book.sources_dir, "0001.webp"))
+
+
+@pytest.mark.parametrize("cpu_workers", [0, 1])
+def test_pages_that_cannot_be_saved_are_failed(make_book, cpu_workers):
+    book, session = make_book({"0001": (400, 300), "0002": (400, 300)})
+    book.set_cpu_workers(cpu_workers)
+    book.set_output("jpeg")
+    # an option the encoder refuses
+    book.save_options = {"quality": "høy"}
+    book.download()
+    assert sorted(book.failed_pages) == ["0001", "0002"]
+    assert sorted(os.listdir(book.sources_dir)) == [".nbno_manifest.json"]
+
+
+def test_messages_name_the_saved_file(make_book):
+    broken = ("0001", (0, 0, 1024, 1024))
+    fault = lambda page, region, attempt: 503 if (page, region) == broken and attempt == 1 else None
+    book, session = make_book(PAGES, fault=fault)
+    book.set_output("png")
+    messages = []
+    book.add_event_sink(lambda event: messages.append(event["msg"]), types=("log",))
+    assert book.download() is True
+    assert any("side 0001.png - prøver igjen" in msg for msg in messages)
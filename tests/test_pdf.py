@@ -0,0 +1,129 @@
+import io
+import os
+import re
+
+import pytest
+from PIL import Image
+
+from nbno import PdfWriter, TilePdfBuilder, jpeg_info
+from conftest import jpeg_bytes
+
+
+def jpeg(mode, size=(30, 20)):
+    buf = io.BytesIO()
+    Image.new(mode, size).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def check_xref(data):
+    """Checks the xref table against the objects; gives the object count."""
+    startxref = int(re.search(rb"startxref\n(\d+)\n%%EOF\n$", data).group(1))
+    assert data[startxref:startxref + 5] == b"xref\n"
+    count = int(re.match(rb"xref\n0 (\d+)\n", data[startxref:]).group(1))
+    entries = re.findall(rb"(\d{10}) 00000 n \n", data[startxref:])
+    assert len(entries) == count - 1
+    for number, offset in enumerate(entries, 1):
+        assert data[int(offset):].startswith(b"%d 0 obj\n" % number)
+    return count - 1
+
+
+def test_jpeg_info_reads_the_header():
+    assert jpeg_info(jpeg("RGB")) == (30, 20, 3)
+    assert jpeg_info(jpeg("L")) == (30, 20, 1)
+    assert jpeg_info(jpeg("CMYK")) == (30, 20, 4)
+
+
+@pytest.mark.parametrize("data", [b"", b"GIF89a", b"\xff\xd8\xff\xe0\x00\x10JFIF"])
+def test_jpeg_info_rejects_other_data(data):
+    with pytest.raises(ValueError):
+        jpeg_info(data)
+
+
+def test_pdf_writer_output_is_consistent(tmp_path):
+    path = str(tmp_path / "out.pdf")
+    writer = PdfWriter(path)
+    first = writer.add_jpeg(jpeg("RGB"))
+    second = writer.add_jpeg(jpeg("CMYK"))
+    page_a = writer.add_page(100, 50, [(first, 0, 0, 100, 50)])
+    page_b = writer.add_page(100, 50, [(second, 10, 10, 30, 20)])
+    # pages go in the order given to close, not the order written
+    writer.close([page_b, page_a])
+    assert not os.path.exists(path + ".part")
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data.startswith(b"%PDF-1.4\n")
+    assert check_xref(data) == 8
+    assert b"/Kids [%d 0 R %d 0 R] /Count 2" % (page_b, page_a) in data
+    assert data.count(b"/Filter /DCTDecode") == 2
+    # the JPEG bytes are embedded as they are
+    assert jpeg("RGB") in data
+    assert b"/ColorSpace /DeviceCMYK /BitsPerComponent 8 /Filter /DCTDecode /Decode [1 0 1 0 1 0 1 0]" in data
+
+
+def test_pdf_writer_output_opens_in_pikepdf(tmp_path):
+    pikepdf = pytest.importorskip("pikepdf")
+    path = str(tmp_path / "out.pdf")
+    writer = PdfWriter(path)
+    image = writer.add_jpeg(jpeg("RGB"))
+    writer.close([writer.add_page(72, 48, [(image, 0, 0, 72, 48)])])
+    with pikepdf.open(path) as pdf:
+        assert len(pdf.pages) == 1
+        assert [float(v) for v in pdf.pages[0].mediabox] == [0, 0, 72, 48]
+        (xobject,) = pdf.pages[0].Resources.XObject.values()
+        assert (xobject.Width, xobject.Height) == (30, 20)
+
+
+def test_aborted_pdf_leaves_nothing(tmp_path):
+    path = str(tmp_path / "out.pdf")
+    writer = PdfWriter(path)
+    writer.add_jpeg(jpeg("RGB"))
+    writer.abort()
+    assert os.listdir(tmp_path) == []
+
+
+def store_tiles(directory, tiles):
+    os.makedirs(directory, exist_ok=True)
+    for (column, row), size in tiles.items():
+        with open(os.path.join(directory, f"{column}_{row}.jpg"), "wb") as f:
+            f.write(jpeg_bytes(size))
+
+
+def test_stored_page_is_laid_out_from_its_tiles(tmp_path):
+    store_tiles(str(tmp_path / "0001"), {(0, 0): (50, 40), (1, 0): (30, 40), (0, 1): (50, 10), (1, 1): (30, 10)})
+    builder = TilePdfBuilder(str(tmp_path / "out.pdf"))
+    assert builder.add_stored_page("0001", str(tmp_path / "0001"))
+    assert builder.close(["0001"]) == 1
+    with open(tmp_path / "out.pdf", "rb") as f:
+        data = f.read()
+    assert check_xref(data) == 8
+    assert data.count(b"/Subtype /Image") == 4
+
+
+@pytest.mark.parametrize("tiles", [
+    # no first row to measure the columns by
+    {(0, 1): (50, 10), (1, 1): (30, 10)},
+    # a hole in the middle of the page
+    {(0, 0): (50, 40), (1, 0): (30, 40), (0, 1): (50, 10)},
+])
+def test_incomplete_stored_page_is_left_out(tmp_path, tiles):
+    store_tiles(str(tmp_path / "0001"), tiles)
+    store_tiles(str(tmp_path / "0002"), {(0, 0): (50, 40)})
+    builder = TilePdfBuilder(str(tmp_path / "out.pdf"))
+    assert builder.add_stored_page("0001", str(tmp_path / "0001")) is False
+    assert builder.add_stored_page("0002", str(tmp_path / "0002"))
+    assert builder.close(["0001", "0002"]) == 1
+    with open(tmp_path / "out.pdf", "rb") as f:
+        assert f.read().count(b"/Subtype /Image") == 1
+
+
+def test_discarded_page_writes_no_images(tmp_path):
+    builder = TilePdfBuilder(str(tmp_path / "out.pdf"))
+    builder.add_tile("0001", 0, 0, 50, 40, jpeg_bytes((50, 40)))
+    builder.add_tile("0002", 0, 0, 50, 40, jpeg_bytes((50, 40)))
+    builder.discard_page("0002")
+    builder.finish_page("0001", (50, 40))
+    assert builder.close(["0001", "0002"]) == 1
+    with open(tmp_path / "out.pdf", "rb") as f:
+        data = f.read()
+    assert check_xref(data) == 5
+    assert data.count(b"/Subtype /Image") == 1
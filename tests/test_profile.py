@@ -0,0 +1,19 @@
+import json
+import os
+
+import nbno
+
+
+def test_batch_gives_each_book_its_own_trace(make_book, tmp_path):
+    book, _ = make_book({"0001": (400, 300)})
+    book.set_profile()
+    assert book.download() is True
+    trace = nbno.batch_profile_path(str(tmp_path / "trace.json"), book.media_id)
+    assert trace == str(tmp_path / f"trace_{book.media_id}.json")
+    assert trace in book.write_profile(trace)
+    with open(trace) as f:
+        assert json.load(f)
+    # without a file name the trace goes in the book folder
+    assert nbno.batch_profile_path(True, book.media_id) is None
+    assert nbno.batch_profile_path("trace", "x") == "trace_x.json"
+    assert not os.path.exists(tmp_path / "trace.json")
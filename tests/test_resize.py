@@ -0,0 +1,39 @@
+import os
+
+from PIL import Image
+
+# 2 x 2 tiles of 1024
+PAGES = {"0001": (2000, 1400)}
+
+
+def saved_size(book):
+    with Image.open(os.path.join(book.sources_dir, "0001.jpg")) as image:
+        return image.size
+
+
+def test_server_scales_tiles_down(make_book):
+    book, session = make_book(PAGES)
+    book.set_resize(50)
+    assert book.download() is True
+    assert saved_size(book) == (1000, 700)
+    # each region comes at its exact size on the saved page
+    assert session.sizes == ["512,512", "488,512", "512,188", "488,188"]
+
+
+def test_tiles_are_scaled_up_locally(make_book):
+    book, session = make_book(PAGES)
+    book.set_resize(150)
+    assert book.download() is True
+    assert saved_size(book) == (3000, 2100)
+    # upscaling is optional in IIIF, so the tiles are asked for in full size
+    assert session.sizes == ["full"] * 4
+
+
+def test_odd_scale_leaves_no_gaps(make_book):
+    # rounded tile edges have to meet exactly, or the page gets seams
+    book, session = make_book({"0001": (2001, 1403)})
+    book.set_resize(33)
+    assert book.download() is True
+    boxes = [book.tile_box("0001", c, r)[1] for r in range(2) for c in range(2)]
+    assert sum(w * h for _, _, w, h in boxes) == 660 * 462
+    assert saved_size(book) == (660, 462)
@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+from nbno import RetryPolicy
+
+MODES = ["serial", "page", "book"]
+
+
+def test_page_budget_counts_rounds_per_page():
+    policy = RetryPolicy(page_budget=2, book_budget=100)
+    assert policy.allow("0001", 3)
+    assert policy.allow("0001", 1)
+    assert not policy.allow("0001", 1)
+    # other pages have their own rounds
+    assert policy.allow("0002", 1)
+    assert policy.page_retries("0001") == 2
+    assert policy.stats()["retries"] == 5
+    assert policy.stats()["rounds"] == 3
+
+
+def test_book_budget_is_shared_by_all_pages():
+    policy = RetryPolicy(page_budget=10, book_budget=5)
+    assert policy.allow("0001", 3)
+    assert not policy.allow("0002", 3)
+    assert policy.allow("0002", 2)
+    assert not policy.allow("0003", 1)
+    assert policy.page_retries("0003") == 0
+
+
+def test_backoff_grows_and_is_capped():
+    policy = RetryPolicy(page_budget=10, base_delay=1.0, max_delay=4.0)
+    for round_ in range(1, 6):
+        policy.allow("0001", 1)
+        delay = policy.backoff("0001")
+        assert 0 <= delay <= min(4.0, 2 ** (round_ - 1))
+    assert policy.stats()["wait"] > 0
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_missing_tiles_are_fetched_again(make_book, mode):
+    pages = {"0001": (2000, 1400), "0002": (2000, 1400)}
+    broken = ("0001", (1024, 0, 976, 1024))
+    fault = lambda page, region, attempt: 503 if (page, region) == broken and attempt < 3 else None
+    book, session = make_book(pages, fault=fault, mode=mode)
+    assert book.download() is True
+    assert book.retry_policy.page_retries("0001") == 2
+    # only the missing tile is asked for again
+    assert session.attempts[broken] == 3
+    assert session.attempts[("0001", (0, 0, 1024, 1024))] == 1
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_page_fails_when_retries_run_out(make_book, mode):
+    pages = {"0001": (2000, 1400), "0002": (2000, 1400), "0003": (2000, 1400)}
+    broken = ("0002", (0, 1024, 1024, 376))
+    fault = lambda page, region, attempt: "truncated" if (page, region) == broken else None
+    book, session = make_book(pages, fault=fault, mode=mode)
+    book.download()
+    assert list(book.failed_pages) == ["0002"]
+    # the first try and then page_budget=3 rounds
+    assert session.attempts[broken] == 4
+    assert not os.path.exists(os.path.join(book.sources_dir, "0002.jpg"))
+    for page in ("0001", "0003"):
+        assert os.path.exists(os.path.join(book.sources_dir, page + ".jpg"))
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_empty_page_is_fetched_again(make_book, mode):
+    # a single-tile page whose first answer is cut off decodes to nothing
+    pages = {"0001": (400, 300), "0002": (400, 300)}
+    fault = lambda page, region, attempt: "truncated" if page == "0001" and attempt == 1 else None
+    book, session = make_book(pages, fault=fault, mode=mode)
+    assert book.download() is True
+    assert book.failed_pages == {}
+    assert book.retry_policy.page_retries("0001") == 1
+    assert session.attempts[("0001", (0, 0, 400, 300))] == 2
+    for page in pages:
+        assert os.path.exists(os.path.join(book.sources_dir, page + ".jpg"))
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_empty_page_fails_when_retries_run_out(make_book, mode):
+    pages = {"0001": (400, 300), "0002": (400, 300), "0003": (400, 300)}
+    fault = lambda page, region, attempt: "truncated" if page == "0002" else None
+    book, session = make_book(pages, fault=fault, mode=mode)
+    book.download()
+    assert list(book.failed_pages) == ["0002"]
+    assert session.attempts[("0002", (0, 0, 400, 300))] == 4
+    for page in ("0001", "0003"):
+        assert os.path.exists(os.path.join(book.sources_dir, page + ".jpg"))
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_dropped_tile_is_fetched_again(make_book, mode):
+    # a timeout or broken connection is retried, not the end of the book
+    pages = {"0001": (2000, 1400), "0002": (2000, 1400)}
+    broken = ("0001", (0, 1024, 1024, 376))
+    fault = lambda page, region, attempt: "dropped" if (page, region) == broken and attempt == 1 else None
+    book, session = make_book(pages, fault=fault, mode=mode)
+    book.set_max_workers(8)
+    book.set_adaptive(initial=8)
+    assert book.download() is True
+    assert book.failed_pages == {}
+    assert session.attempts[broken] == 2
+    assert book.retry_policy.page_retries("0001") == 1
+    # the adaptive limit backed off on the timeout
+    assert book.controller.current() < 8
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_tile_that_keeps_timing_out_fails_its_page(make_book, mode):
+    pages = {"0001": (2000, 1400), "0002": (2000, 1400), "0003": (2000, 1400)}
+    broken = ("0002", (1024, 0, 976, 1024))
+    fault = lambda page, region, attempt: "dropped" if (page, region) == broken else None
+    book, session = make_book(pages, fault=fault, mode=mode)
+    book.download()
+    assert list(book.failed_pages) == ["0002"]
+    assert session.attempts[broken] == 4
+    for page in ("0001", "0003"):
+        assert os.path.exists(os.path.join(book.sources_dir, page + ".jpg"))
@@ -0,0 +1,64 @@
+import os
+import threading
+
+import pytest
+from PIL import Image
+
+# digibok pages are fetched in 1024x1024 tiles: 2 x 2 per page here
+TILE = 1024
+PAGES = {f"{n:04d}": (2000, 1400) for n in range(1, 5)}
+
+
+def test_book_mode_fetches_in_page_order(make_book):
+    book, session = make_book(PAGES, mode="book")
+    book.set_max_workers(1)
+    assert book.download() is True
+    # one worker takes the queue strictly in (page, row, column) order
+    expected = [
+        (page, (x, y, min(TILE, 2000 - x), min(TILE, 1400 - y)))
+        for page in PAGES for y in (0, TILE) for x in (0, TILE)
+    ]
+    assert session.tiles == expected
+
+
+def test_book_mode_bounds_requests_in_flight(make_book):
+    book, session = make_book(PAGES, mode="book", delay=0.01)
+    book.set_max_workers(3)
+    assert book.download() is True
+    assert 1 < session.max_in_flight <= 3
+    for page, size in PAGES.items():
+        with Image.open(os.path.join(book.sources_dir, page + ".jpg")) as image:
+            assert image.size == size
+
+
+def test_page_mode_fetches_each_tile_once(make_book):
+    book, session = make_book(PAGES, mode="page")
+    assert book.download() is True
+    assert len(session.tiles) == len(set(session.tiles)) == 4 * 4
+    saved = [name for name in os.listdir(book.sources_dir) if not name.startswith(".")]
+    assert sorted(saved) == [page + ".jpg" for page in PAGES]
+
+
+@pytest.mark.parametrize("mode", ["serial", "page", "book"])
+def test_worker_error_reaches_the_caller(make_book, monkeypatch, mode):
+    book, session = make_book(PAGES, mode=mode)
+    book.set_resume()
+
+    def full_disk(*args):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(book, "_store_tile", full_disk)
+    errors = []
+
+    def download():
+        try:
+            book.download()
+        except OSError as error:
+            errors.append(error)
+
+    # a worker that dies silently would leave download() waiting forever
+    thread = threading.Thread(target=download, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert [error.errno for error in errors] == [28]
@@ -0,0 +1,45 @@
+import os
+
+from nbno import TileCache
+
+
+def test_round_trip_and_counters(tmp_path):
+    cache = TileCache(str(tmp_path), max_bytes=1000)
+    assert cache.get("a") is None
+    cache.put("a", b"x" * 10)
+    assert cache.get("a") == b"x" * 10
+    assert (cache.hits, cache.misses) == (1, 1)
+    # the same key again replaces, and is not counted twice
+    cache.put("a", b"y" * 20)
+    assert cache.total == 20
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = TileCache(str(tmp_path), max_bytes=300)
+    for key in "abc":
+        cache.put(key, key.encode() * 100)
+    assert cache.get("a") is not None
+    cache.put("d", b"d" * 100)
+    assert cache.get("b") is None
+    assert [cache.get(key) is not None for key in "acd"] == [True, True, True]
+    assert cache.total == 300
+
+
+def test_order_survives_restart(tmp_path):
+    cache = TileCache(str(tmp_path), max_bytes=1000)
+    for age, key in enumerate("abc"):
+        cache.put(key, key.encode() * 100)
+        # oldest first: a was used longest ago
+        os.utime(cache._path(key), (1000 + age, 1000 + age))
+    smaller = TileCache(str(tmp_path), max_bytes=200)
+    assert smaller.total == 200
+    assert smaller.get("a") is None
+    assert smaller.get("c") == b"c" * 100
+
+
+def test_forgets_files_removed_behind_its_back(tmp_path):
+    cache = TileCache(str(tmp_path), max_bytes=1000)
+    cache.put("a", b"a" * 100)
+    os.remove(cache._path("a"))
+    assert cache.get("a") is None
+    assert cache.total == 0
@@ -0,0 +1,61 @@
+import json
+
+import nbno
+from conftest import FakeIIIF
+
+PAGES = {"0001": (3000, 3000), "0002": (3000, 3000)}
+
+
+def stored_sizes():
+    with open(nbno.TILE_SIZE_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_probe_finds_the_largest_accepted_size(make_book):
+    book, session = make_book(PAGES, tile=None, session=FakeIIIF(PAGES, max_tile=2048))
+    assert book.update_column_row("0001") == (1, 1)
+    assert (book.tile_width, book.tile_size_source) == (2048, "probe")
+    # 4096 is cut to the page and refused, 2048 is accepted
+    assert session.tiles == [("0001", (0, 0, 3000, 3000)), ("0001", (0, 0, 2048, 2048))]
+    assert stored_sizes() == {book.tile_class(): 2048}
+
+
+def test_stored_size_is_used_without_probing(make_book):
+    session = FakeIIIF(PAGES, max_tile=2048)
+    make_book(PAGES, tile=None, session=session)[0].update_column_row("0001")
+    book, _ = make_book(PAGES, tile=None, session=session)
+    session.tiles.clear()
+    book.update_column_row("0001")
+    assert (book.tile_width, book.tile_size_source) == (2048, "cache")
+    assert session.tiles == []
+
+
+def test_refused_stored_size_is_forgotten(make_book):
+    book, session = make_book(PAGES, tile=None, session=FakeIIIF(PAGES, max_tile=2048))
+    nbno.save_tile_size(book.tile_class(), 4096)
+    assert book.download() is False
+    assert stored_sizes() == {}
+
+
+def test_default_when_probing_is_off(make_book):
+    book, session = make_book(PAGES, tile=None)
+    book.set_tile_probe(False)
+    book.update_column_row("0001")
+    assert (book.tile_width, book.tile_size_source) == (1024, "default")
+    assert session.tiles == []
+
+
+def test_small_page_probe_is_not_stored(make_book):
+    small = {"0001": (600, 800)}
+    book, session = make_book(small, tile=None)
+    book.update_column_row("0001")
+    # the page only proves that 800 works, so the default is used and nothing is kept
+    assert book.tile_width == 1024
+    assert nbno.load_tile_sizes() == {}
+
+
+def test_old_keys_are_dropped(make_book):
+    with open(nbno.TILE_SIZE_FILE, "w", encoding="utf-8") as f:
+        json.dump({"digibok|fritt tilgjengelig": 512}, f)
+    nbno.save_tile_size("digibok|fri", 2048)
+    assert stored_sizes() == {"digibok|fri": 2048}
@@ -2,120 +2,804 @@
 """
 Simple web interface for nbno downloader.
 """
-import builtins
+import functools
+import hashlib
 import io
 import json
 import os
-import queue
 import re
+import sqlite3
 import subprocess
 import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import ocrmypdf
 from flask import Flask, render_template, request, jsonify, Response, send_from_directory, send_file
-from nbno import Book
-import requests
+from nbno import Book, TileCache, Metrics, MetricsSink, http_pool, OUTPUT_FORMATS, IMAGE_EXTENSIONS
 
-# ensure only one PDF/OCR job runs at a time
-pdf_lock = threading.Lock()
+# counters and histograms for /metrics, fed by every job's Book
+metrics = Metrics()
+metrics.histogram(
+    'nbno_job_seconds', "Tid fra en jobb starter til den er ferdig.",
+    buckets=(1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0),
+)
+metrics.histogram(
+    'nbno_ocr_page_seconds', "Tid brukt av tesseract per side.",
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0),
+)
+metrics.gauge('nbno_jobs', "Jobber i køen, etter type og tilstand.")
+metrics.counter('nbno_http_requests_total', "HTTP-forespørsler gjennom den delte poolen.")
+metrics.counter('nbno_http_connections_total', "Forbindelser åpnet av den delte poolen.")
+metrics.gauge('nbno_http_pool_size', "Forbindelser som holdes åpne per vert.")
 
-app = Flask(__name__)
+# nbno's CPU workers are spawned processes that import this file again as
+# __mp_main__; they only stitch pages, so the caches, job queue, library and
+# OCR stage are set up in the real server alone
+IN_WORKER = __name__ == '__mp_main__'
 
+# tiles shared by all downloads so retries and re-runs skip the network;
+# TILE_CACHE_MB=0 turns the cache off
+TILE_CACHE_MB = int(os.environ.get('TILE_CACHE_MB', '1024'))
+tile_cache = None
+if TILE_CACHE_MB > 0 and not IN_WORKER:
+    tile_cache = TileCache(
+        os.path.join(os.environ.get('DOWNLOAD_DIR', '.'), '.cache', 'tiles'),
+        TILE_CACHE_MB * 1024 * 1024,
+    )
 
-@app.route('/', methods=['GET'])
-def index():
-    # list existing downloaded books (subdirs in DOWNLOAD_DIR)
-    download_dir = os.environ.get('DOWNLOAD_DIR', '.')
-    books = []
-    # sort book directories by recorded download timestamp (descending)
-    entries = [nm for nm in os.listdir(download_dir)
-               if os.path.isdir(os.path.join(download_dir, nm)) and nm != 'logs']
-    # load numeric timestamps (UNIX) or parse legacy ISO strings
-    ts_map = {}
-    for name in entries:
-        mf = os.path.join(download_dir, name, 'metadata', '.nbno_meta.json')
-        if os.path.isfile(mf):
+# resized copies for /files?w=, keyed by source path, mtime and width;
+# THUMB_CACHE_MB=0 resizes on every request instead
+THUMB_CACHE_MB = int(os.environ.get('THUMB_CACHE_MB', '256'))
+thumb_cache = None
+if THUMB_CACHE_MB > 0 and not IN_WORKER:
+    thumb_cache = TileCache(
+        os.path.join(os.environ.get('DOWNLOAD_DIR', '.'), '.cache', 'thumbs'),
+        THUMB_CACHE_MB * 1024 * 1024,
+    )
+# widths made as soon as a page is saved (covers and the page preview use 500)
+THUMB_WIDTHS = (500,)
+thumb_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='thumbs')
+
+
+def thumbnail_etag(path, width):
+    """ETag for en nedskalert side; endres når kildefilen endres."""
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}|{width}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+
+def render_thumbnail(path, width):
+    """Skalerer en JPEG ned til width punkter bred; gir JPEG-bytes."""
+    from PIL import Image
+
+    with Image.open(path) as img:
+        hsize = int(img.size[1] * width / float(img.size[0]))
+        # let the JPEG decoder skip detail we are about to throw away
+        img.draft('RGB', (width, hsize))
+        img = img.resize((width, hsize), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=85)
+    return buf.getvalue()
+
+
+def thumbnail(path, width):
+    """Gir (JPEG-bytes, ETag) for siden i bredde width, fra thumb_cache der mulig."""
+    etag = thumbnail_etag(path, width)
+    data = thumb_cache.get(etag) if thumb_cache is not None else None
+    if data is None:
+        data = render_thumbnail(path, width)
+        if thumb_cache is not None:
+            thumb_cache.put(etag, data)
+    return data, etag
+
+
+def prerender_thumbnails(path):
+    """Lager nedskalerte versjoner av en nylig lagret side i bakgrunnen."""
+    if thumb_cache is None:
+        return
+    for width in THUMB_WIDTHS:
+        thumb_executor.submit(thumbnail, path, width)
+
+
+# tesseract processes run side by side, one core each, as pages arrive
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', os.cpu_count() or 1))
+# tesseract language codes joined by '+' (e.g. nor+eng); the value is also a
+# directory name under ocr/, so nothing else is let through
+OCR_LANGS = re.compile(r'[a-z_]{3,}(\+[a-z_]{3,})*')
+
+
+def valid_ocr_langs(langs):
+    return bool(langs) and OCR_LANGS.fullmatch(langs) is not None
+
+
+class OcrStage:
+    """OCR per side i egne tesseract-prosesser, med tekstlag lagret per side.
+
+    Hver side gir en tekst-PDF (textonly_pdf) i <bok>/ocr/<språk>/<side>.pdf,
+    som gjenbrukes så lenge den er nyere enn sidebildet. Tesseract er selv en
+    egen prosess, så trådene her gjør bare venting, og OCR skalerer med
+    antall kjerner uten å stå i kø bak GIL.
+    """
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.env = dict(os.environ, OMP_THREAD_LIMIT='1')
+
+    @staticmethod
+    def layer_path(image_path, langs):
+        sources = os.path.dirname(image_path)
+        page = os.path.splitext(os.path.basename(image_path))[0]
+        return os.path.join(os.path.dirname(sources), 'ocr', langs, f"{page}.pdf")
+
+    def _run(self, image_path, langs):
+        out = self.layer_path(image_path, langs)
+        try:
+            if os.path.getmtime(out) >= os.path.getmtime(image_path):
+                return out
+        except OSError:
+            pass
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        tmp_base = out[:-len('.pdf')] + '.part'
+        started = time.monotonic()
+        res = subprocess.run(
+            ['tesseract', image_path, tmp_base, '-l', langs, '--dpi', '100',
+             '-c', 'textonly_pdf=1', 'pdf'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, env=self.env,
+        )
+        if res.returncode != 0:
+            raise RuntimeError(res.stderr.strip() or f"tesseract feilet for {image_path}")
+        metrics.observe('nbno_ocr_page_seconds', time.monotonic() - started, langs=langs)
+        os.replace(tmp_base + '.pdf', out)
+        return out
+
+    def submit(self, image_path, langs):
+        """Starter OCR av én side (om den ikke alt kjører); gir en Future."""
+        if not valid_ocr_langs(langs):
+            raise ValueError(f"Ugyldige OCR-språk: {langs!r}")
+        key = (image_path, langs)
+        with self.lock:
+            future = self.pending.get(key)
+            if future is None:
+                future = self.executor.submit(self._run, image_path, langs)
+                self.pending[key] = future
+                future.add_done_callback(lambda _f, key=key: self._done(key))
+        return future
+
+    def _done(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
+
+    def text_layers(self, image_paths, langs, log=print):
+        """OCR av alle sidene (fra cache der mulig); gir tekstlag per side, eller None."""
+        futures = [self.submit(path, langs) for path in image_paths]
+        layers = []
+        for idx, future in enumerate(futures, 1):
             try:
-                with open(mf, encoding='utf-8') as f:
-                    ts = json.load(f).get('timestamp')
-                if isinstance(ts, (int, float)):
-                    ts_map[name] = ts
-                elif isinstance(ts, str):
-                    try:
-                        ts_map[name] = int(datetime.fromisoformat(ts.rstrip('Z')).timestamp())
-                    except Exception:
-                        pass
-            except Exception:
-                pass
-            # fallback to metadata file mtime
-            if name not in ts_map:
-                try:
-                    ts_map[name] = os.path.getmtime(mf)
-                except Exception:
-                    pass
-    # sort by timestamp (0 for missing), newest first
-    entries.sort(key=lambda nm: ts_map.get(nm, 0), reverse=True)
-    for name in entries:
-        folder = os.path.join(download_dir, name)
-        # load saved metadata: title, original ID, thumbnail, type, pages
-        meta_file = os.path.join(folder, 'metadata', '.nbno_meta.json')
-        display = name.replace('_', ' ')
-        orig = name
+                layers.append(future.result())
+            except Exception as e:
+                log(f"OCR feilet for {os.path.basename(image_paths[idx - 1])}: {e}")
+                layers.append(None)
+            if idx % 10 == 0 or idx == len(futures):
+                log(f"OCR: {idx}/{len(futures)} sider")
+        return layers
+
+
+ocr_stage = None if IN_WORKER else OcrStage(OCR_WORKERS)
+
+
+def split_ocr_flags(flags):
+    """Trekker --language/-l ut av ocrmypdf-flaggene; gir (språk eller None, resten)."""
+    langs = None
+    rest = []
+    it = iter(flags)
+    for flag in it:
+        if flag in ('--language', '-l'):
+            langs = next(it, None)
+        elif flag.startswith('--language='):
+            langs = flag.split('=', 1)[1]
+        else:
+            rest.append(flag)
+    return langs, rest
+
+
+def merge_text_layers(pdf_path, layers):
+    """Legger tekstlagene oppå sidene i PDF-en (en side per lag, None hoppes over)."""
+    import pikepdf
+
+    sources = []
+    with pikepdf.open(pdf_path, allow_overwriting_input=True) as pdf:
+        for page, layer in zip(pdf.pages, layers):
+            if layer is None:
+                continue
+            # read into memory: the layer must stay open until save, and a
+            # thousand open file handles would run into the fd limit
+            with open(layer, 'rb') as f:
+                text_pdf = pikepdf.open(io.BytesIO(f.read()))
+            sources.append(text_pdf)
+            page.add_overlay(text_pdf.pages[0])
+        pdf.save(pdf_path)
+    for text_pdf in sources:
+        text_pdf.close()
+
+
+def ocr_command(book, pdf_path, ocr_flags, log=print):
+    """Kjører side-OCR for boken og gir ocrmypdf-kommandoen som gjenstår.
+
+    Med --language OCR-es sidene fra sources/ parallelt (og fra cache), og
+    tekstlagene flettes inn i PDF-en; ocrmypdf brukes da bare til
+    optimalisering med --skip-text. Uten språk, eller med --force-ocr /
+    --redo-ocr, får ocrmypdf flaggene uendret.
+    """
+    langs, rest = split_ocr_flags(ocr_flags)
+    if not langs or {'--force-ocr', '--redo-ocr', '-f'} & set(rest):
+        return ['ocrmypdf', *ocr_flags, pdf_path, pdf_path]
+    layers = ocr_stage.text_layers(book.pdf_page_files(), langs, log=log)
+    if not any(layers):
+        return ['ocrmypdf', *ocr_flags, pdf_path, pdf_path]
+    merge_text_layers(pdf_path, layers)
+    return ['ocrmypdf', '--skip-text', *rest, pdf_path, pdf_path]
+
+
+# downloads wait on the network and run side by side; PDF/OCR jobs are
+# CPU-bound and get their own, smaller pool
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '3'))
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', '1'))
+# processes that stitch and encode pages for all downloads; 0 keeps that
+# work in the download threads
+CPU_WORKERS = int(os.environ.get('CPU_WORKERS', '0'))
+
+# book events that are not worth a row each in the job log
+UNLOGGED_EVENTS = ('tile_fetched', 'page_started')
+
+
+class LogFile:
+    """logs/pdf_ocr.log, holdt åpen og delt av alle jobbene."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8', buffering=1)
+        self.lock = threading.Lock()
+
+    def write(self, msg):
+        with self.lock:
+            self.file.write(msg + "\n")
+
+
+class JobStore:
+    """Jobbkø og jobblogg i SQLite, slik at jobbene overlever omstart."""
+
+    ACTIVE = ('queued', 'running')
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    page INTEGER,
+                    total INTEGER,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    started REAL,
+                    finished REAL
+                );
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id INTEGER NOT NULL,
+                    event TEXT NOT NULL,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS events_job ON events (job_id, id);
+            """)
+
+    @staticmethod
+    def _row(row):
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        return job
+
+    def create(self, kind, key, params):
+        """Legger en jobb i kø; gir (id, ny). Samme bok står aldri i kø to ganger."""
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND key = ? AND state IN (?, ?)",
+                (kind, key, *self.ACTIVE),
+            ).fetchone()
+            if row:
+                return row['id'], False
+            cur = self.conn.execute(
+                "INSERT INTO jobs (kind, key, params, created) VALUES (?, ?, ?, ?)",
+                (kind, key, json.dumps(params), time.time()),
+            )
+            return cur.lastrowid, True
+
+    def update(self, job_id, **fields):
+        cols = ', '.join(f"{name} = ?" for name in fields)
+        with self.lock, self.conn:
+            self.conn.execute(f"UPDATE jobs SET {cols} WHERE id = ?", (*fields.values(), job_id))
+
+    def add_event(self, job_id, event, data):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO events (job_id, event, data) VALUES (?, ?, ?)",
+                (job_id, event, json.dumps(data)),
+            )
+
+    def events(self, job_id, after=0):
+        """Gir (løpenr, hendelse, data) for jobbens hendelser etter løpenr `after`."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, event, data FROM events WHERE job_id = ? AND id > ? ORDER BY id",
+                (job_id, after),
+            ).fetchall()
+        return [(row['id'], row['event'], json.loads(row['data'])) for row in rows]
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def list(self, limit=100):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def counts(self):
+        """Antall jobber per (type, tilstand)."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT kind, state, COUNT(*) FROM jobs GROUP BY kind, state"
+            ).fetchall()
+        return {(kind, state): n for kind, state, n in rows}
+
+    def unfinished(self):
+        """Jobber som ikke ble ferdige før forrige stopp; kjørende settes tilbake i kø."""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'")
+            rows = self.conn.execute(
+                "SELECT * FROM jobs WHERE state = 'queued' ORDER BY id"
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def prune(self, max_age):
+        """Sletter ferdige jobber (og loggen deres) eldre enn `max_age` sekunder."""
+        cutoff = time.time() - max_age
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM events WHERE job_id IN "
+                "(SELECT id FROM jobs WHERE state NOT IN (?, ?) AND finished < ?)",
+                (*self.ACTIVE, cutoff),
+            )
+            self.conn.execute(
+                "DELETE FROM jobs WHERE state NOT IN (?, ?) AND finished < ?",
+                (*self.ACTIVE, cutoff),
+            )
+
+
+class JobScheduler:
+    """Kjører jobber fra en JobStore, i én trådpool per jobbtype.
+
+    `runners` er {type: (funksjon, antall arbeidere)}; funksjonen kalles med
+    jobbens parametre og en hendelsesmottaker for Book.add_event_sink, og
+    gir False når jobben feilet. Hendelsene havner i jobbens logg, og
+    kjøretiden i `metrics` om den er gitt.
+    """
+
+    def __init__(self, store, runners, log_file=None, metrics=None):
+        self.store = store
+        self.log_file = log_file
+        self.metrics = metrics
+        self.runners = {kind: runner for kind, (runner, _) in runners.items()}
+        self.pools = {
+            kind: ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=f"job-{kind}")
+            for kind, (_, workers) in runners.items()
+        }
+
+    def submit(self, kind, key, params):
+        """Legger jobben i kø (eller finner den som alt venter); gir jobb-id."""
+        job_id, new = self.store.create(kind, key, params)
+        if new:
+            self.pools[kind].submit(self._run, job_id, kind, params)
+        return job_id
+
+    def resume(self):
+        """Starter jobbene som sto i kø eller kjørte da serveren stoppet."""
+        for job in self.store.unfinished():
+            self.pools[job['kind']].submit(self._run, job['id'], job['kind'], job['params'])
+
+    def record(self, job_id, event):
+        """Legger en hendelse fra Book (eller jobben selv) i jobbens logg."""
+        kind = event['type']
+        if kind in UNLOGGED_EVENTS:
+            return
+        data = {k: v for k, v in event.items() if k not in ('type', 'book')}
+        if kind == 'progress':
+            page, total = event['done'], event['total']
+            self.store.update(job_id, page=page, total=total)
+            data = {'page': page, 'total': total, 'msg': f"     Lagrer side {page} av {total}."}
+        self.store.add_event(job_id, kind, data)
+        if self.log_file is not None and 'msg' in data:
+            self.log_file.write(data['msg'])
+
+    def _run(self, job_id, kind, params):
+        self.store.update(job_id, state='running', started=time.time())
+        started = time.monotonic()
+        sink = lambda event: self.record(job_id, event)
+        state, error = 'done', None
         try:
-            import json
-            with open(meta_file, encoding='utf-8') as mf:
-                meta = json.load(mf)
-                orig = meta.get('orig', orig)
-                display = meta.get('custom_title') or meta.get('title', display)
-                thumb = meta.get('thumbnail')
-                mtype = meta.get('type')
-                pages = meta.get('pages')
-                custom = meta.get('custom_title')
+            if self.runners[kind](params, sink) is False:
+                state = 'failed'
+        except Exception as e:
+            state, error = 'failed', str(e)
+            sink({'type': 'log', 'msg': f"Feil i jobb {job_id}:"})
+            sink({'type': 'log', 'msg': traceback.format_exc().rstrip()})
+        finally:
+            self.store.update(job_id, state=state, error=error, finished=time.time())
+            self.store.add_event(job_id, 'done', {'state': state})
+            if self.metrics is not None:
+                self.metrics.observe(
+                    'nbno_job_seconds', time.monotonic() - started, kind=kind, outcome=state
+                )
+
+    def wait(self, job_id, poll=0.5):
+        """Venter til jobben er ferdig; gir jobben."""
+        while True:
+            job = self.store.get(job_id)
+            if job is None or job['state'] not in JobStore.ACTIVE:
+                return job
+            time.sleep(poll)
+
+    def stream(self, job_ids, poll=0.5):
+        """SSE for jobbene: log/progress per linje, job_done per jobb, done til slutt."""
+        last = dict.fromkeys(job_ids, 0)
+        while last:
+            idle = True
+            for job_id in list(last):
+                for seq, event, data in self.store.events(job_id, last[job_id]):
+                    idle = False
+                    last[job_id] = seq
+                    if event == 'done':
+                        event = 'job_done'
+                        del last[job_id]
+                    payload = json.dumps(dict(data, job=job_id))
+                    yield f"event: {event}\ndata: {payload}\n\n"
+            if idle:
+                time.sleep(poll)
+        yield 'event: done\ndata: {}\n\n'
+
+
+# GET / shows the library this many books at a time
+LIBRARY_PAGE_SIZE = int(os.environ.get('LIBRARY_PAGE_SIZE', '48'))
+# seconds between background checks of DOWNLOAD_DIR against the catalog
+LIBRARY_SCAN_INTERVAL = int(os.environ.get('LIBRARY_SCAN_INTERVAL', '60'))
+LIBRARY_SORTS = {
+    'date': 'timestamp DESC, dir',
+    'title': 'title COLLATE NOCASE, dir',
+    'pages': 'pages DESC, dir',
+    'dir': 'dir',
+}
+
+
+def read_book(folder):
+    """Leser det biblioteket viser om én bokmappe (metadata, omslag, PDF)."""
+    name = os.path.basename(folder)
+    # load saved metadata: title, original ID, thumbnail, type, pages
+    meta_file = os.path.join(folder, 'metadata', '.nbno_meta.json')
+    meta = {}
+    try:
+        with open(meta_file, encoding='utf-8') as mf:
+            meta = json.load(mf)
+    except Exception:
+        pass
+    # numeric timestamps (UNIX) or legacy ISO strings, else the file's mtime
+    ts = meta.get('timestamp')
+    timestamp = None
+    if isinstance(ts, (int, float)):
+        timestamp = ts
+    elif isinstance(ts, str):
+        try:
+            timestamp = int(datetime.fromisoformat(ts.rstrip('Z')).timestamp())
         except Exception:
-            thumb = None
-            mtype = None
-            pages = None
-            custom = None
-        # pick C1.jpg if present, else fall back to first page 0001.jpg; else use metadata thumbnail
-        sources_folder = os.path.join(folder, 'sources')
-        cover_file = None
-        # prefer front cover C1.jpg
-        if os.path.exists(os.path.join(sources_folder, 'C1.jpg')):
-            cover_file = 'C1.jpg'
-        else:
-            # fallback to first numeric page
-            if os.path.exists(os.path.join(sources_folder, '0001.jpg')):
-                cover_file = '0001.jpg'
-        # detect existing pdf in pdf subfolder and compute size if present
-        pdf_path = os.path.join(folder, 'pdf', f"{name}.pdf")
-        has_pdf = os.path.exists(pdf_path)
-        pdf_size = None
-        if has_pdf:
+            pass
+    if timestamp is None:
+        try:
+            timestamp = os.path.getmtime(meta_file)
+        except OSError:
+            timestamp = 0
+    # prefer front cover C1, then first page 0001 (in any saved image format),
+    # then the manifest thumbnail
+    sources_folder = os.path.join(folder, 'sources')
+    cover = meta.get('thumbnail')
+    cover_files = [page + ext for page in ('C1', '0001') for ext in IMAGE_EXTENSIONS]
+    for cover_file in cover_files:
+        if os.path.exists(os.path.join(sources_folder, cover_file)):
+            cover = f'/files/{name}/sources/{cover_file}?w=500'
+            break
+    # detect existing pdf in pdf subfolder and its size
+    try:
+        pdf_bytes = os.path.getsize(os.path.join(folder, 'pdf', f"{name}.pdf"))
+        has_pdf = True
+    except OSError:
+        pdf_bytes, has_pdf = 0, False
+    return {
+        'dir': name,
+        'orig': meta.get('orig', name),
+        'title': meta.get('custom_title') or meta.get('title', name.replace('_', ' ')),
+        'custom_title': meta.get('custom_title'),
+        'type': meta.get('type'),
+        'pages': meta.get('pages'),
+        'cover': cover,
+        'has_pdf': has_pdf,
+        'pdf_bytes': pdf_bytes,
+        'timestamp': timestamp,
+    }
+
+
+class Library:
+    """Katalog over bøkene i DOWNLOAD_DIR, i SQLite.
+
+    Jobbene oppdaterer boken sin når de er ferdige. I tillegg sammenlignes
+    mappene med katalogen i bakgrunnen, på mtime, slik at endringer gjort
+    utenom web-appen også kommer med uten at hver forside leser alle mappene.
+    """
+
+    COLUMNS = ('dir', 'orig', 'title', 'custom_title', 'type', 'pages', 'cover',
+               'has_pdf', 'pdf_bytes', 'timestamp', 'signature')
+
+    def __init__(self, path, root):
+        self.root = root
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self.scan_lock = threading.Lock()
+        self.scanned = threading.Event()
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS books (
+                    dir TEXT PRIMARY KEY,
+                    orig TEXT,
+                    title TEXT,
+                    custom_title TEXT,
+                    type TEXT,
+                    pages INTEGER,
+                    cover TEXT,
+                    has_pdf INTEGER NOT NULL DEFAULT 0,
+                    pdf_bytes INTEGER NOT NULL DEFAULT 0,
+                    timestamp REAL NOT NULL DEFAULT 0,
+                    signature REAL
+                );
+                CREATE INDEX IF NOT EXISTS books_timestamp ON books (timestamp DESC, dir);
+                CREATE INDEX IF NOT EXISTS books_title ON books (title COLLATE NOCASE, dir);
+                CREATE INDEX IF NOT EXISTS books_pages ON books (pages DESC, dir);
+            """)
+
+    @staticmethod
+    def is_book_dir(name):
+        return name != 'logs' and not name.startswith('.')
+
+    def _signature(self, folder):
+        """Nyeste mtime for mappen, undermappene og metadatafilen."""
+        latest = 0.0
+        for sub in ('', 'sources', 'pdf', 'metadata', os.path.join('metadata', '.nbno_meta.json')):
             try:
-                size = os.path.getsize(pdf_path)
-                pdf_size = f"{round(size / (1024 * 1024))} MB"
-            except Exception:
-                pdf_size = None
-        # choose cover URL: prefer local C1 or 0001 via ?w=500; fallback to metadata thumbnail
-        cover_url = None
-        if cover_file:
-            cover_url = f'/files/{name}/sources/{cover_file}?w=500'
-        elif thumb:
-            cover_url = thumb
-        books.append({
-            'dir': name,
-            'orig': orig,
-            'title': display,
-            'custom_title': custom,
-            'type': mtype,
-            'pages': pages,
-            'cover': cover_url,
-            'pdf_url': f'/files/{name}/pdf/{name}.pdf',
-            'has_pdf': has_pdf,
-            'pdf_size': pdf_size,
-        })
-    # detect available Tesseract languages via tesseract CLI
+                latest = max(latest, os.stat(os.path.join(folder, sub)).st_mtime)
+            except OSError:
+                pass
+        return latest
+
+    def refresh(self, name, signature=None):
+        """Leser én bokmappe inn i katalogen på nytt (eller fjerner den)."""
+        folder = os.path.join(self.root, name)
+        if not self.is_book_dir(name) or not os.path.isdir(folder):
+            self.remove(name)
+            return
+        if signature is None:
+            signature = self._signature(folder)
+        book = dict(read_book(folder), signature=signature)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO books ({', '.join(self.COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                [book[col] for col in self.COLUMNS],
+            )
+
+    def remove(self, name):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM books WHERE dir = ?", (name,))
+
+    def reconcile(self):
+        """Sammenligner DOWNLOAD_DIR med katalogen og leser bare endrede mapper."""
+        with self.scan_lock:
+            with self.lock:
+                known = dict(self.conn.execute("SELECT dir, signature FROM books").fetchall())
+            try:
+                names = [
+                    entry.name for entry in os.scandir(self.root)
+                    if entry.is_dir() and self.is_book_dir(entry.name)
+                ]
+            except OSError:
+                names = []
+            for name in names:
+                signature = self._signature(os.path.join(self.root, name))
+                if known.pop(name, None) != signature:
+                    self.refresh(name, signature)
+            for name in known:
+                self.remove(name)
+        self.scanned.set()
+
+    def page(self, sort, page, per_page):
+        """Gir (bøker på siden, antall bøker totalt)."""
+        with self.lock:
+            total = self.conn.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+            rows = self.conn.execute(
+                f"SELECT * FROM books ORDER BY {LIBRARY_SORTS[sort]} LIMIT ? OFFSET ?",
+                (per_page, (page - 1) * per_page),
+            ).fetchall()
+        return [dict(row) for row in rows], total
+
+    def _watch(self, interval):
+        while True:
+            try:
+                self.reconcile()
+            except Exception as e:
+                print(f"Feil ved gjennomgang av biblioteket: {e}")
+            time.sleep(interval)
+
+    def start(self, interval):
+        """Går gjennom DOWNLOAD_DIR nå, og deretter hvert `interval` sekund."""
+        threading.Thread(target=self._watch, args=(interval,), daemon=True).start()
+
+
+def job_logger(sink):
+    """Gir log(msg) som sender meldingen til jobbens logg."""
+    return lambda msg: sink({'type': 'log', 'msg': str(msg)})
+
+
+def run_download_job(params, sink):
+    """Laster ned én bok; parametrene kommer fra /download."""
+    log = job_logger(sink)
+    book = Book(params['id'])
+    book.set_quiet()
+    book.add_event_sink(sink)
+    book.add_event_sink(MetricsSink(metrics, media_type=book.media_type))
+    book.set_folder_name(params['folder'])
+    book.set_tile_cache(tile_cache)
+    book.set_cpu_workers(CPU_WORKERS)
+    # a restarted container picks up half-finished pages
+    book.set_resume()
+    if any(params.get(key) for key in ('format', 'quality', 'progressive', 'optimize')):
+        book.set_output(
+            params.get('format') or 'jpeg', params.get('quality'),
+            bool(params.get('progressive')), bool(params.get('optimize')),
+        )
+    # pages kept as tiles have no image to preview or OCR
+    if book.output_format != 'tiles':
+        book.add_page_hook(lambda page, path: prerender_thumbnails(path))
+        ocr_langs = params.get('ocr')
+        if ocr_langs:
+            book.add_page_hook(lambda page, path: ocr_stage.submit(path, ocr_langs))
+    # remember custom title for metadata, and show it in the banner
+    book.custom_title = params['name']
+    log(f"\n=== Downloading {params['id']} - '{book.custom_title}' ===")
+    if params.get('cover'):
+        book.download_covers()
+    if params.get('title'):
+        book.set_title()
+    if params.get('resize') is not None:
+        book.set_resize(params['resize'])
+    if params.get('start') is not None:
+        book.set_from_page(params['start'])
+    if params.get('stop') is not None:
+        book.set_to_page(params['stop'])
+    try:
+        return book.download() is not False
+    finally:
+        library.refresh(book.folder_name)
+
+
+def run_pdf_job(params, sink):
+    """Lager PDF av en nedlastet bok og kjører ocrmypdf; parametrene kommer fra /make_pdf."""
+    dirname = params['dirname']
+    download_dir = os.environ.get('DOWNLOAD_DIR', '.')
+    # load original ID from metadata
+    orig = dirname
+    meta_file = os.path.join(download_dir, dirname, 'metadata', '.nbno_meta.json')
+    try:
+        with open(meta_file, encoding='utf-8') as mf:
+            orig = json.load(mf).get('orig', orig)
+    except Exception:
+        pass
+    log = job_logger(sink)
+    log(f"Building PDF for {dirname}...")
+    # manifest comes from metadata/, so PDF builds need no network
+    book = Book(orig, offline=True)
+    book.set_quiet()
+    book.add_event_sink(sink)
+    book.add_event_sink(MetricsSink(metrics, media_type=book.media_type))
+    book.set_folder_name(dirname)
+    # honor GUI toggle for including cover as first page
+    if params.get('include_cover'):
+        book.set_include_cover(True)
+    try:
+        if not book.make_pdf():
+            return False
+    finally:
+        library.refresh(dirname)
+    # always run ocrmypdf to compress (and OCR if enabled); pages are OCRed
+    # in parallel (or taken from the per-page cache) before it runs
+    pdf_path = os.path.join(download_dir, dirname, 'pdf', f"{dirname}.pdf")
+    cmd = ocr_command(book, pdf_path, params.get('flags', []), log=log)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    for line in proc.stdout:
+        log(line.strip())
+    ok = proc.wait() == 0
+    # ocrmypdf rewrote the PDF, so its size changed
+    library.refresh(dirname)
+    return ok
+
+
+_job_dir = os.environ.get('DOWNLOAD_DIR', '.')
+job_store = scheduler = library = None
+if not IN_WORKER:
+    os.makedirs(_job_dir, exist_ok=True)
+    job_store = JobStore(os.path.join(_job_dir, '.nbno_jobs.sqlite3'))
+    # finished jobs are kept a week for the status endpoint
+    job_store.prune(7 * 24 * 3600)
+    scheduler = JobScheduler(job_store, {
+        'download': (run_download_job, DOWNLOAD_WORKERS),
+        'pdf': (run_pdf_job, PDF_WORKERS),
+    }, log_file=LogFile(os.path.join(_job_dir, 'logs', 'pdf_ocr.log')), metrics=metrics)
+    library = Library(os.path.join(_job_dir, '.nbno_library.sqlite3'), _job_dir)
+    library.start(LIBRARY_SCAN_INTERVAL)
+    scheduler.resume()
+
+
+app = Flask(__name__)
+
+
+@app.route('/', methods=['GET'])
+def index():
+    # books come from the library catalog, one page at a time
+    sort = request.args.get('sort', 'date')
+    if sort not in LIBRARY_SORTS:
+        sort = 'date'
+    page = max(1, request.args.get('page', 1, type=int))
+    # the first scan after startup has to finish before the catalog is complete
+    library.scanned.wait(timeout=30)
+    rows, total = library.page(sort, page, LIBRARY_PAGE_SIZE)
+    books = []
+    for row in rows:
+        name = row['dir']
+        books.append(dict(
+            row,
+            pdf_url=f'/files/{name}/pdf/{name}.pdf',
+            pdf_size=f"{round(row['pdf_bytes'] / (1024 * 1024))} MB" if row['has_pdf'] else None,
+        ))
+    return render_template(
+        'index.html', books=books, ocrlangs=tesseract_languages(),
+        sort=sort, page=page, page_count=max(1, -(-total // LIBRARY_PAGE_SIZE)), total=total,
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def tesseract_languages():
+    """Tesseract-språkene som er installert (spørres én gang per prosess)."""
     ocrlangs = []
     try:
         res = subprocess.run(
@@ -129,7 +813,7 @@ def index():
                 ocrlangs.append(code)
     except Exception:
         pass
-    return render_template('index.html', books=books, ocrlangs=ocrlangs)
+    return ocrlangs
 
 
 @app.route('/files/<path:subpath>')
@@ -138,21 +822,21 @@ def files(subpath):
     download_dir = os.environ.get('DOWNLOAD_DIR', '.')
     path = os.path.join(download_dir, subpath)
     if os.path.exists(path):
-        # on-the-fly resizing for JPEGs via ?w=width parameter
-        if subpath.lower().endswith('.jpg'):
+        # on-the-fly resizing (to JPEG) for page images via ?w=width parameter
+        if subpath.lower().endswith(IMAGE_EXTENSIONS):
             width = request.args.get('w', type=int)
             if width:
                 try:
-                    from PIL import Image
-
-                    img = Image.open(path)
-                    wpercent = width / float(img.size[0])
-                    hsize = int(img.size[1] * wpercent)
-                    img = img.resize((width, hsize), Image.LANCZOS)
-                    buf = io.BytesIO()
-                    img.save(buf, format='JPEG', quality=85)
-                    buf.seek(0)
-                    return send_file(buf, mimetype='image/jpeg')
+                    # the ETag only needs a stat, so a repeat costs no decoding
+                    etag = thumbnail_etag(path, width)
+                    if etag in request.if_none_match:
+                        resp = Response(status=304)
+                    else:
+                        data, etag = thumbnail(path, width)
+                        resp = send_file(io.BytesIO(data), mimetype='image/jpeg')
+                    resp.set_etag(etag)
+                    resp.headers['Cache-Control'] = 'no-cache'
+                    return resp
                 except Exception:
                     pass
         return send_from_directory(download_dir, subpath)
@@ -160,106 +844,30 @@ def files(subpath):
 
 @app.route('/make_pdf/<dirname>', methods=['GET', 'POST'])
 def make_pdf(dirname):
-    """Generate PDF for a downloaded book and optionally OCR via ocrmypdf."""
-    # only one PDF/OCR job at a time
-    if not pdf_lock.acquire(blocking=False):
-        return jsonify({'error': 'En annen PDF-prosess kjører allerede'}), 409
+    """Queue a PDF (and ocrmypdf) job for a downloaded book."""
     download_dir = os.environ.get('DOWNLOAD_DIR', '.')
     folder = os.path.join(download_dir, dirname)
     if not os.path.isdir(folder):
         return jsonify({'error': 'Folder not found'}), 404
-    # load original ID from metadata
-    orig = dirname
-    meta_file = os.path.join(folder, 'metadata', '.nbno_meta.json')
-    try:
-        with open(meta_file, encoding='utf-8') as mf:
-            meta = json.load(mf)
-            orig = meta.get('orig', orig)
-    except Exception:
-        pass
     # OCR options and streaming flag
     raw_flags = request.args.get('flags', '').strip()
-    ocr_flags = raw_flags.split() if raw_flags else []
-    include_cover = request.args.get('include_cover') == 'true'
-    stream = request.args.get('stream') == '1'
-    # quick non-streaming mode (JSON response)
-    if not stream:
-        try:
-            book = Book(orig)
-            book.set_folder_name(dirname)
-            if include_cover:
-                book.set_include_cover(True)
-            ok = book.make_pdf()
-            if ok:
-                # run the exact ocrmypdf CLI command as provided by the GUI
-                pdf_path = os.path.join(download_dir, dirname, 'pdf', f"{dirname}.pdf")
-                cmd = ['ocrmypdf', *ocr_flags, pdf_path, pdf_path]
-                subprocess.run(cmd, check=True)
-            return jsonify({'success': ok}) if ok else ('', 500)
-        except Exception as e:
-            return jsonify({'error': str(e)}), 500
-        finally:
-            pdf_lock.release()
-    # streaming SSE logs; also append to server-side log file
-    records = queue.Queue()
-    logs_dir = os.path.join(download_dir, 'logs')
-    os.makedirs(logs_dir, exist_ok=True)
-    log_file = os.path.join(logs_dir, 'pdf_ocr.log')
-    def hook_print(*args, **kwargs):
-        msg = ' '.join(str(a) for a in args)
-        # send to SSE queue
-        records.put(msg)
-        # append to persistent log file
-        try:
-            with open(log_file, 'a', encoding='utf-8') as lf:
-                lf.write(msg + "\n")
-        except Exception:
-            pass
-
-    old_print = builtins.print
-    builtins.print = hook_print
-    def worker():
-        try:
-            print(f"Building PDF for {dirname}...")
-            book = Book(orig)
-            book.set_folder_name(dirname)
-            # honor GUI toggle for including cover as first page
-            if include_cover:
-                book.set_include_cover(True)
-            book.make_pdf()
-            # always run ocrmypdf to compress (and OCR if enabled)
-            pdf_path = os.path.join(download_dir, dirname, 'pdf', f"{dirname}.pdf")
-            # build ocrmypdf command exactly from user-provided flags
-            cmd = ['ocrmypdf']
-            if ocr_flags:
-                cmd.extend(ocr_flags)
-            cmd.extend([pdf_path, pdf_path])
-            # DEBUG: show the ocrmypdf command in streaming worker
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-            for line in proc.stdout:
-                print(line.strip())
-            proc.wait()
-        except Exception:
-            print("Error while building PDF:")
-            import traceback
-
-            traceback.print_exc()
-        finally:
-            builtins.print = old_print
-            records.put(None)
-            pdf_lock.release()
-
-    threading.Thread(target=worker, daemon=True).start()
-    def generate():
-        while True:
-            msg = records.get()
-            if msg is None:
-                yield 'event: done\ndata: {}\n\n'
-                break
-            payload = json.dumps({'msg': msg})
-            yield f"event: log\ndata: {payload}\n\n"
-
-    return Response(generate(), mimetype='text/event-stream')
+    flags = raw_flags.split() if raw_flags else []
+    langs, _ = split_ocr_flags(flags)
+    if langs is not None and not valid_ocr_langs(langs):
+        return jsonify({'error': f'Invalid OCR languages: {langs}'}), 400
+    job_id = scheduler.submit('pdf', dirname, {
+        'dirname': dirname,
+        'flags': flags,
+        'include_cover': request.args.get('include_cover') == 'true',
+    })
+    # streaming SSE logs for the job
+    if request.args.get('stream') == '1':
+        return Response(scheduler.stream([job_id]), mimetype='text/event-stream')
+    # non-streaming mode: wait for the job, JSON response
+    job = scheduler.wait(job_id)
+    if job['state'] != 'done':
+        return jsonify({'error': job['error'] or 'PDF feilet', 'job': job_id}), 500
+    return jsonify({'success': True, 'job': job_id})
 
 @app.route('/pages/<dirname>', methods=['GET'])
 def pages(dirname):
@@ -269,24 +877,25 @@ def pages(dirname):
     sources = os.path.join(folder, 'sources')
     if not os.path.isdir(sources):
         return jsonify([])
-    imgs = sorted(f for f in os.listdir(sources) if f.lower().endswith('.jpg'))
+    imgs = sorted(f for f in os.listdir(sources) if f.lower().endswith(IMAGE_EXTENSIONS))
+    # page names without extension, since pages may be saved as .jpg, .webp, ...
+    lower_imgs = [os.path.splitext(f)[0].lower() for f in imgs]
     include_cover = request.args.get('include_cover') == 'true'
     if include_cover:
         # desired order: C1, I1, numbered pages, I3, C2, C3
-        lower_imgs = [f.lower() for f in imgs]
         ordered = []
-        for name in ('c1.jpg', 'i1.jpg'):
+        for name in ('c1', 'i1'):
             if name in lower_imgs:
                 idx = lower_imgs.index(name)
                 ordered.append(imgs[idx])
                 imgs.pop(idx)
                 lower_imgs.pop(idx)
         # numeric pages
-        numeric = [f for f in imgs if f[:-4].isdigit()]
+        numeric = [f for f, stem in zip(imgs, lower_imgs) if stem.isdigit()]
         ordered.extend(numeric)
-        imgs = [f for f in imgs if not f[:-4].isdigit()]
-        lower_imgs = [f.lower() for f in imgs]
-        for name in ('i3.jpg', 'c2.jpg', 'c3.jpg'):
+        imgs = [f for f, stem in zip(imgs, lower_imgs) if not stem.isdigit()]
+        lower_imgs = [os.path.splitext(f)[0].lower() for f in imgs]
+        for name in ('i3', 'c2', 'c3'):
             if name in lower_imgs:
                 idx = lower_imgs.index(name)
                 ordered.append(imgs[idx])
@@ -296,10 +905,9 @@ def pages(dirname):
         ordered.extend(imgs)
         imgs = ordered
     else:
-        # if a front cover thumbnail named C1.jpg exists, show it first
-        lower_imgs = [f.lower() for f in imgs]
-        if 'c1.jpg' in lower_imgs:
-            idx = lower_imgs.index('c1.jpg')
+        # if a front cover thumbnail named C1 exists, show it first
+        if 'c1' in lower_imgs:
+            idx = lower_imgs.index('c1')
             imgs.insert(0, imgs.pop(idx))
     return jsonify(imgs)
 
@@ -311,6 +919,7 @@ def delete_book(bookname):
     folder = os.path.join(download_dir, bookname)
     try:
         shutil.rmtree(folder)
+        library.remove(bookname)
         return ('', 204)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -341,9 +950,8 @@ def preview():
     if 'C1' in book.page_url:
         c1_url = f"{book.page_url['C1']}/full/!200,200/0/native.jpg"
         try:
-            import requests
-
-            resp = requests.head(c1_url, timeout=5)
+            # the book's session shares the process-wide connection pool
+            resp = book.session.head(c1_url, timeout=5)
             if resp.status_code == 200:
                 thumb = c1_url
                 preview_page = 'C1'
@@ -379,91 +987,79 @@ def download():
     media_names = [n.strip() for n in re.split(r'[;,]+', raw_names) if n.strip()]
 
     # gather options
-    cover_flag = request.args.get('cover') == 'true'
-    title_flag = request.args.get('title') == 'true'
-    try:
-        resize_val = int(request.args.get('resize'))
-    except (TypeError, ValueError):
-        resize_val = None
-    try:
-        start_val = int(request.args.get('start'))
-    except (TypeError, ValueError):
-        start_val = None
-    try:
-        stop_val = int(request.args.get('stop'))
-    except (TypeError, ValueError):
-        stop_val = None
-
-    # setup persistent logging (download + OCR) via SSE & file
-    records = queue.Queue()
-    download_dir = os.environ.get('DOWNLOAD_DIR', '.')
-    logs_dir = os.path.join(download_dir, 'logs')
-    os.makedirs(logs_dir, exist_ok=True)
-    log_file = os.path.join(logs_dir, 'pdf_ocr.log')
-
-    def hook_print(*args, **kwargs):
-        msg = ' '.join(str(a) for a in args)
-        # SSE
-        records.put(msg)
-        # append to persistent log
+    options = {
+        'cover': request.args.get('cover') == 'true',
+        'title': request.args.get('title') == 'true',
+        # OCR languages: pages are OCRed as soon as they are saved
+        'ocr': request.args.get('ocr', '').strip(),
+    }
+    for arg in ('resize', 'start', 'stop', 'quality'):
         try:
-            with open(log_file, 'a', encoding='utf-8') as lf:
-                lf.write(msg + "\n")
-        except Exception:
-            pass
+            options[arg] = int(request.args.get(arg))
+        except (TypeError, ValueError):
+            options[arg] = None
+    # page output: format=jpeg|webp|png|tiff|tiles, quality, progressive, optimize
+    output_format = request.args.get('format', '').strip().lower()
+    if output_format and output_format not in OUTPUT_FORMATS:
+        return f"Unknown format: {output_format}", 400
+    if options['quality'] is not None and not 1 <= options['quality'] <= 100:
+        return "quality must be between 1 and 100", 400
+    if options['ocr'] and not valid_ocr_langs(options['ocr']):
+        return f"Invalid OCR languages: {options['ocr']}", 400
+    options['format'] = output_format or None
+    options['progressive'] = request.args.get('progressive') == 'true'
+    options['optimize'] = request.args.get('optimize') == 'true'
 
-    import builtins
-    old_print = builtins.print
-    builtins.print = hook_print
+    # one job per book, so several books download side by side
+    job_ids = []
+    for idx, mid in enumerate(media_ids):
+        # allow custom title/folder name; replace whitespace with underscores
+        raw_name = media_names[idx] if idx < len(media_names) else mid
+        clean = re.sub(r"[^\w\s-]", "", raw_name)
+        folder_name = re.sub(r"\s+", "_", clean)
+        params = dict(options, id=mid, name=raw_name, folder=folder_name)
+        job_ids.append(scheduler.submit('download', mid, params))
 
-    def worker():
-        try:
-            for idx, mid in enumerate(media_ids):
-                # allow custom title/folder name; replace whitespace with underscores
-                raw_name = media_names[idx] if idx < len(media_names) else mid
-                clean = re.sub(r"[^\w\s-]", "", raw_name)
-                folder_name = re.sub(r"\s+", "_", clean)
-                # instantiate and remember custom title for metadata
-                book = Book(mid)
-                book.set_folder_name(folder_name)
-                book.custom_title = raw_name
-                # show custom title (matches metadata) in banner
-                print(f"\n=== Downloading {mid} - '{book.custom_title}' ===")
-                if cover_flag:
-                    book.download_covers()
-                if title_flag:
-                    book.set_title()
-                if resize_val is not None:
-                    book.set_resize(resize_val)
-                if start_val is not None:
-                    book.set_from_page(start_val)
-                if stop_val is not None:
-                    book.set_to_page(stop_val)
-                book.download()
-        finally:
-            builtins.print = old_print
-            records.put(None)
+    if request.args.get('stream') == '0':
+        return jsonify({'jobs': job_ids})
+    return Response(scheduler.stream(job_ids), mimetype='text/event-stream')
 
-    threading.Thread(target=worker, daemon=True).start()
 
-    prog_pattern = re.compile(r"side\s+(\d+)\s+av\s+(\d+)", re.IGNORECASE)
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Counters, histograms and queue depth in Prometheus text format."""
+    counts = job_store.counts()
+    for kind in scheduler.pools:
+        for state in JobStore.ACTIVE:
+            metrics.set('nbno_jobs', counts.get((kind, state), 0), kind=kind, state=state)
+    http = http_pool.stats()
+    metrics.set('nbno_http_requests_total', http['requests'])
+    metrics.set('nbno_http_connections_total', http['connections'])
+    metrics.set('nbno_http_pool_size', http['size'])
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
-    def generate():
-        while True:
-            msg = records.get()
-            if msg is None:
-                yield 'event: done\ndata: {}\n\n'
-                break
-            m = prog_pattern.search(msg)
-            if m:
-                p, t = map(int, m.groups())
-                payload = json.dumps({'page': p, 'total': t, 'msg': msg})
-                yield f"event: progress\ndata: {payload}\n\n"
-            else:
-                payload = json.dumps({'msg': msg})
-                yield f"event: log\ndata: {payload}\n\n"
-
-    return Response(generate(), mimetype='text/event-stream')
+
+@app.route('/jobs', methods=['GET'])
+def jobs():
+    """List recent jobs, newest first."""
+    limit = request.args.get('limit', 100, type=int)
+    return jsonify(job_store.list(limit))
+
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+
+@app.route('/jobs/<int:job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """SSE stream of a job's log, replayed from the start."""
+    if job_store.get(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return Response(scheduler.stream([job_id]), mimetype='text/event-stream')
 
 
 if __name__ == '__main__':